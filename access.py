@@ -0,0 +1,10 @@
+# access.py
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ID администраторов бота (ADMIN_IDS в .env через запятую) — единственное место, где они читаются:
+# проверки доступа в хендлерах, меню пользователей, исключения из ограничений частоты
+ADMIN_IDS = [int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()]
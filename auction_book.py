@@ -0,0 +1,183 @@
+# auction_book.py
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+import db
+
+# Сколько лучших ставок держим в памяти (хватает для поста в канале)
+BOOK_TOP_N = 5
+
+
+class LiveAuctionBook:
+    """
+    Состояние активного лота в памяти процесса: строка аукциона, топ-N ставок,
+    число ставок и время последней ставки каждого участника.
+    БД остается источником истины: ставка сначала записывается в БД,
+    и только после коммита применяется к книге (apply_bid).
+    """
+
+    def __init__(self, auction: Dict[str, Any], top_bids: List[Dict[str, Any]], bids_count: int,
+                 last_bid_times: Dict[int, datetime], last_bid_id: Optional[int] = None):
+        self.auction = auction
+        self.top_bids = list(top_bids)
+        self.bids_count = bids_count
+        self.last_bid_times = last_bid_times
+        # Ставки лота записываются под блокировкой строки аукциона, поэтому их ID растут в порядке коммита:
+        # ставка с ID не больше last_bid_id уже учтена (свою ставку процесс получает и через NOTIFY)
+        self.last_bid_id = last_bid_id or 0
+
+    @property
+    def auction_id(self) -> int:
+        return self.auction['auction_id']
+
+    @property
+    def leader(self) -> Optional[Dict[str, Any]]:
+        return self.top_bids[0] if self.top_bids else None
+
+    @property
+    def current_price(self) -> float:
+        leader = self.leader
+        return leader['bid_amount'] if leader else self.auction['start_price']
+
+    @property
+    def min_next_bid(self) -> float:
+        return self.current_price + self.auction['min_step']
+
+    def user_last_bid_time(self, user_id: int) -> Optional[datetime]:
+        return self.last_bid_times.get(user_id)
+
+    def apply_bid(self, bid: Dict[str, Any]) -> bool:
+        """
+        Применяет уже записанную в БД ставку (формат как у db.get_top_bids).
+        Возвращает False, если ставка уже была учтена.
+        """
+        if bid['bid_id'] <= self.last_bid_id:
+            return False
+        self.last_bid_id = bid['bid_id']
+        self.bids_count += 1
+        self.last_bid_times[bid['user_id']] = bid['bid_time']
+        self.top_bids.append(bid)
+        # Та же сортировка, что и в SQL: сумма по убыванию, при равенстве — более ранняя
+        self.top_bids.sort(key=lambda b: (-b['bid_amount'], b['bid_time']))
+        del self.top_bids[BOOK_TOP_N:]
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Возвращает состояние в формате db.get_auction_snapshot."""
+        return {
+            'auction': dict(self.auction),
+            'leader': self.leader,
+            'top_bids': list(self.top_bids),
+            'bids_count': self.bids_count,
+            'last_bid_id': self.last_bid_id or None,
+        }
+
+
+_books: Dict[int, LiveAuctionBook] = {}
+_loading: Dict[int, asyncio.Task] = {}
+# Счетчик ставок, примененных (или пропущенных) с момента старта загрузки книги:
+# если он изменился, пока книга грузилась, загруженные данные могли устареть.
+_bid_versions: Dict[int, int] = defaultdict(int)
+# Фоновые оповещения других процессов об изменении лота
+_publish_tasks: Set[asyncio.Task] = set()
+
+
+async def _load_book(auction_id: int) -> Optional[LiveAuctionBook]:
+    try:
+        while True:
+            version = _bid_versions[auction_id]
+            snapshot = await db.get_auction_snapshot(auction_id, top_n=BOOK_TOP_N)
+            if not snapshot or snapshot['auction']['status'] != 'active':
+                return None
+            last_bid_times = await db.get_last_bid_times(auction_id)
+            if version == _bid_versions[auction_id]:
+                break
+        book = LiveAuctionBook(snapshot['auction'], snapshot['top_bids'], snapshot['bids_count'], last_bid_times,
+                               snapshot['last_bid_id'])
+        _books[auction_id] = book
+        return book
+    finally:
+        _loading.pop(auction_id, None)
+
+
+def peek_book(auction_id: int) -> Optional[LiveAuctionBook]:
+    """Возвращает книгу лота, если она уже в памяти (без обращения к БД)."""
+    return _books.get(auction_id)
+
+
+async def get_book(auction_id: int) -> Optional[LiveAuctionBook]:
+    """Возвращает книгу активного лота, при необходимости загружая ее из БД. None — лот неактивен."""
+    book = _books.get(auction_id)
+    if book is not None:
+        return book
+    task = _loading.get(auction_id)
+    if task is None:
+        task = asyncio.create_task(_load_book(auction_id))
+        _loading[auction_id] = task
+    return await asyncio.shield(task)
+
+
+async def hydrate():
+    """Загружает книги всех активных лотов (при старте бота)."""
+    for auction in await db.get_active_auctions():
+        await get_book(auction['auction_id'])
+    logging.info(f"Загружено книг активных лотов: {len(_books)}")
+
+
+def apply_bid(bid: Dict[str, Any], end_time: Optional[datetime] = None):
+    """
+    Применяет записанную ставку к книге лота (если книга в памяти); повторное применение ничего не меняет.
+    end_time — время окончания лота после ставки (антиснайпинг мог его продлить).
+    """
+    _bid_versions[bid['auction_id']] += 1
+    book = _books.get(bid['auction_id'])
+    if book is not None:
+        book.apply_bid(bid)
+        if end_time is not None:
+            book.auction['end_time'] = end_time
+
+
+def update_auction(auction_id: int, **fields):
+    """Обновляет поля аукциона в книге (название, описание, время окончания и т.п.)."""
+    book = _books.get(auction_id)
+    if book is not None:
+        book.auction.update(fields)
+    _publish_change(auction_id)
+
+
+def drop(auction_id: int):
+    """Удаляет книгу завершенного лота."""
+    invalidate(auction_id)
+    _publish_change(auction_id)
+
+
+def invalidate(auction_id: int):
+    """Удаляет книгу только в этом процессе: при следующем обращении она загрузится из БД."""
+    _books.pop(auction_id, None)
+    if auction_id in _loading:
+        _bid_versions[auction_id] += 1  # Загружаемые сейчас данные могли устареть
+    else:
+        _bid_versions.pop(auction_id, None)
+
+
+def invalidate_all():
+    """Удаляет все книги (например, процесс мог пропустить изменения других процессов)."""
+    for auction_id in set(_books) | set(_loading):
+        invalidate(auction_id)
+
+
+def _publish_change(auction_id: int):
+    # Другие процессы кластера перечитают книгу лота из БД (см. cluster.py)
+    if db.cluster_events:
+        task = asyncio.create_task(db.notify_cluster({'type': 'book', 'auction_id': auction_id}))
+        _publish_tasks.add(task)
+        task.add_done_callback(_publish_done)
+
+
+def _publish_done(task: asyncio.Task):
+    _publish_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Не удалось оповестить кластер об изменении лота: {task.exception()}")
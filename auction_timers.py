@@ -0,0 +1,70 @@
+# auction_timers.py
+import logging
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional
+
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.base import STATE_RUNNING, STATE_STOPPED
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from aiogram import Bot
+
+import db
+
+# Разовые таймеры закрытия лотов: по одному на активный аукцион, срабатывают ровно в end_time.
+# Модуль не импортирует scheduler/handlers, поэтому его можно вызывать откуда угодно.
+_scheduler: Optional[AsyncIOScheduler] = None
+_bot: Optional[Bot] = None
+_close_func: Optional[Callable[[Bot, int], Awaitable[None]]] = None
+_JOB_PREFIX = "close_auction_"
+
+
+def init(scheduler: AsyncIOScheduler, bot: Bot, close_func: Callable[[Bot, int], Awaitable[None]]):
+    """Подключает планировщик и функцию закрытия лота close_func(bot, auction_id)."""
+    global _scheduler, _bot, _close_func
+    _scheduler, _bot, _close_func = scheduler, bot, close_func
+
+
+def _job_id(auction_id: int) -> str:
+    return f"{_JOB_PREFIX}{auction_id}"
+
+
+def arm(auction_id: int, end_time: datetime):
+    """Ставит (или переставляет) таймер закрытия лота на end_time."""
+    # Планировщик работает только на ведущем процессе (см. leader.py); ведущий при избрании
+    # выставляет таймеры всем активным лотам сам (reconcile). Приостановленный планировщик
+    # (процесс перестал быть ведущим) тоже считается running — таймеры на нем не ставим
+    if _scheduler is None or _scheduler.state != STATE_RUNNING:
+        return
+    run_date = max(end_time, datetime.now(timezone.utc))
+    _scheduler.add_job(
+        _close_func, 'date', run_date=run_date, args=(_bot, auction_id),
+        id=_job_id(auction_id), replace_existing=True,
+        misfire_grace_time=None, coalesce=True
+    )
+
+
+def disarm(auction_id: int):
+    """Снимает таймер лота (лот завершен досрочно)."""
+    if _scheduler is None or _scheduler.state == STATE_STOPPED:
+        return
+    try:
+        _scheduler.remove_job(_job_id(auction_id))
+    except JobLookupError:
+        pass
+
+
+def disarm_all():
+    """Снимает все таймеры (процесс перестал быть ведущим: при новом избрании их выставит reconcile)."""
+    if _scheduler is None or _scheduler.state == STATE_STOPPED:
+        return
+    for job in _scheduler.get_jobs():
+        if job.id.startswith(_JOB_PREFIX):
+            job.remove()
+
+
+async def reconcile():
+    """Ставит таймеры всем активным лотам из БД (при старте и при страховочной проверке)."""
+    auctions = await db.get_active_auctions()
+    for auction in auctions:
+        arm(auction['auction_id'], auction['end_time'])
+    logging.info(f"Таймеры закрытия выставлены для {len(auctions)} активных лотов.")
@@ -0,0 +1,108 @@
+# bid_lanes.py
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+# Воркер лота завершается после стольких секунд без задач (создается заново при следующей ставке)
+LANE_IDLE_TIMEOUT = float(os.getenv("BID_LANE_IDLE_TIMEOUT", "60"))
+# Ожидание в очереди дольше этого порога пишется в лог
+LANE_WAIT_WARN_MS = float(os.getenv("BID_LANE_WAIT_WARN_MS", "1000"))
+
+
+class AuctionLane:
+    """
+    Очередь обработки ставок одного лота: задачи выполняются одним воркером
+    строго в порядке поступления. Разные лоты обрабатываются параллельно.
+    """
+
+    def __init__(self, auction_id: int):
+        self.auction_id = auction_id
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+        self.worker = asyncio.create_task(self._run())
+
+    async def submit(self, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        """Ставит задачу в очередь лота и ждет ее результата."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((time.monotonic(), func, args, future))
+        return await future
+
+    async def _run(self):
+        try:
+            await self._process()
+        finally:
+            # Воркер завершился (простой, отмена при остановке или сбой): лот снимается из _lanes, чтобы
+            # следующая ставка создала новый воркер, а задачи, оставшиеся в очереди, получают ошибку вместо вечного ожидания
+            if _lanes.get(self.auction_id) is self:
+                del _lanes[self.auction_id]
+            while not self.queue.empty():
+                _, _, _, future = self.queue.get_nowait()
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Очередь ставок лота #{self.auction_id} остановлена"))
+
+    async def _process(self):
+        while True:
+            try:
+                enqueued_at, func, args, future = await asyncio.wait_for(self.queue.get(), LANE_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if self.queue.empty():
+                    return
+                continue
+
+            wait = time.monotonic() - enqueued_at
+            self.processed += 1
+            self.total_wait += wait
+            self.last_wait = wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait * 1000 > LANE_WAIT_WARN_MS:
+                logging.warning(
+                    f"Очередь ставок лота #{self.auction_id}: ожидание {wait * 1000:.0f} мс, "
+                    f"в очереди {self.queue.qsize()}"
+                )
+
+            if future.cancelled():  # Отправитель уже не ждет (например, задача отменена)
+                continue
+            try:
+                result = await func(*args)
+            except asyncio.CancelledError:
+                # Отменен сам воркер: текущая задача тоже отменяется, остальные завершит _run
+                future.cancel()
+                raise
+            except BaseException as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+                if not isinstance(e, Exception):
+                    raise
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.queue.qsize(),
+            "processed": self.processed,
+            "avg_wait_ms": (self.total_wait / self.processed * 1000) if self.processed else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "last_wait_ms": self.last_wait * 1000,
+        }
+
+
+_lanes: Dict[int, AuctionLane] = {}
+
+
+async def submit(auction_id: int, func: Callable[..., Awaitable[Any]], *args) -> Any:
+    """Выполняет func(*args) в очереди лота auction_id (по порядку с другими ставками на этот лот)."""
+    lane = _lanes.get(auction_id)
+    if lane is None or lane.worker.done():
+        lane = _lanes[auction_id] = AuctionLane(auction_id)
+    return await lane.submit(func, *args)
+
+
+def lane_stats() -> Dict[int, Dict[str, Any]]:
+    """Глубина очереди и время ожидания по каждому лоту с активным воркером."""
+    return {auction_id: lane.stats() for auction_id, lane in _lanes.items()}
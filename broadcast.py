@@ -0,0 +1,152 @@
+# broadcast.py
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError
+from aiogram.types import InlineKeyboardMarkup
+
+import db
+import leader
+from rate_limiter import Priority, priority
+
+# Сколько сообщений рассылки отправляется одновременно (общие лимиты Telegram соблюдает rate_limiter)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+# Сколько получателей берем из БД за раз; результаты пачки записываются одним запросом
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "50"))
+# Как часто обновлять сообщение с прогрессом у администратора
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+# Рассылки отправляет только ведущий процесс (leader.py); как часто он ищет новые и прерванные задания
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+
+_jobs: Dict[int, asyncio.Task] = {}
+
+
+def _progress_text(job: dict, finished: bool = False) -> str:
+    done = job['sent'] + job['failed']
+    head = "✅" if finished else "⏳"
+    text = f"{head} {job['title']}: {done}/{job['total']}"
+    if job['failed']:
+        text += f", не доставлено: {job['failed']}"
+    return text
+
+
+async def _report(bot: Bot, job: dict, finished: bool = False):
+    if not job.get('report_chat_id') or not job.get('report_message_id'):
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=job['report_chat_id'],
+            message_id=job['report_message_id'],
+            text=_progress_text(job, finished)
+        )
+    except TelegramAPIError as e:
+        if "message is not modified" not in str(e):
+            logging.warning(f"Не удалось обновить прогресс рассылки #{job['job_id']}: {e}")
+
+
+async def _deliver(bot: Bot, job: dict, reply_markup: Optional[InlineKeyboardMarkup], user_id: int) -> tuple:
+    try:
+        await bot.send_message(user_id, job['text'], reply_markup=reply_markup)
+        return user_id, 'sent', None
+    except TelegramForbiddenError as e:  # Пользователь заблокировал бота
+        return user_id, 'failed', str(e)
+    except TelegramAPIError as e:
+        logging.warning(f"Рассылка #{job['job_id']}: не удалось отправить сообщение {user_id}: {e}")
+        return user_id, 'failed', str(e)
+
+
+async def _run_job(bot: Bot, job_id: int):
+    job = await db.get_broadcast_job(job_id)
+    reply_markup = InlineKeyboardMarkup.model_validate_json(job['reply_markup']) if job['reply_markup'] else None
+    await db.set_broadcast_job_status(job_id, 'running')
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_report = time.monotonic()
+
+    async def deliver(user_id: int, results: List[tuple]):
+        async with semaphore:
+            results.append(await _deliver(bot, job, reply_markup, user_id))
+
+    with priority(Priority.LOW):
+        while True:
+            user_ids = await db.get_pending_broadcast_recipients(job_id, BROADCAST_BATCH_SIZE)
+            if not user_ids:
+                break
+            results: List[tuple] = []
+            try:
+                await asyncio.gather(*(deliver(user_id, results) for user_id in user_ids))
+            finally:
+                # Даже при остановке бота сохраняем то, что уже успели отправить
+                await db.record_broadcast_results(job_id, results)
+            job = await db.get_broadcast_job(job_id)
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                await _report(bot, job)
+                last_report = time.monotonic()
+
+        await db.set_broadcast_job_status(job_id, 'done')
+        await _report(bot, job, finished=True)
+    logging.info(f"Рассылка #{job_id} завершена: отправлено {job['sent']}, не доставлено {job['failed']}.")
+
+
+def _launch(bot: Bot, job_id: int):
+    task = asyncio.create_task(_run_job(bot, job_id))
+    _jobs[job_id] = task
+
+    def _done(t: asyncio.Task):
+        _jobs.pop(job_id, None)
+        if not t.cancelled() and t.exception():
+            logging.error(f"Рассылка #{job_id} прервана с ошибкой: {t.exception()}")
+
+    task.add_done_callback(_done)
+
+
+async def start_broadcast(bot: Bot, title: str, text: str, user_ids: List[int],
+                          reply_markup: Optional[InlineKeyboardMarkup] = None,
+                          report_chat_id: Optional[int] = None) -> int:
+    """
+    Создает задание рассылки text получателям user_ids и запускает его в фоне.
+    Если указан report_chat_id, туда отправляется сообщение, в котором обновляется прогресс.
+    На ведомом процессе задание только записывается: его подхватит ведущий (resume_broadcasts).
+    Возвращает job_id.
+    """
+    markup_json = reply_markup.model_dump_json(exclude_none=True) if reply_markup else None
+    job_id = await db.create_broadcast_job(title, text, user_ids, markup_json, report_chat_id)
+    if report_chat_id:
+        job = await db.get_broadcast_job(job_id)
+        try:
+            report = await bot.send_message(report_chat_id, _progress_text(job))
+            await db.set_broadcast_job_status(job_id, 'pending', report_message_id=report.message_id)
+        except TelegramAPIError as e:
+            logging.warning(f"Не удалось отправить прогресс рассылки #{job_id}: {e}")
+    if not leader.is_leader():
+        logging.info(f"Рассылка #{job_id} «{title}» на {len(user_ids)} получателей передана ведущему процессу.")
+        return job_id
+    _launch(bot, job_id)
+    logging.info(f"Запущена рассылка #{job_id} «{title}» на {len(user_ids)} получателей.")
+    return job_id
+
+
+async def resume_broadcasts(bot: Bot):
+    """
+    Запускает незавершенные рассылки: созданные ведомыми процессами и прерванные остановкой бота
+    (при избрании ведущим и раз в BROADCAST_POLL_INTERVAL секунд). Получатели не закреплены за процессом,
+    поэтому рассылки отправляет только ведущий — иначе два процесса писали бы одним и тем же людям.
+    """
+    if not leader.is_leader():
+        return
+    for job in await db.get_unfinished_broadcast_jobs():
+        if job['job_id'] in _jobs:
+            continue  # Уже идет в этом процессе
+        logging.info(f"Возобновляем рассылку #{job['job_id']} «{job['title']}».")
+        _launch(bot, job['job_id'])
+
+
+async def stop_broadcasts():
+    """Останавливает текущие рассылки; они будут продолжены при следующем старте."""
+    tasks = list(_jobs.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,76 @@
+# cache.py
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional
+
+# Маркер "значения нет в кэше" (None — допустимое закэшированное значение)
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Ограниченный по размеру LRU-кэш с временем жизни записей.
+    Считает попадания/промахи. Не потокобезопасен (рассчитан на один event loop).
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # Растет при каждой инвалидации
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """Возвращает значение или default, если записи нет или она устарела."""
+        item = self._data.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, generation: Optional[int] = None):
+        """
+        Сохраняет значение. Если передан generation и с тех пор была инвалидация,
+        значение не сохраняется (оно могло быть прочитано до изменения).
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        """Удаляет запись из кэша."""
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def invalidate_many(self, keys: Iterable[Hashable]):
+        """Удаляет несколько записей из кэша."""
+        self.generation += 1
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Полностью очищает кэш."""
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает размер кэша и счетчики попаданий/промахов."""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,144 @@
+# channel_updater.py
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import InlineKeyboardMarkup
+
+from rate_limiter import Priority, priority
+
+CHANNEL_ID = os.getenv("CHANNEL_ID")
+# Пост одного лота редактируется не чаще, чем раз в столько секунд
+CHANNEL_EDIT_INTERVAL = float(os.getenv("CHANNEL_EDIT_INTERVAL", "3"))
+# Сколько последних завершенных постов помнить, чтобы отбрасывать запоздавшие обновления
+# (они приходят в первые секунды после закрытия лота, старые записи вытесняются)
+CHANNEL_FINALIZED_MAX = int(os.getenv("CHANNEL_FINALIZED_MAX", "1000"))
+
+
+class ChannelPostUpdater:
+    """
+    Обновляет подписи постов лотов в канале.
+    Запросы на обновление одного поста схлопываются: текст рендерится в момент отправки
+    (побеждает последнее состояние), пост редактируется не чаще раза в interval секунд,
+    а неизменившийся текст не отправляется вовсе. Состояние поста удаляется после его завершения,
+    поэтому память не растет с числом проведенных лотов.
+    """
+
+    def __init__(self, interval: float, finalized_max: int = CHANNEL_FINALIZED_MAX):
+        self.interval = interval
+        self.finalized_max = finalized_max
+        self._pending: Dict[int, Callable[[], Awaitable[Optional[str]]]] = {}  # message_id -> render()
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._last_sent_at: Dict[int, float] = {}
+        self._last_hash: Dict[int, str] = {}
+        self._finalized: "OrderedDict[int, None]" = OrderedDict()  # Посты завершенных лотов больше не трогаем
+        self.edits_sent = 0
+        self.edits_skipped = 0
+
+    def request(self, bot: Bot, message_id: Optional[int], render: Callable[[], Awaitable[Optional[str]]]):
+        """
+        Ставит пост message_id в очередь на обновление и сразу возвращает управление.
+        render — корутинная функция без аргументов, возвращающая актуальный текст поста
+        (или None, если пост обновлять уже не нужно).
+        """
+        if not message_id or message_id in self._finalized:
+            return
+        self._pending[message_id] = render
+        if message_id not in self._tasks:
+            self._tasks[message_id] = asyncio.create_task(self._flush_later(bot, message_id))
+
+    async def finalize(self, bot: Bot, message_id: Optional[int], text: str,
+                       reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+        """
+        Немедленно выставляет финальную подпись поста (аукцион завершен).
+        Отложенные обновления этого поста отменяются, новые игнорируются.
+        Возвращает False, если Telegram не принял изменение.
+        """
+        if not message_id:
+            return True
+        await self._stop(message_id)
+        if not await self._send(bot, message_id, text, reply_markup=reply_markup):
+            return False  # Состояние остается до успешного повтора
+        self._last_sent_at.pop(message_id, None)
+        self._last_hash.pop(message_id, None)
+        return True
+
+    async def abandon(self, message_id: Optional[int]):
+        """
+        Лот завершил другой процесс кластера (он же выставит финальную подпись): отложенное обновление
+        поста отменяется, в том числе уже ждущее лимита отправки в канал, новые игнорируются.
+        """
+        if not message_id:
+            return
+        await self._stop(message_id)
+        self._last_sent_at.pop(message_id, None)
+        self._last_hash.pop(message_id, None)
+
+    async def _stop(self, message_id: int):
+        """Помечает пост завершенным и отменяет его отложенное обновление."""
+        self._finalized[message_id] = None
+        if len(self._finalized) > self.finalized_max:
+            self._finalized.popitem(last=False)
+        self._pending.pop(message_id, None)
+        task = self._tasks.pop(message_id, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _flush_later(self, bot: Bot, message_id: int):
+        try:
+            delay = self.interval - (time.monotonic() - self._last_sent_at.get(message_id, 0.0))
+            if delay > 0:
+                await asyncio.sleep(delay)
+            render = self._pending.pop(message_id, None)
+            if render is None:
+                return
+            text = await render()
+            if text is None:
+                return
+            # Задача наследует приоритет того, кто ее создал (например, HIGH из обработки ставки)
+            with priority(Priority.NORMAL):
+                await self._send(bot, message_id, text)
+        except Exception as e:
+            logging.error(f"Ошибка отложенного обновления поста {message_id} в канале: {e}")
+        finally:
+            if self._tasks.get(message_id) is asyncio.current_task():
+                del self._tasks[message_id]
+                # Пока шла отправка, пришел новый запрос — планируем следующее обновление
+                if message_id in self._pending:
+                    self._tasks[message_id] = asyncio.create_task(self._flush_later(bot, message_id))
+
+    async def _send(self, bot: Bot, message_id: int, text: str,
+                    reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+        text_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        if self._last_hash.get(message_id) == text_hash:
+            self.edits_skipped += 1
+            return True
+        try:
+            await bot.edit_message_caption(
+                chat_id=CHANNEL_ID,
+                message_id=message_id,
+                caption=text,
+                parse_mode="HTML",
+                reply_markup=reply_markup
+            )
+            self._last_hash[message_id] = text_hash
+            self.edits_sent += 1
+            return True
+        except TelegramAPIError as e:
+            if "message is not modified" in str(e):
+                self._last_hash[message_id] = text_hash
+                return True
+            logging.error(f"Не удалось обновить пост {message_id} в канале {CHANNEL_ID}: {e}")
+            return False
+        finally:
+            self._last_sent_at[message_id] = time.monotonic()
+
+
+channel_updater = ChannelPostUpdater(interval=CHANNEL_EDIT_INTERVAL)
@@ -0,0 +1,283 @@
+# cluster.py
+import asyncio
+import hmac
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+import aiohttp
+import asyncpg
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+import auction_book
+import auction_timers
+import db
+import fsm_storage
+import leader
+import metrics
+from channel_updater import channel_updater
+from webhook import SECRET_HEADER, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, register_webhook, serve
+
+# Несколько процессов бота (на одной или нескольких машинах):
+#  - маршрутизатор (--mode router) принимает вебхук Telegram и пересылает обновление воркеру,
+#    выбранному по ID пользователя: все обновления пользователя обрабатывает один воркер, по порядку;
+#  - воркеры (--mode webhook без WEBHOOK_BASE_URL, CLUSTER_SYNC=true) обрабатывают обновления.
+#    Общее состояние — в PostgreSQL (FSM, outbox, рассылки), книги лотов и кэши статусов пользователей
+#    и состояний FSM синхронизируются через LISTEN/NOTIFY;
+#  - лоты закрывает только ведущий процесс (leader.py).
+
+# Адреса воркеров через запятую (http://worker-1:8080/webhook,...). Порядок важен: изменение списка
+# перераспределяет пользователей между воркерами
+CLUSTER_WORKER_URLS = [url.strip() for url in os.getenv("CLUSTER_WORKER_URLS", "").split(",") if url.strip()]
+CLUSTER_FORWARD_TIMEOUT = float(os.getenv("CLUSTER_FORWARD_TIMEOUT", "10"))
+# Синхронизация книг лотов и кэшей с другими процессами бота
+CLUSTER_SYNC = os.getenv("CLUSTER_SYNC", "false").lower() == "true"
+# Проверка соединения синхронизации и пауза перед переподключением (сек)
+CLUSTER_SYNC_PING_INTERVAL = float(os.getenv("CLUSTER_SYNC_PING_INTERVAL", "10"))
+CLUSTER_SYNC_RETRY = float(os.getenv("CLUSTER_SYNC_RETRY", "5"))
+
+
+def routing_key(update: Dict[str, Any]) -> int:
+    """ID пользователя (или чата), от которого пришло обновление; 0, если определить нельзя."""
+    for payload in update.values():
+        if not isinstance(payload, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            entity = payload.get(field)
+            if isinstance(entity, dict) and isinstance(entity.get("id"), int):
+                return entity["id"]
+    return 0
+
+
+class UpdateRouter:
+    """
+    Пересылает обновления Telegram воркерам: пользователь всегда попадает на один и тот же воркер.
+    Обновления одного пользователя пересылаются по одному (следующее — после ответа воркера на предыдущее).
+    Если воркер недоступен, Telegram получает 503 и повторит доставку — на другой воркер
+    пользователь не переносится, чтобы не нарушить порядок.
+    """
+
+    def __init__(self, workers: List[str], secret: str):
+        self.workers = workers
+        self.secret = secret
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._locks: Dict[int, list] = {}  # ключ -> [Lock, число ожидающих]
+        self.forwarded = [0] * len(workers)
+        self.failed = [0] * len(workers)
+        self.unauthorized = 0
+
+    def worker_for(self, key: int) -> int:
+        return key % len(self.workers)
+
+    async def open(self, *_: Any):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=CLUSTER_FORWARD_TIMEOUT))
+
+    async def close(self, *_: Any):
+        if self.session is not None:
+            await self.session.close()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), self.secret.encode()):
+            self.unauthorized += 1
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+
+        key = routing_key(update)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                status = await self._forward(self.worker_for(key), body)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+        return web.Response(status=status)
+
+    async def _forward(self, index: int, body: bytes) -> int:
+        try:
+            async with self.session.post(self.workers[index], data=body, headers={
+                SECRET_HEADER: self.secret, "Content-Type": "application/json"
+            }) as response:
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Воркер {self.workers[index]} недоступен: {e}")
+            status = 503
+        if status == 200:
+            self.forwarded[index] += 1
+        else:
+            self.failed[index] += 1
+        return status
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": {
+                url: {"forwarded": self.forwarded[i], "failed": self.failed[i]}
+                for i, url in enumerate(self.workers)
+            },
+            "in_flight": sum(count for _, count in self._locks.values()),
+            "unauthorized": self.unauthorized,
+        }
+
+
+async def run_router(dp: Dispatcher, bot: Bot):
+    """Регистрирует вебхук и пересылает обновления воркерам CLUSTER_WORKER_URLS."""
+    if not WEBHOOK_SECRET or not WEBHOOK_BASE_URL:
+        raise RuntimeError("Для режима router укажите WEBHOOK_SECRET и WEBHOOK_BASE_URL в .env")
+    if not CLUSTER_WORKER_URLS:
+        raise RuntimeError("Для режима router укажите CLUSTER_WORKER_URLS в .env")
+
+    router = UpdateRouter(CLUSTER_WORKER_URLS, WEBHOOK_SECRET)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, router.handle)
+    metrics.register("router", router.stats)
+    metrics.add_route(app)
+    app.on_startup.append(router.open)
+    app.on_cleanup.append(router.close)
+    await register_webhook(dp, bot)
+    logging.info(f"Маршрутизатор: обновления распределяются между {len(CLUSTER_WORKER_URLS)} воркерами")
+    await serve(app)
+
+
+# --- Синхронизация процессов (LISTEN/NOTIFY) ---
+
+_sync_conn: Optional[asyncpg.Connection] = None
+_sync_task: Optional[asyncio.Task] = None
+_rearm_tasks: Set[asyncio.Task] = set()
+_sync = {'connected': False, 'events': 0, 'reconnects': 0}
+
+
+def _apply_bid(event: Dict[str, Any]):
+    """Ставка, записанная любым процессом (в том числе этим — повтор книга пропустит)."""
+    auction_id = event['auction_id']
+    end_time = datetime.fromisoformat(event['end_time'])
+    book = auction_book.peek_book(auction_id)
+    if book is not None and book.auction['end_time'] != end_time:
+        auction_timers.arm(auction_id, end_time)  # Продление антиснайпингом
+    auction_book.apply_bid({
+        'bid_id': event['bid_id'],
+        'auction_id': auction_id,
+        'user_id': event['user_id'],
+        'bid_amount': float(event['bid_amount']),
+        'bid_time': datetime.fromisoformat(event['bid_time']),
+        'username': event['username'],
+        'tg_full_name': event['tg_full_name'],
+    }, end_time=end_time)
+
+
+async def _reload_book(auction_id: int, channel_message_id: Optional[int]):
+    """
+    Перечитывает книгу измененного лота и переставляет (или снимает) его таймер закрытия.
+    Если лот завершен, отложенное обновление его поста в канале отменяется: оно отрисовано
+    по данным идущего лота и перезаписало бы финальную подпись, которую ставит завершивший процесс.
+    """
+    try:
+        book = await auction_book.get_book(auction_id)
+    except Exception as e:
+        logging.error(f"Не удалось перечитать лот #{auction_id}: {e}")
+        return
+    if book is not None:
+        auction_timers.arm(auction_id, book.auction['end_time'])
+    else:
+        auction_timers.disarm(auction_id)
+        await channel_updater.abandon(channel_message_id)
+
+
+def _on_notification(conn: asyncpg.Connection, pid: int, channel: str, payload: str):
+    try:
+        event = json.loads(payload)
+        if event.get('node') == db.NODE_ID:
+            return  # Свое изменение уже применено
+        _sync['events'] += 1
+        if event['type'] == 'bid':
+            _apply_bid(event)
+        elif event['type'] == 'book':
+            book = auction_book.peek_book(event['auction_id'])
+            auction_book.invalidate(event['auction_id'])
+            message_id = book.auction['channel_message_id'] if book is not None else None
+            task = asyncio.create_task(_reload_book(event['auction_id'], message_id))
+            _rearm_tasks.add(task)
+            task.add_done_callback(_rearm_tasks.discard)
+        elif event['type'] == 'fsm':
+            fsm_storage.invalidate(event['key'])
+        elif event['type'] == 'user_status':
+            if event['user_ids'] is None:
+                db.user_status_cache.clear()
+            else:
+                db.user_status_cache.invalidate_many(event['user_ids'])
+    except Exception as e:
+        logging.error(f"Ошибка обработки события кластера {payload[:200]}: {e}")
+
+
+async def _listen() -> asyncpg.Connection:
+    conn = await db.connect("sync")
+    await conn.add_listener(db.CLUSTER_CHANNEL, _on_notification)
+    _sync['connected'] = True
+    return conn
+
+
+async def _sync_loop():
+    global _sync_conn
+    while True:
+        try:
+            while True:
+                await asyncio.sleep(CLUSTER_SYNC_PING_INTERVAL)
+                await _sync_conn.fetchval("SELECT 1", timeout=5)
+        except Exception as e:
+            logging.warning(f"Соединение синхронизации кластера потеряно: {e}")
+        _sync['connected'] = False
+        _sync_conn.terminate()
+        while True:
+            await asyncio.sleep(CLUSTER_SYNC_RETRY)
+            try:
+                _sync_conn = await _listen()
+                break
+            except Exception as e:
+                logging.warning(f"Не удалось переподключить синхронизацию кластера: {e}")
+        _sync['reconnects'] += 1
+        # Пока соединения не было, события других процессов терялись — перечитываем все из БД
+        auction_book.invalidate_all()
+        db.user_status_cache.clear()
+        fsm_storage.invalidate()
+        logging.info("Синхронизация кластера восстановлена, книги лотов будут перечитаны.")
+
+
+async def start_sync():
+    """Подписывается на события других процессов и начинает публиковать свои (db.notify_cluster)."""
+    global _sync_conn, _sync_task
+    if _sync_task is not None:
+        return
+    _sync_conn = await _listen()
+    db.cluster_events = True
+    _sync_task = asyncio.create_task(_sync_loop())
+    logging.info(f"Синхронизация кластера включена (процесс {db.NODE_ID}).")
+
+
+async def stop_sync():
+    global _sync_conn, _sync_task
+    if _sync_task is None:
+        return
+    db.cluster_events = False
+    _sync_task.cancel()
+    await asyncio.gather(_sync_task, return_exceptions=True)
+    _sync_task = None
+    if not _sync_conn.is_closed():
+        await _sync_conn.close()
+    _sync_conn = None
+    _sync['connected'] = False
+
+
+def cluster_stats() -> Dict[str, Any]:
+    """Состояние процесса в кластере: имя, роль и ведущий процесс, синхронизация с другими процессами."""
+    return {
+        'node': db.NODE_ID,
+        'leader': leader.stats(),
+        'sync': {'enabled': CLUSTER_SYNC, **_sync},
+    }
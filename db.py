@@ -1,121 +1,486 @@
+import asyncio
 import asyncpg
+import bisect
+import json
 import logging
 import os
+import socket
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from enum import Enum
 from dotenv import load_dotenv
-from typing import List, Dict, Any, Optional
+from typing import Awaitable, Callable, List, Dict, Any, Optional, Union
+
+import migrations
+import queries
+from cache import TTLCache, MISSING
 
 # Загружаем переменные окружения
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Кэш статусов пользователей (читается на каждое событие в middleware).
+# Явно сбрасывается при любом изменении статуса, поэтому бан действует сразу.
+USER_STATUS_CACHE_TTL = float(os.getenv("USER_STATUS_CACHE_TTL", "300"))
+USER_STATUS_CACHE_SIZE = int(os.getenv("USER_STATUS_CACHE_SIZE", "50000"))
+user_status_cache = TTLCache(maxsize=USER_STATUS_CACHE_SIZE, ttl=USER_STATUS_CACHE_TTL)
+
+# Пул соединений. Под конец лота почти каждый запрос к боту — ставка, и соединений может не хватать:
+# время ожидания соединения видно в pool_stats()
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+# Лимит времени на один запрос (сек) и на ожидание свободного соединения
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "60"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+# Кэш подготовленных запросов на соединение для запросов db.py вне реестра queries.STATEMENTS
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+# Соединение пересоздается после стольких запросов и после стольких секунд простоя
+DB_MAX_QUERIES = int(os.getenv("DB_MAX_QUERIES", "50000"))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))
+DB_APPLICATION_NAME = os.getenv("DB_APPLICATION_NAME", "auction_bot")
+# Параметры сессии соединений пула через запятую, например "jit=off,lock_timeout=5s". Передаются при
+# подключении, поэтому переживают сброс соединения при возврате в пул (SET в init-хуке — нет)
+DB_SERVER_SETTINGS = dict(
+    item.split("=", 1) for item in os.getenv("DB_SERVER_SETTINGS", "").replace(" ", "").split(",") if item
+)
+# Подключение при старте: число попыток и задержка между ними (растет вдвое до максимума)
+DB_CONNECT_ATTEMPTS = int(os.getenv("DB_CONNECT_ATTEMPTS", "10"))
+DB_CONNECT_RETRY_BASE = float(os.getenv("DB_CONNECT_RETRY_BASE", "1"))
+DB_CONNECT_RETRY_MAX = float(os.getenv("DB_CONNECT_RETRY_MAX", "30"))
+# Проверка связи с БД в фоне и порог "долгого" ожидания соединения (мс)
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", "30"))
+DB_SLOW_ACQUIRE_MS = float(os.getenv("DB_SLOW_ACQUIRE_MS", "100"))
+# Границы корзин гистограммы времени ожидания соединения (мс)
+ACQUIRE_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Реплика для чтения (необязательно): выгрузка, история ставок, списки лотов и статистика
+# читаются с нее, чтобы не конкурировать со ставками на основной БД
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+DB_REPLICA_POOL_MAX_SIZE = int(os.getenv("DB_REPLICA_POOL_MAX_SIZE", str(DB_POOL_MAX_SIZE)))
+# Если реплика отстает больше чем на столько секунд или недоступна, чтение идет с основной БД
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "5"))
+
+# Отставание реплики (сек): 0, если это не реплика или она получает WAL и все полученное уже применено.
+# Если приемник WAL не работает (связь с основной БД потеряна), полученное совпадает с примененным,
+# но данные могут быть сколь угодно старыми — тогда отставание считается по времени последней примененной
+# транзакции, а если его нет — NULL (реплика не используется).
+# Без роли pg_read_all_stats status в pg_stat_wal_receiver скрыт (NULL) — достаточно того, что приемник запущен
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status IS NULL OR status = 'streaming')
+             AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp())
+    END
+"""
+
 # Глобальный пул соединений для повышения производительности
 pool = None
+replica_pool = None
+
+# Метрики пула (см. pool_stats)
+_acquire_waiters = 0  # Ждут соединение прямо сейчас
+_acquire_timeouts = 0
+_acquire_histogram = [0] * (len(ACQUIRE_BUCKETS_MS) + 1)  # Последняя корзина — больше максимальной границы
+_slow_acquires = 0
+_health = {'ok': None, 'latency_ms': None, 'failures': 0}
+_health_task: Optional[asyncio.Task] = None
+_replica = {'ok': False, 'lag': None, 'reads': 0, 'fallbacks': 0}
+_replica_task: Optional[asyncio.Task] = None
+
+# Будит диспетчер outbox (outbox.py) сразу после коммита нового события
+outbox_wakeup = asyncio.Event()
+
+# Имя процесса бота в кластере (в логах, application_name служебных соединений, событиях кластера)
+NODE_ID = os.getenv("NODE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+# Канал LISTEN/NOTIFY, через который процессы бота сообщают друг другу об изменениях (см. cluster.py).
+# Ставки публикует функция place_bid, остальное — notify_cluster (только при включенной синхронизации)
+CLUSTER_CHANNEL = "auction_bot_events"
+cluster_events = False
+
+PoolHook = Callable[[asyncpg.Connection], Awaitable[None]]
+# Хуки пулов (основного и реплики), выполняются по порядку: init — на каждом новом соединении,
+# setup — при каждой выдаче соединения из пула. Добавлять до create_pool (init_db)
+pool_init_hooks: List[PoolHook] = [queries.init_connection]
+pool_setup_hooks: List[PoolHook] = [queries.setup_connection]
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    for hook in pool_init_hooks:
+        await hook(conn)
+
+
+async def _setup_connection(conn: asyncpg.Connection):
+    for hook in pool_setup_hooks:
+        await hook(conn)
+
+
+def _pool_options(max_size: int) -> Dict[str, Any]:
+    return dict(
+        min_size=min(DB_POOL_MIN_SIZE, max_size),
+        max_size=max_size,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_queries=DB_MAX_QUERIES,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        server_settings={**DB_SERVER_SETTINGS, 'application_name': DB_APPLICATION_NAME},
+        init=_init_connection,
+        setup=_setup_connection,
+    )
+
+
+async def _with_retry(connect: Callable[[], Awaitable[Any]], what: str) -> Any:
+    """
+    Подключается к БД через connect(). Если БД недоступна (например, еще поднимается вместе с ботом),
+    повторяет попытки с растущей задержкой; после DB_CONNECT_ATTEMPTS неудач пробрасывает ошибку.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return await connect()
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            if attempt >= DB_CONNECT_ATTEMPTS:
+                logging.critical(f"Не удалось создать {what} PostgreSQL за {attempt} попыток: {e}")
+                raise
+            delay = min(DB_CONNECT_RETRY_BASE * 2 ** (attempt - 1), DB_CONNECT_RETRY_MAX)
+            logging.warning(f"PostgreSQL недоступен ({e}), повтор через {delay:g} с (попытка {attempt})")
+            await asyncio.sleep(delay)
 
 
 async def create_pool():
-    """Инициализирует пул соединений с базой данных."""
+    """
+    Инициализирует пул соединений с базой данных (с повторами, см. _with_retry).
+    Схема должна быть уже создана: init-хук пула готовит запросы реестра, и ошибка в них
+    (RuntimeError) останавливает старт сразу, без повторов.
+    """
     global pool
     if pool is None:
+        pool = await _with_retry(lambda: asyncpg.create_pool(DATABASE_URL, **_pool_options(DB_POOL_MAX_SIZE)),
+                                 "пул соединений")
+        logging.info(f"Пул соединений с PostgreSQL успешно создан ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE}).")
+
+
+async def create_replica_pool():
+    """Создает пул реплики (если задан DATABASE_REPLICA_URL). Недоступная реплика не мешает старту."""
+    global replica_pool
+    if not DATABASE_REPLICA_URL or replica_pool is not None:
+        return
+    try:
+        replica_pool = await asyncpg.create_pool(DATABASE_REPLICA_URL, **_pool_options(DB_REPLICA_POOL_MAX_SIZE))
+        logging.info("Пул соединений с репликой PostgreSQL создан.")
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError, RuntimeError) as e:
+        # RuntimeError — запрос реестра не готовится: реплика еще не получила новую миграцию
+        logging.warning(f"Реплика PostgreSQL недоступна, чтение идет с основной БД: {e}")
+
+
+async def check_replica() -> bool:
+    """Проверяет доступность и отставание реплики; от результата зависит, читаем ли с нее."""
+    if not DATABASE_REPLICA_URL:
+        return False
+    await create_replica_pool()
+    lag = None
+    reason = "недоступна"
+    if replica_pool is not None:
         try:
-            pool = await asyncpg.create_pool(DATABASE_URL)
-            logging.info("Пул соединений с PostgreSQL успешно создан.")
+            async with replica_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+                value = await conn.fetchval(REPLICA_LAG_SQL, timeout=5)
+            if value is None:
+                reason = "нет связи с основной БД, отставание неизвестно"
+            else:
+                lag = float(value)
         except Exception as e:
-            logging.critical(f"Не удалось создать пул соединений с PostgreSQL: {e}")
-            # В реальном приложении здесь можно остановить работу бота
-            exit()
+            logging.debug(f"Проверка реплики не прошла: {e}")
+    ok = lag is not None and lag <= DB_REPLICA_MAX_LAG
+    if ok != _replica['ok']:
+        if ok:
+            logging.info(f"Чтение переключено на реплику (отставание {lag:.1f} с).")
+        else:
+            if lag is not None:
+                reason = f"отставание {lag:.1f} с"
+            logging.warning(f"Реплика: {reason}, чтение переключено на основную БД.")
+    _replica['ok'] = ok
+    _replica['lag'] = round(lag, 3) if lag is not None else None
+    return ok
+
+
+async def _acquire_replica_connection() -> Optional[asyncpg.Connection]:
+    """Соединение с репликой или None, если читать с нее сейчас нельзя."""
+    if not _replica['ok']:
+        return None
+    try:
+        conn = await replica_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except Exception as e:
+        _replica['ok'] = False
+        _replica['fallbacks'] += 1
+        logging.warning(f"Не удалось взять соединение с репликой, чтение с основной БД: {e}")
+        return None
+    _replica['reads'] += 1
+    return conn
+
+
+async def _acquire_connection() -> asyncpg.Connection:
+    """Берет соединение из пула, учитывая время ожидания в метриках (см. pool_stats)."""
+    global _acquire_waiters, _acquire_timeouts, _slow_acquires
+    started = time.perf_counter()
+    _acquire_waiters += 1
+    try:
+        conn = await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        _acquire_timeouts += 1
+        logging.error(f"Нет свободного соединения с БД за {DB_ACQUIRE_TIMEOUT:g} с: {pool_stats()}")
+        raise
+    finally:
+        _acquire_waiters -= 1
+    waited_ms = (time.perf_counter() - started) * 1000
+    _acquire_histogram[bisect.bisect_left(ACQUIRE_BUCKETS_MS, waited_ms)] += 1
+    if waited_ms >= DB_SLOW_ACQUIRE_MS:
+        _slow_acquires += 1
+    return conn
+
+
+@asynccontextmanager
+async def acquire():
+    """Соединение из пула на время блока with."""
+    conn = await _acquire_connection()
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+def pool_stats() -> Dict[str, Any]:
+    """Состояние пула: занятые и свободные соединения, ожидающие, гистограмма ожидания, здоровье."""
+    histogram = {f"<={bound}ms": count for bound, count in zip(ACQUIRE_BUCKETS_MS, _acquire_histogram)}
+    histogram[f">{ACQUIRE_BUCKETS_MS[-1]}ms"] = _acquire_histogram[-1]
+    size = pool.get_size() if pool else 0
+    idle = pool.get_idle_size() if pool else 0
+    return {
+        'size': size,
+        'max_size': DB_POOL_MAX_SIZE,
+        'in_use': size - idle,
+        'idle': idle,
+        'waiters': _acquire_waiters,
+        'slow_acquires': _slow_acquires,
+        'acquire_timeouts': _acquire_timeouts,
+        'acquire_histogram': histogram,
+        'healthy': _health['ok'],
+        'health_latency_ms': _health['latency_ms'],
+        'health_failures': _health['failures'],
+        'replica': {
+            'enabled': bool(DATABASE_REPLICA_URL),
+            'in_use': replica_pool.get_size() - replica_pool.get_idle_size() if replica_pool else 0,
+            **_replica,
+        },
+    }
+
+
+async def check_pool_health() -> bool:
+    """Проверяет связь с БД простым запросом; при ошибке пересоздает соединения пула."""
+    started = time.perf_counter()
+    try:
+        async with acquire() as conn:
+            await conn.fetchval("SELECT 1", timeout=5)
+    except Exception as e:
+        _health['ok'] = False
+        _health['failures'] += 1
+        logging.error(f"Проверка соединения с БД не прошла: {e}")
+        # Соединения, открытые до сбоя, будут заменены новыми при следующем использовании
+        pool.expire_connections()
+        return False
+    _health['ok'] = True
+    _health['latency_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return True
+
+
+async def _health_loop():
+    slow_seen = _slow_acquires
+    while True:
+        await asyncio.sleep(DB_HEALTHCHECK_INTERVAL)
+        await check_pool_health()
+        if _slow_acquires > slow_seen:
+            logging.warning(f"Нехватка соединений с БД: {_slow_acquires - slow_seen} ожиданий "
+                            f"дольше {DB_SLOW_ACQUIRE_MS:.0f} мс. {pool_stats()}")
+            slow_seen = _slow_acquires
+
+
+async def _replica_loop():
+    while True:
+        await asyncio.sleep(DB_REPLICA_CHECK_INTERVAL)
+        await check_replica()
+
+
+def start_pool_monitor():
+    """Запускает фоновую проверку связи с БД, контроль нехватки соединений и отставания реплики."""
+    global _health_task, _replica_task
+    if _health_task is None or _health_task.done():
+        _health_task = asyncio.create_task(_health_loop())
+    if DATABASE_REPLICA_URL and (_replica_task is None or _replica_task.done()):
+        _replica_task = asyncio.create_task(_replica_loop())
+
+
+async def stop_pool_monitor():
+    global _health_task, _replica_task
+    tasks = [task for task in (_health_task, _replica_task) if task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _health_task = _replica_task = None
+
+
+# --- Единица работы (одно соединение на обработку события) ---
+
+class Session:
+    """
+    Единица работы с БД: все вызовы db.* с conn=session идут через одно соединение.
+    Соединение берется из пула при первом запросе и возвращается при выходе из async with
+    (или раньше — release(), например перед долгими запросами к Telegram).
+    Чтение, помеченное для реплики, идет с реплики, пока сессия не обращалась к основной БД;
+    после этого — с основной, чтобы сессия видела свои же изменения.
+    """
+
+    def __init__(self):
+        self._conn: Optional[asyncpg.Connection] = None
+        self._replica_conn: Optional[asyncpg.Connection] = None
+        self._after_commit: Optional[List[Callable[[], None]]] = None  # Пока идет transaction()
+
+    async def connection(self, read_only: bool = False) -> asyncpg.Connection:
+        if read_only and self._conn is None:
+            if self._replica_conn is None:
+                self._replica_conn = await _acquire_replica_connection()
+            if self._replica_conn is not None:
+                return self._replica_conn
+        if self._conn is None:
+            self._conn = await _acquire_connection()
+        return self._conn
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Транзакция на соединении сессии: вызовы db.* внутри блока коммитятся вместе."""
+        conn = await self.connection()
+        outermost = self._after_commit is None
+        if outermost:
+            self._after_commit = []
+        try:
+            async with conn.transaction():
+                yield conn
+        finally:
+            if outermost:
+                # Инвалидация кэшей (см. _after_commit): после отката тоже безвредна
+                callbacks, self._after_commit = self._after_commit, None
+                for callback in callbacks:
+                    callback()
+        # События outbox, записанные внутри транзакции, видны диспетчеру только после коммита
+        outbox_wakeup.set()
+
+    async def release(self):
+        """Возвращает соединения в пул; следующий запрос возьмет новое."""
+        if self._replica_conn is not None:
+            conn, self._replica_conn = self._replica_conn, None
+            await replica_pool.release(conn)
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await pool.release(conn)
+
+    async def __aenter__(self) -> "Session":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+
+def session() -> Session:
+    """async with db.session() as s: ... — одно соединение на несколько вызовов db.* (conn=s)."""
+    return Session()
+
+
+# Соединение, которое можно передать в функции db.*: обычное соединение asyncpg или сессия
+DbConn = Union[asyncpg.Connection, Session]
+
+
+def _after_commit(conn: Optional[DbConn], callback: Callable[[], None]):
+    """
+    Выполняет callback (инвалидацию кэша) после коммита транзакции сессии conn, а если она не идет — сразу.
+    Иначе параллельный запрос успел бы снова закэшировать значение, которое еще не закоммичено.
+    """
+    if isinstance(conn, Session) and conn._after_commit is not None:
+        conn._after_commit.append(callback)
+    else:
+        callback()
+
+
+@asynccontextmanager
+async def _connection(conn: Optional[DbConn] = None, read_only: bool = False):
+    """
+    Переданное соединение (или соединение сессии), а если его нет — соединение из пула на время блока.
+    read_only=True — запрос только читает и терпит небольшое отставание: его можно выполнить на реплике.
+    """
+    if isinstance(conn, Session):
+        yield await conn.connection(read_only)
+    elif conn is not None:
+        yield conn
+    else:
+        replica_conn = await _acquire_replica_connection() if read_only else None
+        if replica_conn is None:
+            async with acquire() as pooled:
+                yield pooled
+        else:
+            try:
+                yield replica_conn
+            finally:
+                await replica_pool.release(replica_conn)
+
+
+async def connect(purpose: str, **server_settings: str) -> asyncpg.Connection:
+    """
+    Отдельное соединение вне пула (LISTEN, advisory lock ведущего): пул при возврате соединения
+    сбрасывает его состояние (UNLISTEN, pg_advisory_unlock_all).
+    server_settings — дополнительные параметры сессии.
+    """
+    return await asyncpg.connect(
+        DATABASE_URL,
+        timeout=DB_ACQUIRE_TIMEOUT,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        server_settings={'application_name': f"{DB_APPLICATION_NAME}:{purpose}:{NODE_ID}", **server_settings},
+    )
+
+
+async def notify_cluster(event: Dict[str, Any], conn: Optional[DbConn] = None):
+    """
+    Сообщает другим процессам кластера об изменении (event — JSON-объект с полем 'type').
+    Внутри транзакции уведомление доставляется только после коммита.
+    """
+    if not cluster_events:
+        return
+    async with _connection(conn) as conn:
+        await conn.execute("SELECT pg_notify($1, $2)", CLUSTER_CHANNEL, json.dumps({**event, 'node': NODE_ID}))
 
 
 async def init_db():
     """
-    Создает таблицы в базе данных, если они еще не существуют.
+    Применяет миграции схемы и функций БД и создает пул соединений.
     Выполняется один раз при старте бота.
     """
-    await create_pool()  # Убедимся, что пул создан
-    async with pool.acquire() as conn:
-        await conn.execute('''
-                           CREATE TABLE IF NOT EXISTS users
-                           (
-                               user_id           BIGINT PRIMARY KEY,
-                               username          TEXT,
-                               full_name         TEXT,
-                               tg_full_name      TEXT, -- Имя из Telegram профиля
-                               phone_number      TEXT,
-                               status            TEXT        DEFAULT 'pending', -- pending, approved, banned
-                               registration_date TIMESTAMPTZ DEFAULT NOW()
-                           );
-                           ''')
-        await conn.execute('''
-                           CREATE TABLE IF NOT EXISTS auctions
-                           (
-                               auction_id         SERIAL PRIMARY KEY,
-                               title              TEXT,
-                               description        TEXT,
-                               photo_id           TEXT,
-                               start_price        REAL,
-                               min_step           REAL DEFAULT 1000,
-                               max_step           REAL DEFAULT 10000,
-                               blitz_price        REAL,
-                               end_time           TIMESTAMPTZ,
-                               status             TEXT DEFAULT 'active', -- active, finished, canceled
-                               winner_id          BIGINT,
-                               final_price        REAL,
-                               channel_message_id BIGINT,
-                               cooldown_minutes INTEGER DEFAULT 10,
-                               cooldown_off_before_end_minutes INTEGER DEFAULT 30
-                           );
-                           ''')
-        # На случай, если таблица уже существовала раньше — добавим новые столбцы
-        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS tg_full_name TEXT")
-        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS menu_message_id BIGINT")
-        await conn.execute("ALTER TABLE auctions ADD COLUMN IF NOT EXISTS cooldown_minutes INTEGER DEFAULT 10")
-        await conn.execute("ALTER TABLE auctions ADD COLUMN IF NOT EXISTS cooldown_off_before_end_minutes INTEGER DEFAULT 30")
-        await conn.execute("ALTER TABLE auctions ADD COLUMN IF NOT EXISTS media_type TEXT DEFAULT 'photo'")
-
-        await conn.execute('''
-                           CREATE TABLE IF NOT EXISTS bids
-                           (
-                               bid_id     SERIAL PRIMARY KEY,
-                               auction_id INTEGER REFERENCES auctions (auction_id) ON DELETE CASCADE,
-                               user_id    BIGINT REFERENCES users (user_id) ON DELETE CASCADE,
-                               bid_amount REAL,
-                               bid_time   TIMESTAMPTZ DEFAULT NOW()
-                           );
-                           ''')
-
-        await conn.execute('''
-                           CREATE TABLE IF NOT EXISTS auction_participants
-                           (
-                               participant_id   SERIAL PRIMARY KEY,
-                               user_id          BIGINT REFERENCES users (user_id) ON DELETE CASCADE,
-                               auction_id       INTEGER REFERENCES auctions (auction_id) ON DELETE CASCADE,
-                               status           TEXT DEFAULT 'pending', -- pending, approved, rejected
-                               rejection_reason TEXT,
-                               UNIQUE (user_id, auction_id)             -- Пользователь может подать заявку на 1 лот только один раз
-                           );
-                           ''')
-
-        # --- НОВАЯ ТАБЛИЦА SETTINGS ---
-        await conn.execute('''
-                           CREATE TABLE IF NOT EXISTS settings
-                           (
-                               setting_key   TEXT PRIMARY KEY,
-                               setting_value TEXT
-                           );
-                           ''')
-        # Устанавливаем значение по умолчанию для автопринятия (если еще не установлено)
-        await conn.execute('''
-                           INSERT INTO settings (setting_key, setting_value)
-                           VALUES ('auto_approve_enabled', 'false')
-                           ON CONFLICT (setting_key) DO NOTHING;
-                           ''')
-        # --- КОНЕЦ НОВОЙ ТАБЛИЦЫ ---
-
-        logging.info("Проверка таблиц в БД завершена.")
+    # Схема: версионные миграции (см. migrations.py) — на отдельном соединении до создания пула:
+    # init-хук пула готовит запросы реестра, которым нужны таблицы и функции
+    conn = await _with_retry(lambda: connect("migrations"), "соединение")
+    try:
+        await migrations.run_migrations(conn)
+    finally:
+        await conn.close()
+    logging.info("Проверка таблиц в БД завершена.")
+    await create_pool()
+    # Реплика (если задана) получит схему через репликацию
+    await check_replica()
 
 
 # --- Функции для работы с пользователями (Users) ---
 
-async def add_user_request(user_id: int, username: str, full_name: str, phone_number: str, tg_full_name: str):
+async def add_user_request(user_id: int, username: str, full_name: str, phone_number: str, tg_full_name: str,
+                           conn: Optional[DbConn] = None):
     """
     Добавляет заявку на регистрацию пользователя в статусе 'pending'.
     Сохраняет ОБА имени.
@@ -130,30 +495,38 @@ async def add_user_request(user_id: int, username: str, full_name: str, phone_nu
               status       = 'pending',
               username     = EXCLUDED.username;
           """
-    async with pool.acquire() as conn:
-        await conn.execute(sql, user_id, username, full_name, tg_full_name, phone_number)
+    async with _connection(conn) as db_conn:
+        await db_conn.execute(sql, user_id, username, full_name, tg_full_name, phone_number)
+        await notify_cluster({'type': 'user_status', 'user_ids': [user_id]}, db_conn)
+    _after_commit(conn, lambda: user_status_cache.invalidate(user_id))
 
 
-async def get_user_status(user_id: int) -> Optional[str]:
-    """Получает статус пользователя по его ID."""
-    async with pool.acquire() as conn:
-        status = await conn.fetchval("SELECT status FROM users WHERE user_id = $1", user_id)
+async def get_user_status(user_id: int, conn: Optional[DbConn] = None) -> Optional[str]:
+    """Получает статус пользователя по его ID (через кэш user_status_cache)."""
+    status = user_status_cache.get(user_id)
+    if status is not MISSING:
         return status
 
+    generation = user_status_cache.generation
+    async with _connection(conn) as conn:
+        status = await queries.fetchval(conn, "user_status", user_id)
+    user_status_cache.set(user_id, status, generation=generation)
+    return status
+
 
-async def get_user_details(user_id: int) -> Optional[Dict[str, Any]]:
+async def get_user_details(user_id: int, conn: Optional[DbConn] = None) -> Optional[Dict[str, Any]]:
     """Получает полные данные пользователя (ФИО, телефон) по ID."""
     sql = "SELECT user_id, username, full_name, tg_full_name, phone_number, status FROM users WHERE user_id = $1"
     if not pool:
         logging.warning("get_user_details: Пул не инициализирован.")
         return None
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         row = await conn.fetchrow(sql, user_id)
         return dict(row) if row else None
 
 
 
-async def update_user_menu_message_id(user_id: int, message_id: Optional[int]):
+async def update_user_menu_message_id(user_id: int, message_id: Optional[int], conn: Optional[DbConn] = None):
     """
     Обновляет ID 'главного' меню пользователя.
     Устанавливает None, если меню было удалено или заменено.
@@ -161,28 +534,44 @@ async def update_user_menu_message_id(user_id: int, message_id: Optional[int]):
     if not pool:
         logging.warning("update_user_menu_message_id: Пул не инициализирован.")
         return
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         await conn.execute("UPDATE users SET menu_message_id = $1 WHERE user_id = $2", message_id, user_id)
 
 
-async def get_user_menu_message_id(user_id: int) -> Optional[int]:
+async def get_user_menu_message_id(user_id: int, conn: Optional[DbConn] = None) -> Optional[int]:
     """Получает ID 'главного' меню пользователя."""
     if not pool:
         logging.warning("get_user_menu_message_id: Пул не инициализирован.")
         return None
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         return await conn.fetchval("SELECT menu_message_id FROM users WHERE user_id = $1", user_id)
 
-async def update_user_status(user_id: int, status: str):
-    """Обновляет статус пользователя (approved, banned)."""
-    async with pool.acquire() as conn:
-        await conn.execute("UPDATE users SET status = $1 WHERE user_id = $2", status, user_id)
+# Событие outbox, которым пользователь уведомляется о новом статусе
+USER_STATUS_EVENTS = {'approved': 'user_approved', 'banned': 'user_rejected'}
+
+
+async def update_user_status(user_id: int, status: str, notify: bool = False, reason: Optional[str] = None,
+                             conn: Optional[DbConn] = None):
+    """
+    Обновляет статус пользователя (approved, banned).
+    notify=True — в той же транзакции ставит уведомление пользователю в outbox (reason — причина отклонения).
+    """
+    async with _connection(conn) as db_conn:
+        async with db_conn.transaction():
+            await db_conn.execute("UPDATE users SET status = $1 WHERE user_id = $2", status, user_id)
+            if notify and status in USER_STATUS_EVENTS:
+                await _enqueue_event(db_conn, USER_STATUS_EVENTS[status], {'user_id': user_id, 'reason': reason})
+            await notify_cluster({'type': 'user_status', 'user_ids': [user_id]}, db_conn)
         logging.info(f"Статус пользователя {user_id} обновлен на {status}.")
+    _after_commit(conn, lambda: user_status_cache.invalidate(user_id))
+    if notify:
+        outbox_wakeup.set()
 
 
 # db.py
 
-async def update_user_tg_details(user_id: int, username: Optional[str], tg_full_name: str):
+async def update_user_tg_details(user_id: int, username: Optional[str], tg_full_name: str,
+                                 conn: Optional[DbConn] = None):
     """
     Обновляет username и tg_full_name пользователя при каждом взаимодействии.
     НЕ СОЗДАЕТ нового пользователя, если его нет.
@@ -195,40 +584,140 @@ async def update_user_tg_details(user_id: int, username: Optional[str], tg_full_
           AND (users.username IS DISTINCT FROM $2
            OR users.tg_full_name IS DISTINCT FROM $3);
     """
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         await conn.execute(sql, user_id, username, tg_full_name)
 
 
+# --- Отложенная запись (write-behind) username / tg_full_name ---
+# Middleware вызывает queue_user_tg_details на каждое событие. Одинаковые значения
+# отбрасываются сразу, изменившиеся копятся и уходят в БД одним UPDATE
+# раз в TG_DETAILS_FLUSH_INTERVAL_MS или при накоплении TG_DETAILS_FLUSH_BATCH_SIZE записей.
+TG_DETAILS_FLUSH_INTERVAL_MS = int(os.getenv("TG_DETAILS_FLUSH_INTERVAL_MS", "1000"))
+TG_DETAILS_FLUSH_BATCH_SIZE = int(os.getenv("TG_DETAILS_FLUSH_BATCH_SIZE", "500"))
+TG_DETAILS_SEEN_LIMIT = int(os.getenv("TG_DETAILS_SEEN_LIMIT", "100000"))
+
+_tg_details_seen: "OrderedDict[int, tuple]" = OrderedDict()  # Последние увиденные значения (LRU)
+_tg_details_pending: Dict[int, tuple] = {}  # Ожидают записи в БД
+_tg_details_flush_event = asyncio.Event()
+_tg_details_flusher: Optional[asyncio.Task] = None
+
+
+def queue_user_tg_details(user_id: int, username: Optional[str], tg_full_name: str):
+    """
+    Ставит username и tg_full_name в очередь на запись, если они изменились
+    с прошлого взаимодействия. Не ждет БД.
+    """
+    details = (username, tg_full_name)
+    if _tg_details_seen.get(user_id) == details:
+        _tg_details_seen.move_to_end(user_id)
+        return
+
+    _tg_details_seen[user_id] = details
+    _tg_details_seen.move_to_end(user_id)
+    if len(_tg_details_seen) > TG_DETAILS_SEEN_LIMIT:
+        _tg_details_seen.popitem(last=False)
+
+    _tg_details_pending[user_id] = details
+    if len(_tg_details_pending) >= TG_DETAILS_FLUSH_BATCH_SIZE:
+        _tg_details_flush_event.set()
+
+
+async def flush_user_tg_details():
+    """Записывает накопленные username/tg_full_name одним UPDATE ... FROM unnest(...)."""
+    if not _tg_details_pending or not pool:
+        return
+
+    batch = dict(_tg_details_pending)
+    _tg_details_pending.clear()
+
+    sql = """
+        UPDATE users SET
+            username     = v.username,
+            tg_full_name = v.tg_full_name
+        FROM unnest($1::bigint[], $2::text[], $3::text[]) AS v(user_id, username, tg_full_name)
+        WHERE users.user_id = v.user_id
+          AND (users.username IS DISTINCT FROM v.username
+           OR users.tg_full_name IS DISTINCT FROM v.tg_full_name);
+    """
+    try:
+        async with acquire() as conn:
+            await conn.execute(
+                sql,
+                list(batch.keys()),
+                [details[0] for details in batch.values()],
+                [details[1] for details in batch.values()]
+            )
+    except Exception as e:
+        logging.error(f"Не удалось записать данные {len(batch)} пользователей из буфера: {e}")
+        # Возвращаем в очередь то, что не успели перезаписать более свежими значениями
+        for user_id, details in batch.items():
+            _tg_details_pending.setdefault(user_id, details)
+
+
+async def _tg_details_flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_tg_details_flush_event.wait(), timeout=TG_DETAILS_FLUSH_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _tg_details_flush_event.clear()
+        await flush_user_tg_details()
+
+
+def start_tg_details_flusher():
+    """Запускает фоновую запись буфера username/tg_full_name."""
+    global _tg_details_flusher
+    if _tg_details_flusher is None or _tg_details_flusher.done():
+        _tg_details_flusher = asyncio.create_task(_tg_details_flush_loop())
 
-async def get_pending_users() -> List[Dict[str, Any]]:
+
+async def stop_tg_details_flusher():
+    """Останавливает фоновую запись и сбрасывает остаток буфера в БД."""
+    global _tg_details_flusher
+    if _tg_details_flusher is not None:
+        _tg_details_flusher.cancel()
+        try:
+            await _tg_details_flusher
+        except asyncio.CancelledError:
+            pass
+        _tg_details_flusher = None
+    await flush_user_tg_details()
+
+
+
+async def get_pending_users(conn: Optional[DbConn] = None) -> List[Dict[str, Any]]:
     """Возвращает список пользователей в статусе 'pending'."""
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         rows = await conn.fetch("SELECT user_id, username, full_name, phone_number FROM users WHERE status = 'pending'")
         return [dict(r) for r in rows]
 
-async def bulk_update_user_status(user_ids: List[int], status: str):
+async def bulk_update_user_status(user_ids: List[int], status: str, conn: Optional[DbConn] = None):
     """Массово обновляет статус пользователей."""
     if not user_ids:
         return 0
     # Преобразуем список ID в строку для запроса (1, 2, 3)
     ids_tuple = tuple(user_ids)
     sql = f"UPDATE users SET status = $1 WHERE user_id = ANY($2::bigint[])"
-    async with pool.acquire() as conn:
-        result = await conn.execute(sql, status, ids_tuple)
-        # result возвращает строку вида "UPDATE N", извлекаем N
-        try:
-            updated_count = int(result.split()[-1])
-            logging.info(f"Массово обновлен статус {updated_count} пользователей на '{status}'.")
-            return updated_count
-        except (IndexError, ValueError):
-            logging.warning(f"Не удалось получить количество обновленных строк при bulk_update_user_status.")
-            return 0
+    async with _connection(conn) as db_conn:
+        result = await db_conn.execute(sql, status, ids_tuple)
+        # Длинный список не поместится в уведомление (до 8000 байт) — тогда процессы сбрасывают кэш целиком
+        await notify_cluster({'type': 'user_status', 'user_ids': list(user_ids) if len(user_ids) <= 500 else None},
+                             db_conn)
+    _after_commit(conn, lambda: user_status_cache.invalidate_many(user_ids))
+    # result возвращает строку вида "UPDATE N", извлекаем N
+    try:
+        updated_count = int(result.split()[-1])
+        logging.info(f"Массово обновлен статус {updated_count} пользователей на '{status}'.")
+        return updated_count
+    except (IndexError, ValueError):
+        logging.warning(f"Не удалось получить количество обновленных строк при bulk_update_user_status.")
+        return 0
 
 
 
 # --- Функции для работы с аукционами (Auctions) ---
 
-async def create_auction(data: Dict[str, Any]) -> int:
+async def create_auction(data: Dict[str, Any], conn: Optional[DbConn] = None) -> int:
     """Создает новый аукцион и возвращает его ID."""
     sql = """
           INSERT INTO auctions
@@ -236,7 +725,7 @@ async def create_auction(data: Dict[str, Any]) -> int:
           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
           RETURNING auction_id; \
           """
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         auction_id = await conn.fetchval(
             sql,
             data['title'],
@@ -252,22 +741,22 @@ async def create_auction(data: Dict[str, Any]) -> int:
         )
         return auction_id
 
-async def get_auctions(limit: int = 10) -> List[Dict[str, Any]]:
+async def get_auctions(limit: int = 10, conn: Optional[DbConn] = None) -> List[Dict[str, Any]]:
     """Возвращает последние аукционы (активные и завершенные)."""
-    async with pool.acquire() as conn:
+    async with _connection(conn, read_only=True) as conn:
         rows = await conn.fetch("SELECT * FROM auctions ORDER BY auction_id DESC LIMIT $1", limit)
         return [dict(r) for r in rows]
 
-async def count_auctions() -> int:
+async def count_auctions(conn: Optional[DbConn] = None) -> int:
     """Возвращает общее количество аукционов."""
-    async with pool.acquire() as conn:
+    async with _connection(conn, read_only=True) as conn:
         row = await conn.fetchval("SELECT COUNT(*) FROM auctions")
         return int(row)
 
 
-async def get_auctions_page(limit: int, offset: int) -> List[Dict[str, Any]]:
+async def get_auctions_page(limit: int, offset: int, conn: Optional[DbConn] = None) -> List[Dict[str, Any]]:
     """Возвращает страницу аукционов."""
-    async with pool.acquire() as conn:
+    async with _connection(conn, read_only=True) as conn:
         rows = await conn.fetch(
             "SELECT * FROM auctions ORDER BY auction_id DESC LIMIT $1 OFFSET $2",
             limit, offset
@@ -276,101 +765,223 @@ async def get_auctions_page(limit: int, offset: int) -> List[Dict[str, Any]]:
 
 
 
-async def update_auction_end_time(auction_id: int, new_end_time):
+async def update_auction_end_time(auction_id: int, new_end_time, conn: Optional[DbConn] = None):
     """Обновляет время окончания аукциона."""
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         await conn.execute("UPDATE auctions SET end_time = $1 WHERE auction_id = $2", new_end_time, auction_id)
 
 
-async def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
+async def get_user_by_username(username: str, conn: Optional[DbConn] = None) -> Optional[Dict[str, Any]]:
     """Возвращает пользователя по username (без @)."""
     if username.startswith('@'):
         username = username[1:]
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM users WHERE username = $1", username)
+    async with _connection(conn) as conn:
+        row = await queries.fetchrow(conn, "user_by_username", username)
         return dict(row) if row else None
 
 
-async def get_user_by_phone(phone: str) -> Optional[Dict[str, Any]]:
+async def get_user_by_phone(phone: str, conn: Optional[DbConn] = None) -> Optional[Dict[str, Any]]:
     """Возвращает пользователя по номеру телефона."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM users WHERE phone_number = $1", phone)
+    async with _connection(conn) as conn:
+        row = await queries.fetchrow(conn, "user_by_phone", phone)
         return dict(row) if row else None
 
 
 
 
-async def get_active_auction() -> Optional[Dict[str, Any]]:
+async def get_active_auction(conn: Optional[DbConn] = None) -> Optional[Dict[str, Any]]:
     """Возвращает данные текущего активного аукциона."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM auctions WHERE status = 'active' ORDER BY auction_id DESC LIMIT 1")
+    async with _connection(conn) as conn:
+        row = await queries.fetchrow(conn, "active_auction")
         return dict(row) if row else None
 
 
-async def set_auction_message_id(auction_id: int, message_id: int):
+async def get_active_auctions(conn: Optional[DbConn] = None) -> List[Dict[str, Any]]:
+    """Возвращает все активные аукционы."""
+    async with _connection(conn) as conn:
+        rows = await conn.fetch("SELECT * FROM auctions WHERE status = 'active' ORDER BY auction_id")
+        return [dict(r) for r in rows]
+
+
+async def set_auction_message_id(auction_id: int, message_id: int, conn: Optional[DbConn] = None):
     """Сохраняет ID сообщения аукциона в канале."""
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         await conn.execute("UPDATE auctions SET channel_message_id = $1 WHERE auction_id = $2", message_id, auction_id)
 
 
-async def finish_auction(auction_id: int, winner_id: Optional[int], final_price: Optional[float]):
-    """Завершает аукцион, обновляя его статус и данные о победителе."""
-    sql = "UPDATE auctions SET status = 'finished', winner_id = $1, final_price = $2 WHERE auction_id = $3"
-    async with pool.acquire() as conn:
-        await conn.execute(sql, winner_id, final_price, auction_id)
-        logging.info(f"Аукцион {auction_id} завершен. Победитель: {winner_id}, цена: {final_price}")
+async def finish_auction(auction_id: int, winner_id: Optional[int], final_price: Optional[float],
+                         conn: Optional[DbConn] = None) -> bool:
+    """
+    Завершает аукцион, обновляя его статус и данные о победителе.
+    В той же транзакции ставит в outbox финальный пост в канале и уведомление победителю.
+    Условие status = 'active' не дает перезаписать победителя лота, который уже закрыт
+    (например, планировщиком между проверкой админа и этим вызовом).
+    Возвращает False, если аукцион уже не активен.
+    """
+    sql = """
+        UPDATE auctions SET status = 'finished', winner_id = $1, final_price = $2
+        WHERE auction_id = $3 AND status = 'active'
+        RETURNING auction_id
+    """
+    async with _connection(conn) as conn:
+        async with conn.transaction():
+            finished = await conn.fetchval(sql, winner_id, final_price, auction_id) is not None
+            if finished:
+                await _enqueue_event(conn, 'auction_post_finalize', {'auction_id': auction_id})
+                if winner_id:
+                    await _enqueue_event(conn, 'winner_notify', {'auction_id': auction_id})
+    if not finished:
+        logging.info(f"Аукцион {auction_id} уже не активен, завершение пропущено.")
+        return False
+    logging.info(f"Аукцион {auction_id} завершен. Победитель: {winner_id}, цена: {final_price}")
+    outbox_wakeup.set()
+    return True
+
+
+async def close_expired_auctions(auction_ids: Optional[List[int]] = None,
+                                 conn: Optional[DbConn] = None) -> List[Dict[str, Any]]:
+    """
+    Закрывает активные лоты с истекшим временем (все или только из auction_ids) одним запросом:
+    победитель — лидер по ставкам, вместе с закрытием в outbox записываются финальный пост
+    и уведомление победителю. Условие status = 'active' гарантирует, что лот
+    закрывается ровно один раз. Возвращает закрытые лоты.
+    """
+    async with _connection(conn) as conn:
+        rows = await queries.fetch(conn, "close_expired_auctions", auction_ids)
+        for row in rows:
+            logging.info(f"Аукцион {row['auction_id']} завершен. Победитель: {row['winner_id']}, цена: {row['final_price']}")
+    if rows:
+        outbox_wakeup.set()
+    return [dict(row) for row in rows]
 
 
 # --- Функции для работы со ставками (Bids) ---
 
-async def add_bid(auction_id: int, user_id: int, amount: float):
-    """Добавляет новую ставку в базу данных."""
-    sql = "INSERT INTO bids (auction_id, user_id, bid_amount) VALUES ($1, $2, $3)"
-    async with pool.acquire() as conn:
-        await conn.execute(sql, auction_id, user_id, amount)
+class BidOutcome(str, Enum):
+    """Результат place_bid_atomic."""
+    ACCEPTED = 'accepted'  # Ставка принята
+    BLITZ = 'blitz'  # Ставка >= блиц-цены: лот куплен и завершен
+    NOT_FOUND = 'not_found'  # Аукциона нет
+    NOT_ACTIVE = 'not_active'  # Аукцион уже завершен
+    ENDED = 'ended'  # Время вышло, но аукцион еще не закрыт планировщиком
+    TOO_LOW = 'too_low'  # Меньше текущей цены + минимальный шаг
+
 
+async def place_bid_atomic(auction_id: int, user_id: int, amount: float,
+                           snipe_window: Optional[timedelta] = None,
+                           snipe_extension: Optional[timedelta] = None,
+                           conn: Optional[DbConn] = None) -> Dict[str, Any]:
+    """
+    Проверяет и записывает ставку одним запросом (функция place_bid в БД, см. migrations.py):
+    статус и время окончания аукциона, блиц-цену, минимальный шаг от актуальной цены.
+    Если до конца осталось не больше snipe_window — продлевает аукцион на snipe_extension.
+    Уведомления (перебитому лидеру, победителю блиц-покупки) пишутся в outbox той же транзакцией.
 
-async def get_last_bid(auction_id: int) -> Optional[Dict[str, Any]]:
+    Возвращает {'outcome': BidOutcome, 'bid': ставка в формате get_top_bids или None,
+    'current_price': цена до ставки, 'min_step', 'previous_leader_id', 'end_time'}.
+    """
+    async with _connection(conn) as conn:
+        row = await queries.fetchrow(conn, "place_bid", auction_id, user_id, amount, snipe_window, snipe_extension,
+                                     cluster_events)
+
+    outcome = BidOutcome(row['outcome'])
+    if outcome in (BidOutcome.ACCEPTED, BidOutcome.BLITZ):
+        outbox_wakeup.set()
+    bid = None
+    if outcome in (BidOutcome.ACCEPTED, BidOutcome.BLITZ):
+        bid = {
+            'bid_id': row['bid_id'],
+            'auction_id': auction_id,
+            'user_id': user_id,
+            'bid_amount': row['bid_amount'],
+            'bid_time': row['bid_time'],
+            'username': row['username'],
+            'tg_full_name': row['tg_full_name'],
+        }
+        logging.info(f"Ставка {row['bid_amount']} от {user_id} на аукционе {auction_id}: {outcome.value}")
+    return {
+        'outcome': outcome,
+        'bid': bid,
+        'current_price': row['current_price'],
+        'min_step': row['min_step'],
+        'previous_leader_id': row['previous_leader_id'],
+        'end_time': row['end_time'],
+    }
+
+
+async def get_last_bid(auction_id: int, conn: Optional[DbConn] = None) -> Optional[Dict[str, Any]]:
     """Получает последнюю ставку, включая tg_full_name."""
-    sql = """
-          SELECT b.bid_amount, u.username, b.user_id, u.tg_full_name -- Используем tg_full_name
-          FROM bids b
-          JOIN users u ON b.user_id = u.user_id
-          WHERE b.auction_id = $1
-          ORDER BY b.bid_amount DESC, b.bid_time ASC
-          LIMIT 1;
-          """
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(sql, auction_id)
+    async with _connection(conn) as conn:
+        row = await queries.fetchrow(conn, "last_bid", auction_id)
         return dict(row) if row else None
 
 
-async def get_user_last_bid_time(user_id: int, auction_id: int) -> Optional[str]:
+async def get_last_bid_times(auction_id: int, conn: Optional[DbConn] = None) -> Dict[int, Any]:
+    """Возвращает время последней ставки каждого участника лота: {user_id: bid_time}."""
+    async with _connection(conn) as conn:
+        rows = await queries.fetch(conn, "last_bid_times", auction_id)
+        return {r['user_id']: r['bid_time'] for r in rows}
+
+
+async def get_user_last_bid_time(user_id: int, auction_id: int, conn: Optional[DbConn] = None) -> Optional[str]:
     """Возвращает время последней ставки пользователя на конкретном аукционе."""
-    sql = "SELECT bid_time FROM bids WHERE user_id = $1 AND auction_id = $2 ORDER BY bid_time DESC LIMIT 1"
-    async with pool.acquire() as conn:
-        return await conn.fetchval(sql, user_id, auction_id)
+    async with _connection(conn) as conn:
+        return await queries.fetchval(conn, "user_last_bid_time", user_id, auction_id)
 
 
 
-async def get_top_bids(auction_id: int, limit: int = 5) -> list[dict]:
+async def get_top_bids(auction_id: int, limit: int = 5, conn: Optional[DbConn] = None) -> list[dict]:
     """Возвращает топ ставок (неуникальных), включая tg_full_name."""
-    sql = """
-        SELECT b.bid_id, b.auction_id, b.user_id, b.bid_amount, b.bid_time,
-               u.username, u.tg_full_name -- Используем tg_full_name
-        FROM bids b
-        JOIN users u ON b.user_id = u.user_id
-        WHERE b.auction_id = $1
-        ORDER BY b.bid_amount DESC, b.bid_time ASC -- Сортируем по сумме ставки (убыв.)
-        LIMIT $2;
-    """
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(sql, auction_id, limit)
+    async with _connection(conn) as conn:
+        rows = await queries.fetch(conn, "top_bids", auction_id, limit)
         # Убираем 'sorted_rows', так как SQL теперь сортирует правильно
         return [dict(r) for r in rows]
 
 
-async def get_bid_by_id(bid_id: int) -> dict | None:
+# Колонки ставки в строках get_auction_snapshot (остальные колонки — строка аукциона)
+_SNAPSHOT_BID_FIELDS = ('bid_id', 'bid_user_id', 'bid_amount', 'bid_time', 'username', 'tg_full_name')
+
+
+async def get_auction_snapshot(auction_id: int, top_n: int = 5,
+                               conn: Optional[DbConn] = None) -> Optional[Dict[str, Any]]:
+    """
+    Возвращает за один запрос состояние лота:
+    {'auction': строка аукциона, 'leader': лучшая ставка или None,
+     'top_bids': топ-N ставок (как get_top_bids), 'bids_count': число ставок,
+     'last_bid_id': ID последней ставки или None}.
+    None, если аукциона нет.
+    """
+    async with _connection(conn) as conn:
+        rows = await queries.fetch(conn, "auction_snapshot", auction_id, top_n)
+    if not rows:
+        return None
+
+    first = dict(rows[0])
+    bids_count = int(first.pop('bids_count'))
+    last_bid_id = first.pop('last_bid_id')
+    auction = {k: v for k, v in first.items() if k not in _SNAPSHOT_BID_FIELDS}
+    top_bids = [
+        {
+            'bid_id': r['bid_id'],
+            'auction_id': auction_id,
+            'user_id': r['bid_user_id'],
+            'bid_amount': r['bid_amount'],
+            'bid_time': r['bid_time'],
+            'username': r['username'],
+            'tg_full_name': r['tg_full_name'],
+        }
+        for r in rows if r['bid_id'] is not None
+    ]
+    return {
+        'auction': auction,
+        'leader': top_bids[0] if top_bids else None,
+        'top_bids': top_bids,
+        'bids_count': bids_count,
+        'last_bid_id': last_bid_id,
+    }
+
+
+async def get_bid_by_id(bid_id: int, conn: Optional[DbConn] = None) -> dict | None:
     """Возвращает ставку по ID, включая tg_full_name."""
     sql = """
         SELECT b.*, u.username, u.tg_full_name -- Используем tg_full_name
@@ -378,12 +989,12 @@ async def get_bid_by_id(bid_id: int) -> dict | None:
         JOIN users u ON b.user_id = u.user_id
         WHERE bid_id = $1
         """
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         row = await conn.fetchrow(sql, bid_id)
         return dict(row) if row else None
 
 
-async def get_users_with_bid_stats() -> list[dict]:
+async def get_users_with_bid_stats(conn: Optional[DbConn] = None) -> list[dict]:
     """Возвращает список пользователей со статистикой, включая tg_full_name."""
     sql = """
         SELECT u.user_id, u.username, u.full_name, u.tg_full_name, -- Добавлен tg_full_name
@@ -395,57 +1006,59 @@ async def get_users_with_bid_stats() -> list[dict]:
         GROUP BY u.user_id -- Группируем по ID, остальные поля уникальны для ID
         ORDER BY bids_sum DESC, bids_count DESC
     """
-    async with pool.acquire() as conn:
+    async with _connection(conn, read_only=True) as conn:
         rows = await conn.fetch(sql)
         return [dict(r) for r in rows]
 
-async def get_expired_active_auctions() -> list[dict]:
-    """Возвращает список активных аукционов, время которых истекло."""
-    sql = "SELECT * FROM auctions WHERE status = 'active' AND end_time <= NOW()"
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(sql)
-        return [dict(row) for row in rows]
-
-async def get_participation_status(user_id: int, auction_id: int) -> Optional[str]:
+async def get_participation_status(user_id: int, auction_id: int, conn: Optional[DbConn] = None) -> Optional[str]:
     """Получает статус участия пользователя в аукционе (pending, approved, rejected) или None."""
-    sql = "SELECT status FROM auction_participants WHERE user_id = $1 AND auction_id = $2"
-    async with pool.acquire() as conn:
-        return await conn.fetchval(sql, user_id, auction_id)
+    async with _connection(conn) as conn:
+        return await queries.fetchval(conn, "participation_status", user_id, auction_id)
 
 
-async def apply_for_participation(user_id: int, auction_id: int):
+async def apply_for_participation(user_id: int, auction_id: int, conn: Optional[DbConn] = None):
     """Добавляет заявку пользователя на участие в статусе 'pending'."""
     sql = """
           INSERT INTO auction_participants (user_id, auction_id, status)
           VALUES ($1, $2, 'pending')
           ON CONFLICT (user_id, auction_id) DO NOTHING;
           """
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         await conn.execute(sql, user_id, auction_id)
 
 
-async def update_participation_status(user_id: int, auction_id: int, status: str, reason: Optional[str] = None):
-    """Обновляет статус заявки на участие (approved/rejected)."""
+async def update_participation_status(user_id: int, auction_id: int, status: str, reason: Optional[str] = None,
+                                      notify: bool = False, conn: Optional[DbConn] = None):
+    """
+    Обновляет статус заявки на участие (approved/rejected).
+    notify=True — в той же транзакции ставит уведомление участнику в outbox.
+    """
     sql = """
           UPDATE auction_participants 
           SET status = $1, rejection_reason = $2 
           WHERE user_id = $3 AND auction_id = $4
           """
-    async with pool.acquire() as conn:
-        await conn.execute(sql, status, reason, user_id, auction_id)
+    async with _connection(conn) as conn:
+        async with conn.transaction():
+            await conn.execute(sql, status, reason, user_id, auction_id)
+            if notify:
+                await _enqueue_event(conn, f"participation_{status}",
+                                     {'user_id': user_id, 'auction_id': auction_id, 'reason': reason})
         logging.info(f"Статус участия {user_id} в {auction_id} обновлен на {status}.")
+    if notify:
+        outbox_wakeup.set()
 
 
-async def get_auto_approve_status() -> bool:
+async def get_auto_approve_status(conn: Optional[DbConn] = None) -> bool:
     """Проверяет, включено ли автопринятие заявок."""
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         value = await conn.fetchval("SELECT setting_value FROM settings WHERE setting_key = 'auto_approve_enabled'")
         return value == 'true' # Сравниваем со строкой 'true'
 
-async def set_auto_approve_status(enabled: bool):
+async def set_auto_approve_status(enabled: bool, conn: Optional[DbConn] = None):
     """Включает или выключает автопринятие заявок."""
     value_str = 'true' if enabled else 'false'
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         await conn.execute(
             "UPDATE settings SET setting_value = $1 WHERE setting_key = 'auto_approve_enabled'",
             value_str
@@ -453,36 +1066,266 @@ async def set_auto_approve_status(enabled: bool):
         logging.info(f"Автопринятие заявок установлено в: {enabled}")
 
 
-async def update_auction_title(auction_id: int, new_title: str):
+async def update_auction_title(auction_id: int, new_title: str, conn: Optional[DbConn] = None):
     """Обновляет название аукциона."""
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         await conn.execute("UPDATE auctions SET title = $1 WHERE auction_id = $2", new_title, auction_id)
         logging.info(f"Название аукциона {auction_id} обновлено.")
 
-async def update_auction_description(auction_id: int, new_description: str):
+async def update_auction_description(auction_id: int, new_description: str, conn: Optional[DbConn] = None):
     """Обновляет описание аукциона."""
-    async with pool.acquire() as conn:
+    async with _connection(conn) as conn:
         await conn.execute("UPDATE auctions SET description = $1 WHERE auction_id = $2", new_description, auction_id)
         logging.info(f"Описание аукциона {auction_id} обновлено.")
 
 
-async def get_bids_page(auction_id: int, limit: int, offset: int) -> list[dict]:
+async def get_bids_page(auction_id: int, limit: int, offset: int, conn: Optional[DbConn] = None) -> list[dict]:
     """Возвращает страницу ставок по лоту, отсортированных от большей к меньшей."""
-    sql = """
-        SELECT b.*, u.username, u.tg_full_name
-        FROM bids b
-        JOIN users u ON b.user_id = u.user_id
-        WHERE b.auction_id = $1
-        ORDER BY b.bid_amount DESC, b.bid_time ASC
-        LIMIT $2 OFFSET $3
-    """
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(sql, auction_id, limit, offset)
+    async with _connection(conn, read_only=True) as conn:
+        rows = await queries.fetch(conn, "bids_page", auction_id, limit, offset)
         return [dict(r) for r in rows]
 
-async def count_bids(auction_id: int) -> int:
+async def count_bids(auction_id: int, conn: Optional[DbConn] = None) -> int:
     """Возвращает общее количество ставок по лоту."""
-    sql = "SELECT COUNT(*) FROM bids WHERE auction_id = $1"
-    async with pool.acquire() as conn:
-        count = await conn.fetchval(sql, auction_id)
-        return int(count)
\ No newline at end of file
+    async with _connection(conn, read_only=True) as conn:
+        count = await queries.fetchval(conn, "count_bids", auction_id)
+        return int(count)
+
+
+# --- Функции для массовых рассылок (Broadcasts) ---
+
+async def create_broadcast_job(title: str, text: str, user_ids: List[int], reply_markup: Optional[str] = None,
+                               report_chat_id: Optional[int] = None, conn: Optional[DbConn] = None) -> int:
+    """Создает задание рассылки и строки доставки для каждого получателя. reply_markup — JSON клавиатуры."""
+    user_ids = list(dict.fromkeys(user_ids))  # Без повторов, порядок сохраняем
+    async with _connection(conn) as conn:
+        async with conn.transaction():
+            job_id = await conn.fetchval(
+                """
+                INSERT INTO broadcast_jobs (title, text, reply_markup, total, report_chat_id)
+                VALUES ($1, $2, $3::jsonb, $4, $5)
+                RETURNING job_id
+                """,
+                title, text, reply_markup, len(user_ids), report_chat_id
+            )
+            await conn.execute(
+                "INSERT INTO broadcast_deliveries (job_id, user_id) SELECT $1, unnest($2::bigint[])",
+                job_id, user_ids
+            )
+            return job_id
+
+
+async def get_broadcast_job(job_id: int, conn: Optional[DbConn] = None) -> Optional[Dict[str, Any]]:
+    async with _connection(conn) as conn:
+        row = await conn.fetchrow("SELECT * FROM broadcast_jobs WHERE job_id = $1", job_id)
+        return dict(row) if row else None
+
+
+async def get_unfinished_broadcast_jobs(conn: Optional[DbConn] = None) -> List[Dict[str, Any]]:
+    """Возвращает рассылки, не завершенные к моменту остановки бота."""
+    async with _connection(conn) as conn:
+        rows = await conn.fetch(
+            "SELECT * FROM broadcast_jobs WHERE status IN ('pending', 'running') ORDER BY job_id"
+        )
+        return [dict(r) for r in rows]
+
+
+async def set_broadcast_job_status(job_id: int, status: str, report_message_id: Optional[int] = None,
+                                   conn: Optional[DbConn] = None):
+    async with _connection(conn) as conn:
+        await conn.execute(
+            """
+            UPDATE broadcast_jobs
+            SET status = $2,
+                report_message_id = COALESCE($3, report_message_id),
+                finished_at = CASE WHEN $2 = 'done' THEN NOW() ELSE finished_at END
+            WHERE job_id = $1
+            """,
+            job_id, status, report_message_id
+        )
+
+
+async def get_pending_broadcast_recipients(job_id: int, limit: int, conn: Optional[DbConn] = None) -> List[int]:
+    async with _connection(conn) as conn:
+        rows = await conn.fetch(
+            "SELECT user_id FROM broadcast_deliveries WHERE job_id = $1 AND status = 'pending' LIMIT $2",
+            job_id, limit
+        )
+        return [r['user_id'] for r in rows]
+
+
+async def record_broadcast_results(job_id: int, results: List[tuple], conn: Optional[DbConn] = None):
+    """
+    Записывает результаты доставки пачкой: results — список (user_id, status, error).
+    Счетчики задания обновляются тем же запросом.
+    """
+    if not results:
+        return
+    user_ids = [r[0] for r in results]
+    statuses = [r[1] for r in results]
+    errors = [r[2] for r in results]
+    # Счетчики считаем только по строкам, которые действительно были в ожидании (повторная запись их не сдвинет)
+    sql = """
+        WITH updated AS (
+            UPDATE broadcast_deliveries AS d
+            SET status = r.status,
+                error = r.error,
+                sent_at = NOW()
+            FROM unnest($2::bigint[], $3::text[], $4::text[]) AS r(user_id, status, error)
+            WHERE d.job_id = $1 AND d.user_id = r.user_id AND d.status = 'pending'
+            RETURNING d.status
+        )
+        UPDATE broadcast_jobs
+        SET sent = sent + (SELECT COUNT(*) FROM updated WHERE status = 'sent'),
+            failed = failed + (SELECT COUNT(*) FROM updated WHERE status = 'failed')
+        WHERE job_id = $1
+    """
+    async with _connection(conn) as conn:
+        await conn.execute(sql, job_id, user_ids, statuses, errors)
+
+
+# --- Transactional outbox (см. outbox.py) ---
+
+async def _enqueue_event(conn, kind: str, payload: Dict[str, Any]):
+    """Записывает событие в outbox. Вызывается внутри транзакции, меняющей состояние."""
+    await conn.execute("INSERT INTO outbox (kind, payload) VALUES ($1, $2::jsonb)", kind, json.dumps(payload))
+
+
+async def claim_outbox_events(limit: int, lease_seconds: float, conn: Optional[DbConn] = None) -> List[Dict[str, Any]]:
+    """
+    Забирает до limit готовых к отправке событий. Пока событие обрабатывается, его next_attempt_at
+    сдвинут на lease_seconds: другие диспетчеры его не возьмут, а после падения оно вернется в работу.
+    """
+    async with _connection(conn) as conn:
+        rows = await queries.fetch(conn, "claim_outbox", limit, lease_seconds)
+    events = [dict(row) for row in rows]
+    for event in events:
+        event['payload'] = json.loads(event['payload'])
+    events.sort(key=lambda e: e['event_id'])
+    return events
+
+
+async def complete_outbox_events(event_ids: List[int], conn: Optional[DbConn] = None):
+    """Отмечает события отправленными (одним запросом)."""
+    if not event_ids:
+        return
+    async with _connection(conn) as conn:
+        await conn.execute(
+            "UPDATE outbox SET status = 'done', done_at = NOW(), last_error = NULL WHERE event_id = ANY($1::bigint[])",
+            event_ids
+        )
+
+
+async def extend_outbox_lease(event_ids: List[int], lease_seconds: float, conn: Optional[DbConn] = None):
+    """Продлевает аренду событий, которые еще обрабатываются (долгая пачка не должна вернуться в очередь)."""
+    if not event_ids:
+        return
+    async with _connection(conn) as conn:
+        await conn.execute(
+            "UPDATE outbox SET next_attempt_at = NOW() + make_interval(secs => $2) "
+            "WHERE event_id = ANY($1::bigint[]) AND status = 'pending'",
+            event_ids, lease_seconds
+        )
+
+
+async def fail_outbox_event(event_id: int, error: str, retry_in: Optional[float], conn: Optional[DbConn] = None):
+    """Записывает ошибку события: retry_in — через сколько секунд повторить, None — больше не повторять."""
+    sql = """
+        UPDATE outbox
+        SET status = CASE WHEN $3::float8 IS NULL THEN 'failed' ELSE 'pending' END,
+            next_attempt_at = NOW() + make_interval(secs => COALESCE($3::float8, 0)),
+            last_error = $2
+        WHERE event_id = $1
+    """
+    async with _connection(conn) as conn:
+        await conn.execute(sql, event_id, error, retry_in)
+
+
+# --- Хранилище FSM (см. fsm_storage.py) ---
+# Строка без состояния и без данных не хранится: сброс FSM удаляет ее.
+
+async def get_fsm_record(key: str, conn: Optional[DbConn] = None) -> Optional[tuple]:
+    """Возвращает (state, data в виде JSON-текста) по ключу FSM или None."""
+    async with _connection(conn) as conn:
+        row = await queries.fetchrow(conn, "fsm_get", key)
+    return (row['state'], row['data']) if row else None
+
+
+async def set_fsm_state(key: str, state: Optional[str], conn: Optional[DbConn] = None):
+    """Записывает состояние FSM."""
+    if state is None:
+        sql = """
+            WITH del AS (DELETE FROM fsm_state WHERE key = $1 AND data = '{}'::jsonb RETURNING key)
+            UPDATE fsm_state SET state = NULL, updated_at = NOW()
+            WHERE key = $1 AND NOT EXISTS (SELECT 1 FROM del)
+        """
+        args = (key,)
+    else:
+        sql = """
+            INSERT INTO fsm_state (key, state) VALUES ($1, $2)
+            ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, updated_at = NOW()
+        """
+        args = (key, state)
+    async with _connection(conn) as conn:
+        await conn.execute(sql, *args)
+        # Кэш FSM других процессов (см. fsm_storage.py)
+        await notify_cluster({'type': 'fsm', 'key': key}, conn)
+
+
+async def set_fsm_data(key: str, data_json: Optional[str], conn: Optional[DbConn] = None):
+    """Записывает данные FSM (JSON-текст; None — очистить)."""
+    if data_json is None:
+        sql = """
+            WITH del AS (DELETE FROM fsm_state WHERE key = $1 AND state IS NULL RETURNING key)
+            UPDATE fsm_state SET data = '{}'::jsonb, updated_at = NOW()
+            WHERE key = $1 AND NOT EXISTS (SELECT 1 FROM del)
+        """
+        args = (key,)
+    else:
+        sql = """
+            INSERT INTO fsm_state (key, data) VALUES ($1, $2::jsonb)
+            ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+        """
+        args = (key, data_json)
+    async with _connection(conn) as conn:
+        await conn.execute(sql, *args)
+        # Кэш FSM других процессов (см. fsm_storage.py)
+        await notify_cluster({'type': 'fsm', 'key': key}, conn)
+
+
+async def delete_expired_fsm_states(ttl_seconds: float, conn: Optional[DbConn] = None) -> int:
+    """Удаляет состояния FSM, не менявшиеся дольше ttl_seconds. Возвращает количество удаленных."""
+    async with _connection(conn) as conn:
+        result = await conn.execute(
+            "DELETE FROM fsm_state WHERE updated_at < NOW() - make_interval(secs => $1)", ttl_seconds
+        )
+    return int(result.split()[-1])
+
+
+# --- Ограничение частоты (throttling.py, THROTTLE_BACKEND=postgres) ---
+
+async def throttle_hit(key: str, limit: int, period: float, conn: Optional[DbConn] = None) -> bool:
+    """
+    Учитывает событие в окне длиной period секунд по ключу (правило:пользователь).
+    Возвращает False, если в текущем окне уже было limit событий.
+    """
+    sql = """
+        INSERT INTO throttle_hits (key, window_end, hits)
+        VALUES ($1, NOW() + make_interval(secs => $2), 1)
+        ON CONFLICT (key) DO UPDATE SET
+            window_end = CASE WHEN throttle_hits.window_end <= NOW() THEN EXCLUDED.window_end
+                              ELSE throttle_hits.window_end END,
+            hits       = CASE WHEN throttle_hits.window_end <= NOW() THEN 1
+                              ELSE throttle_hits.hits + 1 END
+        RETURNING hits
+    """
+    async with _connection(conn) as conn:
+        hits = await conn.fetchval(sql, key, period)
+    return hits <= limit
+
+
+async def delete_expired_throttle_hits(conn: Optional[DbConn] = None) -> int:
+    """Удаляет истекшие окна ограничения частоты. Возвращает количество удаленных."""
+    async with _connection(conn) as conn:
+        result = await conn.execute("DELETE FROM throttle_hits WHERE window_end <= NOW()")
+    return int(result.split()[-1])
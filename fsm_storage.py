@@ -0,0 +1,147 @@
+# fsm_storage.py
+import asyncio
+import copy
+import json
+import logging
+import os
+import weakref
+from datetime import date, datetime
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import db
+from cache import TTLCache, MISSING
+
+# Состояние FSM, не менявшееся дольше FSM_STATE_TTL секунд, удаляется (брошенные карточки, ставки)
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600)))
+FSM_CLEANUP_INTERVAL = float(os.getenv("FSM_CLEANUP_INTERVAL", "3600"))
+# Кэш чтения в процессе. Запись сквозная (сначала БД, затем кэш), поэтому свои изменения процесс
+# видит сразу; изменения других процессов приходят через синхронизацию кластера (cluster.py, событие fsm).
+# Без синхронизации кэш допустим, только если обновления получает один процесс (см. main.py):
+# иначе состояние, выставленное на другой реплике (например, ожидание суммы ставки), было бы не видно
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "20000"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "60"))
+
+_storages: "weakref.WeakSet[PostgresStorage]" = weakref.WeakSet()
+
+
+def _json_default(value: Any) -> Any:
+    # datetime/date (например, end_time в карточке создания лота) сохраняем с пометкой типа
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    raise TypeError(f"Значение типа {type(value).__name__} нельзя сохранить в FSM")
+
+
+def _json_object_hook(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1:
+        if "__datetime__" in obj:
+            return datetime.fromisoformat(obj["__datetime__"])
+        if "__date__" in obj:
+            return date.fromisoformat(obj["__date__"])
+    return obj
+
+
+def dumps(data: Mapping[str, Any]) -> str:
+    return json.dumps(data, default=_json_default, ensure_ascii=False)
+
+
+def loads(raw: str) -> Dict[str, Any]:
+    return json.loads(raw, object_hook=_json_object_hook)
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_state (PostgreSQL): состояние переживает перезапуск
+    и доступно всем процессам бота. Чтения обслуживаются кэшем в процессе.
+    """
+
+    def __init__(self, state_ttl: float = FSM_STATE_TTL, cache_ttl: float = FSM_CACHE_TTL):
+        self.state_ttl = state_ttl
+        # key -> (state, data); cache_ttl=0 — без кэша
+        self._cache = TTLCache(maxsize=FSM_CACHE_SIZE if cache_ttl > 0 else 0, ttl=cache_ttl)
+        self._cleanup_task: Optional[asyncio.Task] = None
+        _storages.add(self)
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    async def _load(self, key: str) -> tuple:
+        record = self._cache.get(key)
+        if record is not MISSING:
+            return record
+        generation = self._cache.generation
+        row = await db.get_fsm_record(key)
+        record = (row[0], loads(row[1])) if row else (None, {})
+        self._cache.set(key, record, generation=generation)
+        return record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        value = state.state if isinstance(state, State) else state
+        await db.set_fsm_state(storage_key, value)
+        cached = self._cache.get(storage_key)
+        if cached is MISSING:
+            self._cache.invalidate(storage_key)
+        else:
+            self._cache.set(storage_key, (value, cached[1]))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key = self._key(key)
+        data = dict(data)
+        await db.set_fsm_data(storage_key, dumps(data) if data else None)
+        cached = self._cache.get(storage_key)
+        if cached is MISSING:
+            self._cache.invalidate(storage_key)
+        else:
+            self._cache.set(storage_key, (cached[0], copy.deepcopy(data)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return copy.deepcopy(data)
+
+    async def cleanup(self) -> int:
+        """Удаляет устаревшие состояния. Возвращает количество удаленных."""
+        deleted = await db.delete_expired_fsm_states(self.state_ttl)
+        if deleted:
+            self._cache.clear()
+            logging.info(f"Удалено устаревших состояний FSM: {deleted}")
+        return deleted
+
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                await self.cleanup()
+            except Exception as e:
+                logging.error(f"Ошибка очистки состояний FSM: {e}")
+            await asyncio.sleep(FSM_CLEANUP_INTERVAL)
+
+    def start_cleanup(self):
+        """Запускает фоновую очистку устаревших состояний."""
+        if self._cleanup_task is None or self._cleanup_task.done():
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self) -> None:
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
+
+
+def invalidate(key: Optional[str] = None):
+    """Сбрасывает кэш состояния key (None — весь кэш) во всех хранилищах процесса: его изменил другой процесс."""
+    for storage in _storages:
+        if key is None:
+            storage._cache.clear()
+        else:
+            storage._cache.invalidate(key)
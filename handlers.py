@@ -1,3 +1,4 @@
+import asyncio
 import os
 import re
 import pytz
@@ -8,22 +9,29 @@ import csv
 from html import escape
 
 from aiogram import Router, F, Bot, types
-from aiogram.types import Message, CallbackQuery, User, InputMediaPhoto, InputMediaVideo, BufferedInputFile
+from aiogram.types import Message, CallbackQuery, User, InputMediaPhoto, InputMediaVideo, BufferedInputFile, \
+    ChatMemberUpdated
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import default_state
 from aiogram.exceptions import TelegramAPIError
 from aiogram.utils.markdown import hbold
-import time
-from collections import defaultdict
+import auction_book
+import auction_timers
+import bid_lanes
+import broadcast
 import db as db
+import metrics
+from access import ADMIN_IDS
+from channel_updater import channel_updater
+from rate_limiter import Priority, with_priority
+from throttling import callback_rate_limit_middleware, throttle_middleware
 import kb
+from cache import TTLCache, MISSING
 from states import Registration, AuctionCreation, Bidding, AdminActions
 
 # Загружаем переменные окружения
 ADMIN_ID = os.getenv("ADMIN_ID")
-ADMIN_IDS = os.getenv("ADMIN_IDS").split(",")
-ADMIN_IDS = list(map(int, ADMIN_IDS))
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME")
@@ -31,19 +39,94 @@ APPROVAL_MESSAGE = "✅ Ваша заявка одобрена! Добро по
 REJECTION_MESSAGE = "❌ К сожалению, ваша заявка на регистрацию отклонена."
 
 
-async def is_user_subscribed(bot: Bot, user_id: int) -> bool:
-    """Проверяет подписку пользователя на канал."""
+# Кэш подписки на канал: подтвержденная подписка живет дольше, чем ее отсутствие,
+# чтобы только что подписавшийся пользователь не ждал долго.
+SUBSCRIPTION_CACHE_POSITIVE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_POSITIVE_TTL", "600"))
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_NEGATIVE_TTL", "15"))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "50000"))
+# Обновлять кэш по событиям chat_member (Telegram присылает их, только если бот — админ канала)
+SUBSCRIPTION_TRACK_CHAT_MEMBER = os.getenv("SUBSCRIPTION_TRACK_CHAT_MEMBER", "true").lower() == "true"
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+subscription_cache = TTLCache(maxsize=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_POSITIVE_TTL)
+_subscription_checks: dict[int, asyncio.Task] = {}  # Проверки "в полете" (single-flight)
+
+
+def _cache_subscription(user_id: int, subscribed: bool, generation: int | None = None):
+    ttl = SUBSCRIPTION_CACHE_POSITIVE_TTL if subscribed else SUBSCRIPTION_CACHE_NEGATIVE_TTL
+    subscription_cache.set(user_id, subscribed, ttl=ttl, generation=generation)
+
+
+async def _check_subscription(bot: Bot, user_id: int) -> bool:
+    """Запрашивает подписку у Telegram и кладет результат в кэш."""
+    generation = subscription_cache.generation
     try:
         member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
         status = getattr(member, "status", None)
-        return status in ("member", "administrator", "creator")
+        subscribed = status in SUBSCRIBED_STATUSES
+        _cache_subscription(user_id, subscribed, generation=generation)
+        return subscribed
     except Exception as e:
+        # Ошибку не кэшируем: следующая проверка снова спросит Telegram
         logging.warning(f"Не удалось проверить подписку пользователя {user_id}: {e}")
         return False
+    finally:
+        _subscription_checks.pop(user_id, None)
+
 
+async def is_user_subscribed(bot: Bot, user_id: int, use_cache: bool = True) -> bool:
+    """
+    Проверяет подписку пользователя на канал.
+    Результат кэшируется; одновременные проверки одного пользователя
+    объединяются в один запрос к Telegram.
+    use_cache=False — не доверять кэшу (кнопка "Проверить подписку").
+    """
+    if use_cache:
+        cached = subscription_cache.get(user_id)
+        if cached is not MISSING:
+            return cached
+
+    task = _subscription_checks.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_check_subscription(bot, user_id))
+        _subscription_checks[user_id] = task
+    # shield: отмена одного ожидающего не должна отменять общий запрос
+    return await asyncio.shield(task)
+
+
+class BotIdentity:
+    """
+    Данные бота (username и префикс deep link), запрашиваемые у Telegram один раз.
+    Заполняется в main.main() до приема обновлений; хендлеры используют модульный bot_identity.
+    """
+
+    def __init__(self):
+        self.user: User | None = None
+        self.deep_link_prefix: str | None = None
+
+    async def resolve(self, bot: Bot, force: bool = False) -> "BotIdentity":
+        """Запрашивает get_me(); повторно — только при force=True."""
+        if self.user is None or force:
+            self.user = await bot.get_me()
+            self.deep_link_prefix = f"https://t.me/{self.user.username}?start="
+            logging.info(f"Бот: @{self.user.username} (ID {self.user.id})")
+        return self
+
+    async def deep_link(self, bot: Bot, payload: str) -> str:
+        """Возвращает deep link на бота с указанным payload."""
+        if self.deep_link_prefix is None:
+            await self.resolve(bot)
+        return self.deep_link_prefix + payload
+
+
+bot_identity = BotIdentity()
 
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
+# Антиснайпинг: ставка за ANTI_SNIPE_WINDOW до конца продлевает аукцион на ANTI_SNIPE_EXTENSION
+ANTI_SNIPE_WINDOW = timedelta(minutes=2)
+ANTI_SNIPE_EXTENSION = timedelta(minutes=2)
+
 # Создаем роутер
 router = Router()
 
@@ -106,6 +189,12 @@ async def restrict_chat_middleware(handler, event, data):
     return  # Блокируем
 
 
+# Ограничение частоты (см. throttling.py): сообщения — для хендлеров с флагом throttle, до обращений к БД;
+# нажатия кнопок — по префиксу callback_data, еще до фильтров и остальных middleware
+router.message.middleware(throttle_middleware)
+router.callback_query.outer_middleware(callback_rate_limit_middleware)
+
+
 @router.message.middleware()
 @router.callback_query.middleware()
 async def user_status_middleware(handler, event, data):
@@ -120,8 +209,8 @@ async def user_status_middleware(handler, event, data):
         # logging.warning("user_status_middleware: User not found in event.")
         return  # Игнорируем события без пользователя
 
-    # Обновляем username (безопасно делать всегда)
-    await db.update_user_tg_details(user.id, user.username, user.full_name)
+    # Обновляем username (без ожидания БД: изменения пишутся пачкой в фоне)
+    db.queue_user_tg_details(user.id, user.username, user.full_name)
 
     # Админы в ЛС имеют полный доступ (в других чатах их уже отфильтровал restrict_chat_middleware)
     # Кнопки модерации для админа в админ-чате также уже разрешены предыдущим middleware
@@ -165,6 +254,30 @@ async def user_status_middleware(handler, event, data):
     return await handler(event, data)
 
 
+@router.message.middleware()
+@router.callback_query.middleware()
+async def db_session_middleware(handler, event, data):
+    """
+    Выполняется ПОСЛЕ user_status_middleware. Дает хендлеру db_session: вызовы db.* с conn=db_session
+    идут через одно соединение. Оно берется из пула при первом запросе и возвращается после хендлера.
+    """
+    async with db.session() as db_session:
+        data['db_session'] = db_session
+        return await handler(event, data)
+
+
+async def channel_member_updated(event: ChatMemberUpdated):
+    """Обновляет кэш подписки по событию chat_member в канале (вход/выход пользователя)."""
+    if str(event.chat.id) != CHANNEL_ID:
+        return
+    member = event.new_chat_member
+    _cache_subscription(member.user.id, member.status in SUBSCRIBED_STATUSES)
+
+
+if SUBSCRIPTION_TRACK_CHAT_MEMBER:
+    router.chat_member.register(channel_member_updated)
+
+
 # --- Вспомогательные функции ---
 def normalize_phone(phone: str) -> str:
     """Приводит номер телефона к формату +7XXXXXXXXXX."""
@@ -199,12 +312,24 @@ def csv_safe(s: str) -> str:
     return ("'" + s) if s[:1] in ("=", "+", "-", "@", "\t") else s
 
 
-async def format_auction_post(auction_data: dict, bot: Bot, finished: bool = False) -> str:
-    """Форматирует текст поста для канала (с кликабельными именами)."""
-    last_bid = await db.get_last_bid(auction_data['auction_id'])
+TOP_BIDS_IN_POST = 5
+
+
+async def format_auction_post(auction_data: dict, bot: Bot, finished: bool = False,
+                              snapshot: dict | None = None) -> str:
+    """
+    Форматирует текст поста для канала (с кликабельными именами).
+    snapshot — результат db.get_auction_snapshot, если он уже получен (иначе запрашивается).
+    """
+    if snapshot is None:
+        book = auction_book.peek_book(auction_data['auction_id'])
+        if book is not None:
+            snapshot = book.snapshot()
+        else:
+            snapshot = await db.get_auction_snapshot(auction_data['auction_id'], top_n=TOP_BIDS_IN_POST)
+    last_bid = snapshot['leader'] if snapshot else None
     safe_title = escape(auction_data.get('title') or "")
     safe_description = escape(auction_data.get('description') or "")
-    bot_info = await bot.get_me()
 
     # --- ФОРМАТИРОВАНИЕ ПОБЕДИТЕЛЯ/ЛИДЕРА ---
     winner_display = "Ставок еще нет"
@@ -238,7 +363,7 @@ async def format_auction_post(auction_data: dict, bot: Bot, finished: bool = Fal
     leader_text = winner_display  # Используем уже отформатированное имя
     end_time_dt = auction_data['end_time'].astimezone(MOSCOW_TZ)
 
-    top_bids = await db.get_top_bids(auction_data['auction_id'], limit=5)
+    top_bids = snapshot['top_bids'][:TOP_BIDS_IN_POST] if snapshot else []
     history = ""
     if top_bids:
         lines = ["\n<b>🔥 Топ-5 ставок:</b>"]
@@ -259,7 +384,7 @@ async def format_auction_post(auction_data: dict, bot: Bot, finished: bool = Fal
     blitz_price_text = ""
     if auction_data.get('blitz_price'):
         blitz_price_text = f"⚡️ <b>Блиц-цена:</b> {auction_data['blitz_price']:,.2f} руб.\n\n"
-    deep_link = f"https://t.me/{bot_info.username}?start=view_auction_{auction_data['auction_id']}"
+    deep_link = await bot_identity.deep_link(bot, f"view_auction_{auction_data['auction_id']}")
     text = (
         f"💎 <b>{safe_title}</b>\n\n"
         f"{safe_description}\n\n"
@@ -273,34 +398,50 @@ async def format_auction_post(auction_data: dict, bot: Bot, finished: bool = Fal
     return text
 
 
-async def _execute_blitz_purchase(bot: Bot, auction: dict, user_id: int, chat_id: int, message_id_to_edit: int):
+async def _render_live_post(auction_id: int, bot: Bot) -> str | None:
+    """
+    Текст поста идущего лота для channel_updater (данные — из книги лота или из БД в момент отправки).
+    None — лот уже завершен (в том числе другим процессом кластера): финальную подпись ставит outbox,
+    и запоздавшее обновление не должно ее перезаписать.
+    """
+    book = auction_book.peek_book(auction_id)
+    snapshot = book.snapshot() if book is not None else await db.get_auction_snapshot(auction_id,
+                                                                                     top_n=TOP_BIDS_IN_POST)
+    if not snapshot or snapshot['auction']['status'] != 'active':
+        return None
+    return await format_auction_post(snapshot['auction'], bot, snapshot=snapshot)
+
+
+async def _execute_blitz_purchase(bot: Bot, auction: dict, user_id: int, chat_id: int,
+                                  message_id_to_edit: int) -> bool:
     """
     Вспомогательная функция для выполнения блиц-покупки.
     Завершает аукцион, обновляет посты и уведомляет победителя.
+    Возвращает False, если лот уже нельзя купить (завершен или время вышло).
     """
-    auction_id = auction['auction_id']
-    blitz_price = auction['blitz_price']
+    # 1. Атомарно добавляем "победную" ставку и завершаем аукцион
+    result = await bid_lanes.submit(
+        auction['auction_id'], db.place_bid_atomic, auction['auction_id'], user_id, auction['blitz_price']
+    )
+    if result['outcome'] != db.BidOutcome.BLITZ:
+        return False
+    await _announce_blitz_purchase(bot, auction, result['bid'], chat_id, message_id_to_edit)
+    return True
 
-    # 1. Добавляем "победную" ставку и завершаем аукцион
-    await db.add_bid(auction_id, user_id, blitz_price)
-    await db.finish_auction(auction_id, user_id, blitz_price)
 
-    # 2. Форматируем финальный пост
-    finished_post_text = await format_auction_post(auction, bot, finished=True)
+async def _announce_blitz_purchase(bot: Bot, auction: dict, bid: dict, chat_id: int, message_id_to_edit: int):
+    """
+    Обновляет приватную карточку после блиц-покупки (ставка уже записана в БД).
+    Пост в канале и поздравление победителю отправляет outbox (события записаны функцией place_bid).
+    """
+    auction_id = auction['auction_id']
+    auction_book.apply_bid(bid)
 
-    # 3. Обновляем пост в канале [cite: 187-188]
-    try:
-        await bot.edit_message_caption(
-            chat_id=CHANNEL_ID,
-            message_id=auction['channel_message_id'],
-            caption=finished_post_text,
-            parse_mode="HTML",
-            reply_markup=None
-        )
-    except TelegramAPIError as e:
-        logging.warning(f"Не удалось обновить пост в канале после блиц-покупки: {e}")
+    # Форматируем финальный пост
+    finished_post_text = await format_auction_post(auction, bot, finished=True)
+    auction_book.drop(auction_id)
 
-    # 4. Обновляем приватную карточку пользователя
+    # Обновляем приватную карточку пользователя
     try:
         await bot.edit_message_caption(
             chat_id=chat_id,
@@ -312,16 +453,6 @@ async def _execute_blitz_purchase(bot: Bot, auction: dict, user_id: int, chat_id
     except TelegramAPIError as e:
         logging.warning(f"Не удалось обновить приватную карточку после блиц-покупки: {e}")
 
-    # 5. Уведомляем победителя [cite: 190-191]
-    try:
-        await bot.send_message(
-            user_id,
-            f"🎉 Поздравляем! Вы купили лот «{escape(auction['title'])}» по блиц-цене {blitz_price:,.2f} руб.\n\n"
-            f"В ближайшее время с вами свяжется администратор."
-        )
-    except TelegramAPIError:
-        pass
-
 
 async def show_auction_card_message(message: Message, bot: Bot, auction_data: dict):
     """Отправляет или редактирует сообщение, показывая карточку аукциона."""
@@ -506,18 +637,14 @@ async def render_registration_card(bot: Bot, chat_id: int, state: FSMContext, pr
             logging.warning(f"Failed to edit registration card: {e}")
 
 
-@router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext, bot: Bot, last_start_time: defaultdict[float]):
+@router.message(CommandStart(), flags={"throttle": "start"})
+async def cmd_start(message: Message, state: FSMContext, bot: Bot):
     """
     Обработчик /start. Проверяет подписку, deep link.
+    Повторные нажатия чаще раза в секунду отбрасывает throttle_middleware.
     """
     await safe_delete_message(message)
     user_id = message.from_user.id
-    current_time = time.time()
-    if current_time - last_start_time[user_id] < 1.0:
-        logging.info(f"Throttling /start for user {user_id}")
-        return  # Молча игнорируем
-    last_start_time[user_id] = current_time
 
     await state.clear()  # Сбрасываем состояние
     await safe_delete_old_menu(bot, user_id)
@@ -780,22 +907,11 @@ async def approve_user(callback: CallbackQuery, bot: Bot):
     except Exception:
         return await callback.answer("Некорректный идентификатор", show_alert=True)
 
-    await db.update_user_status(user_id, 'approved')
+    # Стандартное сообщение с главным меню пользователю отправит outbox
+    await db.update_user_status(user_id, 'approved', notify=True)
     # Редактируем сообщение админа
     await callback.message.edit_text(f"✅ Пользователь {user_id} одобрен.")
-
-    try:
-        # Отправляем стандартное сообщение пользователю с главным меню
-        new_msg = await bot.send_message(user_id, APPROVAL_MESSAGE,
-                                         reply_markup=kb.get_main_menu())
-        await db.update_user_menu_message_id(user_id, new_msg.message_id)
-    except TelegramAPIError as e:
-        logging.error(f"Не удалось уведомить пользователя {user_id} об одобрении: {e}")
-        # Сообщаем админу об ошибке уведомления
-        await callback.answer(f"Пользователь {user_id} одобрен, но не удалось отправить уведомление.", show_alert=True)
-        return  # Выходим, чтобы не было двойного callback.answer()
-
-    await callback.answer(f"Пользователь {user_id} одобрен и уведомлен.")
+    await callback.answer(f"Пользователь {user_id} одобрен.")
 
 
 @router.callback_query(F.data.startswith("decline_user_"))
@@ -839,17 +955,8 @@ async def decline_reason_process(message: Message, state: FSMContext, bot: Bot):
     reason = (message.text or '').strip()
     no_reason = (reason in ('-', '0', ''))
 
-    await db.update_user_status(target_user_id, 'banned')
-
-    # Формируем стандартное сообщение + причину (если есть)
-    notify_text = REJECTION_MESSAGE
-    if not no_reason:
-        notify_text += f"\nПричина: {escape(reason)}"
-
-    try:
-        await bot.send_message(target_user_id, notify_text)
-    except TelegramAPIError as e:
-        logging.error(f"Не удалось уведомить пользователя {target_user_id} об отклонении: {e}")
+    # Стандартное сообщение + причину (если есть) пользователю отправит outbox
+    await db.update_user_status(target_user_id, 'banned', notify=True, reason=None if no_reason else reason)
 
     # Возвращаем админа в админ-меню
     await state.clear()
@@ -898,23 +1005,23 @@ async def menu_current(callback: CallbackQuery, bot: Bot):
 
 
 @router.callback_query(F.data == "menu_all")
-async def menu_all(callback: CallbackQuery, bot: Bot):
-    await render_all_auctions_page(callback, bot, page=1)
+async def menu_all(callback: CallbackQuery, bot: Bot, db_session: db.Session):
+    await render_all_auctions_page(callback, bot, page=1, db_session=db_session)
 
 
 @router.callback_query(F.data.startswith("all_page_"))
-async def menu_all_page(callback: CallbackQuery, bot: Bot):
+async def menu_all_page(callback: CallbackQuery, bot: Bot, db_session: db.Session):
     try:
         page = int(callback.data.split("_")[-1])
         if page < 1:
             page = 1
     except Exception:
         page = 1
-    await render_all_auctions_page(callback, bot, page=page)
+    await render_all_auctions_page(callback, bot, page=page, db_session=db_session)
 
 
 @router.callback_query(F.data.startswith("show_bids_"))
-async def show_all_bids(callback: CallbackQuery, bot: Bot):
+async def show_all_bids(callback: CallbackQuery, bot: Bot, db_session: db.Session):
     """
     Показывает историю ставок по лоту с пагинацией.
     """
@@ -929,7 +1036,7 @@ async def show_all_bids(callback: CallbackQuery, bot: Bot):
     page_size = 10
     offset = (page - 1) * page_size
 
-    total_bids = await db.count_bids(auction_id)
+    total_bids = await db.count_bids(auction_id, conn=db_session)
 
     if total_bids == 0:
         await callback.answer("По этому лоту еще нет ставок.", show_alert=True)
@@ -940,7 +1047,8 @@ async def show_all_bids(callback: CallbackQuery, bot: Bot):
         page = total_pages
         offset = (page - 1) * page_size
 
-    bids_page = await db.get_bids_page(auction_id, limit=page_size, offset=offset)
+    bids_page = await db.get_bids_page(auction_id, limit=page_size, offset=offset, conn=db_session)
+    await db_session.release()  # Дальше только Telegram
 
     lines = [f"<b>История ставок (Страница {page}/{total_pages}):</b>\n"]
     for i, bid in enumerate(bids_page, start=offset + 1):
@@ -983,21 +1091,27 @@ async def show_all_bids(callback: CallbackQuery, bot: Bot):
     await callback.answer()
 
 
-async def render_all_auctions_page(callback: CallbackQuery, bot: Bot, page: int, page_size: int = 5):
-    total = await db.count_auctions()
+async def render_all_auctions_page(callback: CallbackQuery, bot: Bot, page: int, page_size: int = 5,
+                                   db_session: db.Session | None = None):
+    total = await db.count_auctions(conn=db_session)
+    auctions = []
+    if total:
+        offset = (page - 1) * page_size
+        auctions = await db.get_auctions_page(limit=page_size, offset=offset, conn=db_session)
+    if db_session is not None:
+        await db_session.release()  # Дальше книги лотов (свое соединение при промахе) и Telegram
+
     if total == 0:
         text = "Пока аукционов нет."
         kb_markup = kb.back_to_menu_keyboard()
     else:
-        offset = (page - 1) * page_size
-        auctions = await db.get_auctions_page(limit=page_size, offset=offset)
         lines = []
         for a in auctions:
             status = a['status']
             prefix = "🟢 Активен" if status == 'active' else ("🏁 Завершен" if status == 'finished' else status)
             if status == 'active':
-                last = await db.get_last_bid(a['auction_id'])
-                price = last['bid_amount'] if last else a['start_price']
+                book = await auction_book.get_book(a['auction_id'])
+                price = book.current_price if book else a['start_price']
                 ends = a['end_time'].astimezone(MOSCOW_TZ).strftime('%d.%m.%Y %H:%M')
                 lines.append(f"{prefix}: «{a['title']}» — {price:,.0f} ₽ (до {ends})")
             else:
@@ -1128,59 +1242,36 @@ async def admin_winner_none(callback: CallbackQuery, bot: Bot):
     active = await db.get_active_auction()
     if not active:
         return await callback.answer("Нет активного аукциона", show_alert=True)
-    await db.finish_auction(active['auction_id'], None, None)
-    finished_post_text = await format_auction_post(active, bot, finished=True)
-    try:
-        await bot.edit_message_caption(
-            chat_id=CHANNEL_ID,
-            message_id=active['channel_message_id'],
-            caption=finished_post_text,
-            parse_mode="HTML",
-            reply_markup=None
-        )
-    except TelegramAPIError as e:
-        logging.error(f"Не удалось обновить пост в канале после завершения без победителя: {e}")
+    # Финальный пост в канале публикует outbox (см. outbox.py)
+    if not await db.finish_auction(active['auction_id'], None, None):
+        return await callback.answer("Аукцион уже не активен", show_alert=True)
+    auction_book.drop(active['auction_id'])
     await callback.message.edit_text("Аукцион завершён без победителя.", reply_markup=await kb.admin_menu_keyboard())
     await callback.answer("Аукцион закрыт", show_alert=True)
 
 
 @router.callback_query(F.data.startswith("admin_winner_bid_"))
-async def admin_winner_bid(callback: CallbackQuery, bot: Bot):
+async def admin_winner_bid(callback: CallbackQuery, bot: Bot, db_session: db.Session):
     if int(callback.from_user.id) not in ADMIN_IDS:
         return await callback.answer("Нет доступа", show_alert=True)
     try:
         bid_id = int(callback.data.split("_")[-1])
     except Exception:
         return await callback.answer("Некорректный выбор", show_alert=True)
-    bid = await db.get_bid_by_id(bid_id)
+    finished = False
+    async with db_session.transaction():
+        bid = await db.get_bid_by_id(bid_id, conn=db_session)
+        active = await db.get_active_auction(conn=db_session)
+        if bid and active and active['auction_id'] == bid['auction_id']:
+            # Финальный пост в канале и поздравление победителю отправляет outbox (см. outbox.py)
+            finished = await db.finish_auction(active['auction_id'], bid['user_id'], bid['bid_amount'],
+                                               conn=db_session)
+    await db_session.release()
     if not bid:
         return await callback.answer("Ставка не найдена", show_alert=True)
-    active = await db.get_active_auction()
-    if not active or active['auction_id'] != bid['auction_id']:
+    if not finished:
         return await callback.answer("Аукцион уже не активен", show_alert=True)
-
-    await db.finish_auction(active['auction_id'], bid['user_id'], bid['bid_amount'])
-    finished_post_text = await format_auction_post(active, bot,
-                                                   finished=True)  # format_auction_post уже содержит нужную логику
-    try:
-        await bot.edit_message_caption(
-            chat_id=CHANNEL_ID,
-            message_id=active['channel_message_id'],
-            caption=finished_post_text,
-            parse_mode="HTML",
-            reply_markup=None
-        )
-    except TelegramAPIError as e:
-        logging.error(f"Не удалось обновить пост в канале после выбора победителя: {e}")
-    try:
-        await bot.send_message(
-            bid['user_id'],
-            f"🎉 Поздравляем! Вы победили в аукционе «{active['title']}». "
-            f"Ваша ставка: {bid['bid_amount']:,.2f} руб."
-            f"В ближайшее время с вами свяжется администратор для уточнения деталей оплаты и доставки."
-        )
-    except TelegramAPIError as e:
-        logging.warning(f"Не удалось уведомить победителя {bid['user_id']}: {e}")
+    auction_book.drop(active['auction_id'])
 
     # --- ФОРМАТИРОВАНИЕ ИМЕНИ ПОБЕДИТЕЛЯ ДЛЯ АДМИНА ---
     winner_id = bid['user_id']
@@ -1205,7 +1296,7 @@ async def admin_winner_bid(callback: CallbackQuery, bot: Bot):
 
 
 @router.callback_query(F.data.startswith("apply_auction_"))
-async def apply_for_auction(callback: CallbackQuery, bot: Bot):
+async def apply_for_auction(callback: CallbackQuery, bot: Bot, db_session: db.Session):
     """Пользователь подает заявку на участие в аукционе."""
     try:
         auction_id = int(callback.data.split("_")[2])
@@ -1213,18 +1304,20 @@ async def apply_for_auction(callback: CallbackQuery, bot: Bot):
         return await callback.answer("Ошибка ID аукциона.", show_alert=True)
 
     user_id = callback.from_user.id
-    auction = await db.get_active_auction()
+    auction = await db.get_active_auction(conn=db_session)
 
     if not auction or auction['auction_id'] != auction_id:
         return await callback.answer("Аукцион уже завершен.", show_alert=True)
 
     # Проверяем, вдруг уже подал, пока думал
-    status = await db.get_participation_status(user_id, auction_id)
+    status = await db.get_participation_status(user_id, auction_id, conn=db_session)
     if status:
         return await callback.answer("Вы уже подали заявку.", show_alert=True)
 
-    # Подаем заявку
-    await db.apply_for_participation(user_id, auction_id)
+    # Подаем заявку; данные (ФИО, Телефон) для уведомления админа берем сразу, пока соединение у нас
+    await db.apply_for_participation(user_id, auction_id, conn=db_session)
+    user_details = await db.get_user_details(user_id, conn=db_session)
+    await db_session.release()
 
     # Обновляем клавиатуру пользователя на "Ожидание"
     is_admin = int(user_id) in ADMIN_IDS
@@ -1247,9 +1340,7 @@ async def apply_for_auction(callback: CallbackQuery, bot: Bot):
     user_info = callback.from_user
     user_display = f"@{escape(user_info.username)}" if user_info.username else f'<a href="tg://user?id={user_info.id}">{escape(user_info.full_name)}</a>'
 
-    # 2. Получаем данные (ФИО, Телефон) из нашей БД
-    user_details = await db.get_user_details(user_id)
-
+    # 2. Данные (ФИО, Телефон) из нашей БД
     fio_text = "Не указано"
     phone_text = "Не указан"
 
@@ -1273,40 +1364,6 @@ async def apply_for_auction(callback: CallbackQuery, bot: Bot):
         logging.error(f"Не удалось отправить заявку на участие админу: {e}")
 
 
-# --- НОВЫЙ ОБРАБОТЧИК: Админ обновляет меню (если нужно) ---
-async def _try_update_user_menu_on_participation_update(bot: Bot, user_id: int, auction_id: int, new_part_status: str):
-    """(Вспомогательная) Пытается обновить меню пользователя, если он смотрит на этот лот."""
-    try:
-        # Проверяем, что лот, который модерируют, = активный лот
-        active_auction = await db.get_active_auction()
-        if not active_auction or active_auction['auction_id'] != auction_id:
-            return  # Лот уже неактивен, обновлять нечего
-
-        # Проверяем, что меню пользователя = ID лота
-        menu_id = await db.get_user_menu_message_id(user_id)
-        if not menu_id:
-            return  # У пользователя нет активного меню
-
-        # (Мы не можем 100% знать, что menu_id - это карточка аукциона,
-        # но если ID совпали, то 99% это так)
-
-        is_admin = int(user_id) in ADMIN_IDS  # (Будет False)
-        new_kb = kb.get_auction_keyboard(
-            auction_id,
-            active_auction['blitz_price'],
-            participation_status=new_part_status,
-            is_admin=is_admin
-        )
-        await bot.edit_message_reply_markup(
-            chat_id=user_id,
-            message_id=menu_id,
-            reply_markup=new_kb
-        )
-        logging.info(f"Обновлено меню участия (на {new_part_status}) для {user_id}")
-    except TelegramAPIError as e:
-        logging.warning(f"Не удалось 'вживую' обновить меню {user_id} при модерации: {e}")
-
-
 # --- НОВЫЙ ОБРАБОТЧИК: Одобрение участия ---
 @router.callback_query(F.data.startswith("approve_part_"))
 async def approve_participation(callback: CallbackQuery, bot: Bot):
@@ -1322,18 +1379,11 @@ async def approve_participation(callback: CallbackQuery, bot: Bot):
     except Exception:
         return await callback.answer("Ошибка данных.", show_alert=True)
 
-    await db.update_participation_status(user_id, auction_id, 'approved')
+    # Уведомление и обновление меню пользователя выполнит outbox
+    await db.update_participation_status(user_id, auction_id, 'approved', notify=True)
     await callback.message.edit_text(f"✅ Участие для {user_id} в лоте {auction_id} ОДОБРЕНО.")
     await callback.answer("Одобрено!")
 
-    try:
-        await bot.send_message(user_id,
-                               f"✅ Ваша заявка на участие в аукционе одобрена. Теперь вы можете делать ставки.")
-        # Пытаемся обновить меню пользователя "вживую"
-        await _try_update_user_menu_on_participation_update(bot, user_id, auction_id, 'approved')
-    except TelegramAPIError as e:
-        logging.warning(f"Не удалось уведомить {user_id} об одобрении участия: {e}")
-
 
 # --- НОВЫЙ ОБРАБОТЧИК: Отклонение участия (FSM) ---
 @router.callback_query(F.data.startswith("decline_part_"))
@@ -1384,16 +1434,9 @@ async def decline_participation_reason_process(message: Message, state: FSMConte
     no_reason = (reason in ('-', '0', ''))
     reason_text = reason if not no_reason else "Без указания причины"
 
-    await db.update_participation_status(target_user_id, target_auction_id, 'rejected', reason=reason_text)
-
-    # Уведомляем пользователя
-    try:
-        notify_text = f"❌ Ваша заявка на участие в аукционе отклонена.\nПричина: {escape(reason_text)}"
-        await bot.send_message(target_user_id, notify_text)
-        # Пытаемся обновить меню пользователя "вживую"
-        await _try_update_user_menu_on_participation_update(bot, target_user_id, target_auction_id, 'rejected')
-    except TelegramAPIError as e:
-        logging.error(f"Не удалось уведомить {target_user_id} об отклонении участия: {e}")
+    # Уведомление и обновление меню пользователя выполнит outbox
+    await db.update_participation_status(target_user_id, target_auction_id, 'rejected', reason=reason_text,
+                                         notify=True)
 
     # Возвращаем админа в админ-меню
     await state.clear()
@@ -1412,12 +1455,12 @@ async def decline_participation_reason_process(message: Message, state: FSMConte
 
 
 @router.callback_query(F.data.startswith("bid_auction_"))
-async def make_bid_start(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def make_bid_start(callback: CallbackQuery, state: FSMContext, bot: Bot, db_session: db.Session):
     """Начало процесса ставки (FSM)."""
     auction_id = int(callback.data.split("_")[2])
-    auction = await db.get_active_auction()
+    book = await auction_book.get_book(auction_id)
 
-    if not auction or auction['auction_id'] != auction_id:
+    if not book:
         await callback.answer("Аукцион уже завершен или неактивен.", show_alert=True)
         try:
             await callback.message.delete()
@@ -1428,7 +1471,8 @@ async def make_bid_start(callback: CallbackQuery, state: FSMContext, bot: Bot):
     user_id = callback.from_user.id
     is_admin = int(user_id) in ADMIN_IDS
     if not is_admin:  # Админов пропускаем
-        part_status = await db.get_participation_status(user_id, auction_id)
+        part_status = await db.get_participation_status(user_id, auction_id, conn=db_session)
+        await db_session.release()  # Дальше проверка подписки и правка карточки — только Telegram
 
         if part_status == 'pending':
             return await callback.answer("Ваша заявка на участие еще на рассмотрении.", show_alert=True)
@@ -1456,13 +1500,14 @@ async def make_bid_start(callback: CallbackQuery, state: FSMContext, bot: Bot):
         return
 
     # Проверка интервала (cooldown)
+    auction = book.auction
     end_time_dt = auction['end_time']
     time_to_end = end_time_dt - datetime.now(end_time_dt.tzinfo)
     cooldown_off_before_end = int(auction.get('cooldown_off_before_end_minutes') or 0)
     cooldown_minutes = int(auction.get('cooldown_minutes') or 0)
 
     if cooldown_minutes > 0 and time_to_end > timedelta(minutes=cooldown_off_before_end):
-        last_bid_time = await db.get_user_last_bid_time(callback.from_user.id, auction_id)
+        last_bid_time = book.user_last_bid_time(callback.from_user.id)
         if last_bid_time:
             elapsed = datetime.now(last_bid_time.tzinfo) - last_bid_time
             if elapsed < timedelta(minutes=cooldown_minutes):
@@ -1480,15 +1525,12 @@ async def make_bid_start(callback: CallbackQuery, state: FSMContext, bot: Bot):
         menu_message_id=callback.message.message_id
     )
 
-    last_bid = await db.get_last_bid(auction_id)
-    current_price = last_bid['bid_amount'] if last_bid else auction['start_price']
-
     # Редактируем карточку, запрашивая ставку
     await callback.bot.edit_message_caption(
         chat_id=callback.message.chat.id,
         message_id=callback.message.message_id,
         caption=(
-            f"Текущая ставка: {current_price:,.0f} руб.\n"
+            f"Текущая ставка: {book.current_price:,.0f} руб.\n"
             f"Минимальный шаг: {auction['min_step']:,.0f} руб.\n\n"
             f"{hbold('Введите вашу ставку (число):')}"
         ),
@@ -1548,7 +1590,7 @@ async def check_subscription_generic(callback: CallbackQuery, bot: Bot, state: F
     Показывает алерт, если не подписан, НЕ редактируя сообщение.
     """
     user_id = callback.from_user.id
-    subscribed = await is_user_subscribed(bot, user_id)
+    subscribed = await is_user_subscribed(bot, user_id, use_cache=False)
     channel_url = f"https://t.me/{CHANNEL_USERNAME}" if CHANNEL_USERNAME else "https://t.me/test_auction2"  # Fallback URL
 
     if subscribed:
@@ -1594,7 +1636,7 @@ async def check_subscription_generic(callback: CallbackQuery, bot: Bot, state: F
 async def check_subscription_auction(callback: CallbackQuery, bot: Bot, state: FSMContext):
     """Проверка подписки (на карточке аукциона)."""
     user_id = callback.from_user.id
-    subscribed = await is_user_subscribed(bot, user_id)
+    subscribed = await is_user_subscribed(bot, user_id, use_cache=False)
 
     if subscribed:
         # Возвращаем на карточку аукциона
@@ -1661,6 +1703,7 @@ async def blitz_buy_confirm_request(callback: CallbackQuery, bot: Bot, state: FS
 
 # 2. ДОБАВЬТЕ ЭТОТ НОВЫЙ ОБРАБОТЧИК (после функции выше)
 @router.callback_query(F.data.startswith("confirm_blitz_"))
+@with_priority(Priority.HIGH)
 async def blitz_buy_execute(callback: CallbackQuery, bot: Bot, state: FSMContext):
     """
     Выполнение блиц-покупки (после подтверждения кнопкой "Да, купить").
@@ -1677,18 +1720,72 @@ async def blitz_buy_execute(callback: CallbackQuery, bot: Bot, state: FSMContext
         return
 
     # Вызываем нашу новую общую функцию
-    await _execute_blitz_purchase(
+    purchased = await _execute_blitz_purchase(
         bot=bot,
         auction=auction,
         user_id=callback.from_user.id,
         chat_id=callback.message.chat.id,
         message_id_to_edit=callback.message.message_id
     )
+    if not purchased:
+        await callback.answer("Аукцион уже завершен или неактивен.", show_alert=True)
+        return
 
     await callback.answer("Покупка по блиц-цене оформлена!", show_alert=True)
 
 
+async def _apply_bid_in_lane(bot: Bot, book: auction_book.LiveAuctionBook, user_id: int, bid_amount: float):
+    """
+    Записывает ставку и выполняет связанные с ней действия: обновление книги лота и таймера закрытия,
+    запрос на обновление поста в канале (уведомление перебитого лидера place_bid пишет в outbox).
+    Вызывается через bid_lanes, поэтому для одного лота эти шаги не перемешиваются между ставками.
+    Возвращает результат place_bid_atomic.
+    """
+    auction = book.auction
+    result = await db.place_bid_atomic(
+        auction['auction_id'], user_id, bid_amount,
+        snipe_window=ANTI_SNIPE_WINDOW, snipe_extension=ANTI_SNIPE_EXTENSION
+    )
+    if result['outcome'] != db.BidOutcome.ACCEPTED:
+        return result
+
+    # --- Ставка принята ---
+    previous_end_time = auction['end_time']
+    auction_book.apply_bid(result['bid'], end_time=result['end_time'])
+    # Антиснайпинг [cite: 203] (продление уже записано в БД функцией place_bid)
+    if result['end_time'] != previous_end_time:
+        auction_timers.arm(auction['auction_id'], result['end_time'])
+
+    # Предыдущего лидера [cite: 204-205] уведомляет outbox (событие записано функцией place_bid)
+
+    # Обновляем главный пост в канале [cite: 206] (в фоне, текст берется из книги в момент отправки)
+    channel_updater.request(bot, auction['channel_message_id'], lambda: _render_live_post(auction['auction_id'], bot))
+    return result
+
+
+async def _show_bid_too_low(bot: Bot, chat_id: int, menu_message_id: int, auction: dict, current_price: float):
+    """Показывает в карточке ставки ошибку "ставка меньше минимальной"."""
+    try:
+        min_bid_value = current_price + auction['min_step']
+        error_text = f"Ошибка! Ваша ставка должна быть как минимум {min_bid_value:,.0f} руб."
+        await bot.edit_message_caption(
+            chat_id=chat_id,
+            message_id=menu_message_id,
+            caption=(
+                f"Текущая ставка: {current_price:,.0f} руб.\n"
+                f"Минимальный шаг: {auction['min_step']:,.0f} руб.\n\n"
+                f"{hbold(error_text)}"
+            ),
+            parse_mode="HTML",
+            reply_markup=kb.cancel_fsm_keyboard(f"show_auction_{auction['auction_id']}")
+        )
+    except TelegramAPIError:
+        pass
+
+
+# Без ограничения частоты: отброшенная сумма осталась бы без ответа, а ставки и так идут по очереди лота
 @router.message(StateFilter(Bidding.waiting_for_bid_amount), F.text)
+@with_priority(Priority.HIGH)
 async def process_bid_amount(message: Message, state: FSMContext, bot: Bot):
     """Обработка введенной суммы ставки (с проверкой на блиц-цену)."""
 
@@ -1701,9 +1798,9 @@ async def process_bid_amount(message: Message, state: FSMContext, bot: Bot):
     menu_message_id = data.get('menu_message_id')
     auction_id = data.get('auction_id')
 
-    auction = await db.get_active_auction()
+    book = await auction_book.get_book(auction_id) if auction_id else None
 
-    if not auction or auction['auction_id'] != auction_id:
+    if not book:
         await state.clear()
         try:
             await bot.edit_message_text(
@@ -1722,8 +1819,8 @@ async def process_bid_amount(message: Message, state: FSMContext, bot: Bot):
         if bid_amount <= 0: raise ValueError("Bid must be positive")
     except ValueError:
         # (Логика отображения ошибки... [cite: 195-196])
-        last_bid = await db.get_last_bid(auction_id)
-        current_price = last_bid['bid_amount'] if last_bid else auction['start_price']
+        auction = book.auction
+        current_price = book.current_price
         try:
             await bot.edit_message_caption(
                 chat_id=message.chat.id,
@@ -1740,84 +1837,56 @@ async def process_bid_amount(message: Message, state: FSMContext, bot: Bot):
             pass
         return
 
-    # --- НОВАЯ ПРОВЕРКА НА БЛИЦ-ЦЕНУ ---
+    # Быстрая проверка по книге лота (без БД). Окончательно ставку проверяет place_bid_atomic.
+    auction = book.auction
     blitz_price = auction.get('blitz_price')
-    if blitz_price and bid_amount >= blitz_price:
-        logging.info(f"Пользователь {message.from_user.id} активировал блиц-цену ставкой {bid_amount}")
-        await state.clear()
-
-        # Вызываем нашу новую общую функцию
-        await _execute_blitz_purchase(
-            bot=bot,
-            auction=auction,
-            user_id=message.from_user.id,
-            chat_id=message.chat.id,
-            message_id_to_edit=menu_message_id
-        )
-        # Завершаем выполнение функци
+    is_blitz = bool(blitz_price) and bid_amount >= blitz_price
+    if not is_blitz and bid_amount < book.min_next_bid:
+        await _show_bid_too_low(bot, message.chat.id, menu_message_id, auction, book.current_price)
         return
-    # --- КОНЕЦ НОВОЙ ПРОВЕРКИ ---
 
-    last_bid = await db.get_last_bid(auction['auction_id'])
-    current_price = last_bid['bid_amount'] if last_bid else auction['start_price']
+    # Ставки на один лот применяются строго по очереди (см. _apply_bid_in_lane)
+    result = await bid_lanes.submit(
+        auction_id, _apply_bid_in_lane, bot, book, message.from_user.id, bid_amount
+    )
+    outcome = result['outcome']
 
-    # Проверка минимальной ставки [cite: 199-202]
-    if bid_amount < current_price + auction['min_step']:
+    if outcome == db.BidOutcome.TOO_LOW:
+        # Цена успела вырасти (ставка другого участника)
+        await _show_bid_too_low(bot, message.chat.id, menu_message_id, auction, result['current_price'])
+        return
+
+    if outcome not in (db.BidOutcome.ACCEPTED, db.BidOutcome.BLITZ):
+        if outcome != db.BidOutcome.ENDED:
+            auction_book.drop(auction_id)  # Лот уже закрыт (например, блиц-покупкой)
+        await state.clear()
         try:
-            min_bid_value = current_price + auction['min_step']
-            error_text = f"Ошибка! Ваша ставка должна быть как минимум {min_bid_value:,.0f} руб."
-            await bot.edit_message_caption(
+            await bot.edit_message_text(
                 chat_id=message.chat.id,
                 message_id=menu_message_id,
-                caption=(
-                    f"Текущая ставка: {current_price:,.0f} руб.\n"
-                    f"Минимальный шаг: {auction['min_step']:,.0f} руб.\n\n"
-                    f"{hbold(error_text)}"
-                ),
-                parse_mode="HTML",
-                reply_markup=kb.cancel_fsm_keyboard(f"show_auction_{auction_id}")
+                text="Аукцион завершился, пока вы делали ставку.",
+                reply_markup=kb.back_to_menu_keyboard()
             )
         except TelegramAPIError:
             pass
         return
 
-    # --- Ставка принята (логика без изменений) ---
     await state.clear()
-    previous_leader = last_bid['user_id'] if last_bid else None
-    await db.add_bid(auction['auction_id'], message.from_user.id, bid_amount)
-
-    # Антиснайпинг [cite: 203]
-    try:
-        end_dt = auction['end_time']
-        now_dt = datetime.now(end_dt.tzinfo)
-        if (end_dt - now_dt) <= timedelta(minutes=2):
-            new_end = end_dt + timedelta(minutes=2)
-            await db.update_auction_end_time(auction['auction_id'], new_end)
-            auction = await db.get_active_auction()
-    except Exception as e:
-        logging.warning(f"Антиснайпинг не сработал: {e}")
 
-    # Уведомляем предыдущего лидера [cite: 204-205]
-    if previous_leader and previous_leader != message.from_user.id:
-        try:
-            await bot.send_message(previous_leader,
-                                   f"❗️ Вашу ставку на аукционе '{escape(auction['title'])}' перебили! Новая ставка: {bid_amount:,.0f} руб.")
-        except TelegramAPIError as e:
-            logging.warning(f"Не удалось уведомить пользователя {previous_leader}: {e}")
-
-    # Обновляем главный пост в канале [cite: 206]
-    new_text_channel = await format_auction_post(auction, bot)
-    try:
-        await bot.edit_message_caption(
-            chat_id=CHANNEL_ID,
-            message_id=auction['channel_message_id'],
-            caption=new_text_channel,
-            parse_mode="HTML"
+    # --- БЛИЦ-ЦЕНА: лот куплен, аукцион уже завершен в БД ---
+    if outcome == db.BidOutcome.BLITZ:
+        logging.info(f"Пользователь {message.from_user.id} активировал блиц-цену ставкой {bid_amount}")
+        await _announce_blitz_purchase(
+            bot=bot,
+            auction=auction,
+            bid=result['bid'],
+            chat_id=message.chat.id,
+            message_id_to_edit=menu_message_id
         )
-    except TelegramAPIError as e:
-        logging.error(f"Не удалось обновить пост в канале {CHANNEL_ID}: {e}")
+        return
 
-    # Обновляем приватную карточку [cite: 207]
+    # Обновляем приватную карточку [cite: 207] (текст из книги лота, без БД)
+    new_text_channel = await format_auction_post(auction, bot)
     new_text_private = f"✅ Ваша ставка: {bid_amount:,.0f} руб.\n\n" + new_text_channel
     try:
         is_admin = int(message.from_user.id) in ADMIN_IDS
@@ -1954,17 +2023,9 @@ async def admin_unban_handle(message: Message, state: FSMContext, bot: Bot):
 
 
 async def _update_all_posts(bot: Bot, auction: dict):
-    """Обновляет пост в канале и возвращает обновленный текст."""
+    """Ставит пост в канале в очередь на обновление и возвращает обновленный текст."""
     new_text_channel = await format_auction_post(auction, bot)
-    try:
-        await bot.edit_message_caption(
-            chat_id=CHANNEL_ID,
-            message_id=auction['channel_message_id'],
-            caption=new_text_channel,
-            parse_mode="HTML"
-        )
-    except TelegramAPIError as e:
-        logging.error(f"Не удалось обновить пост в канале {CHANNEL_ID} после ред.: {e}")
+    channel_updater.request(bot, auction['channel_message_id'], lambda: _render_live_post(auction['auction_id'], bot))
     return new_text_channel
 
 
@@ -2033,6 +2094,7 @@ async def process_new_title(message: Message, state: FSMContext, bot: Bot):
         return
 
     await db.update_auction_title(auction_id, new_title)
+    auction_book.update_auction(auction_id, title=new_title)
     await state.clear()
 
     auction = await db.get_active_auction()
@@ -2067,6 +2129,7 @@ async def process_new_description(message: Message, state: FSMContext, bot: Bot)
         return
 
     await db.update_auction_description(auction_id, new_desc)
+    auction_book.update_auction(auction_id, description=new_desc)
     await state.clear()
 
     auction = await db.get_active_auction()
@@ -2116,20 +2179,12 @@ async def bulk_approve_pending(callback: CallbackQuery, bot: Bot):
     user_ids = [user['user_id'] for user in pending_users]
     updated_count = await db.bulk_update_user_status(user_ids, 'approved')
 
-    # Уведомляем пользователей
-    notification_errors = 0
-    for user_id in user_ids:
-        try:
-            # Отправляем стандартное сообщение с главным меню
-            await bot.send_message(user_id, APPROVAL_MESSAGE, reply_markup=kb.get_main_menu())
-        except TelegramAPIError:
-            notification_errors += 1
-            logging.warning(f"Не удалось уведомить пользователя {user_id} при массовом одобрении.")
-
-    alert_text = f"Одобрено {updated_count} пользователей."
-    if notification_errors > 0:
-        alert_text += f" Не удалось уведомить {notification_errors}."
-    await callback.answer(alert_text, show_alert=True)
+    # Уведомляем пользователей в фоне (стандартное сообщение с главным меню), прогресс — отдельным сообщением
+    await broadcast.start_broadcast(
+        bot, "Уведомления об одобрении", APPROVAL_MESSAGE, user_ids,
+        reply_markup=kb.get_main_menu(), report_chat_id=callback.from_user.id
+    )
+    await callback.answer(f"Одобрено {updated_count} пользователей. Уведомления отправляются.", show_alert=True)
 
 
 @router.callback_query(F.data == "admin_bulk_decline")
@@ -2145,20 +2200,13 @@ async def bulk_decline_pending(callback: CallbackQuery, bot: Bot):
     user_ids = [user['user_id'] for user in pending_users]
     updated_count = await db.bulk_update_user_status(user_ids, 'banned')  # Ставим статус banned
 
-    # Уведомляем пользователей
-    notification_errors = 0
-    for user_id in user_ids:
-        try:
-            # Отправляем стандартное сообщение об отклонении
-            await bot.send_message(user_id, REJECTION_MESSAGE)
-        except TelegramAPIError:
-            notification_errors += 1
-            logging.warning(f"Не удалось уведомить пользователя {user_id} при массовом отклонении.")
-
-    alert_text = f"Отклонено (забанено) {updated_count} пользователей."
-    if notification_errors > 0:
-        alert_text += f" Не удалось уведомить {notification_errors}."
-    await callback.answer(alert_text, show_alert=True)
+    # Уведомляем пользователей в фоне (стандартное сообщение об отклонении)
+    await broadcast.start_broadcast(
+        bot, "Уведомления об отклонении", REJECTION_MESSAGE, user_ids,
+        report_chat_id=callback.from_user.id
+    )
+    await callback.answer(f"Отклонено (забанено) {updated_count} пользователей. Уведомления отправляются.",
+                          show_alert=True)
 
 
 # --- 6. СОЗДАНИЕ АУКЦИОНА (ИНЛАЙН FSM) ---
@@ -2550,6 +2598,8 @@ async def confirm_auction_post(callback: CallbackQuery, state: FSMContext, bot:
                 caption=text, parse_mode="HTML"
             )
         await db.set_auction_message_id(auction_id, sent_message.message_id)
+        auction_book.update_auction(auction_id, channel_message_id=sent_message.message_id)
+        auction_timers.arm(auction_id, auction_data_full['end_time'])
         try:
             await bot.delete_message(chat_id=callback.message.chat.id, message_id=menu_message_id)
         except TelegramAPIError:
@@ -2696,31 +2746,32 @@ async def finish_auction_command(message: Message, bot: Bot):
         await message.answer("Нет активных аукционов для завершения.")
         return
     auction_id = active_auction['auction_id']
-    last_bid = await db.get_last_bid(auction_id)
+    snapshot = await db.get_auction_snapshot(auction_id, top_n=1)
+    last_bid = snapshot['leader'] if snapshot else None
     winner_id = last_bid['user_id'] if last_bid else None
     final_price = last_bid['bid_amount'] if last_bid else None
-    await db.finish_auction(auction_id, winner_id, final_price)
+    # Финальный пост в канале и поздравление победителю отправляет outbox (см. outbox.py)
+    if not await db.finish_auction(auction_id, winner_id, final_price):
+        await message.answer("Аукцион уже не активен.")
+        return
+    auction_book.drop(auction_id)
     await message.answer(f"✅ Аукцион «{active_auction['title']}» принудительно завершен.")
-    finished_post_text = await format_auction_post(active_auction, bot, finished=True)
-    try:
-        await bot.edit_message_caption(
-            chat_id=CHANNEL_ID,
-            message_id=active_auction['channel_message_id'],
-            caption=finished_post_text,
-            parse_mode="HTML",
-            reply_markup=None
-        )
-    except TelegramAPIError as e:
-        logging.error(f"Не удалось обновить пост в канале после завершения: {e}")
-    if winner_id:
-        try:
-            await bot.send_message(
-                winner_id,
-                f"🎉 Поздравляем! Вы победили в аукционе «{(active_auction['title'])}»!\n\n"
-                f"Ваша выигрышная ставка: {final_price:,.2f} руб.\n\n"
-                f"В ближайшее время с вами свяжется администратор для уточнения деталей оплаты и доставки."
-            )
-        except TelegramAPIError as e:
-            logging.error(f"Не удалось уведомить победителя {winner_id}: {e}")
-            await message.answer(
-                f"❗️ Не удалось отправить уведомление победителю {winner_id}. Свяжитесь с ним вручную.")
+
+
+# --- 10. МЕТРИКИ ПРОЦЕССА (КОМАНДА) ---
+
+@router.message(Command("stats"), F.from_user.id.in_(ADMIN_IDS))
+async def stats_command(message: Message):
+    """
+    /stats — роль процесса в кластере (кто ведущий) и список разделов метрик; /stats <раздел> — раздел.
+    В кластере отвечает воркер, к которому маршрутизатор направляет админа (метрики всех — GET /metrics).
+    """
+    parts = (message.text or "").split(maxsplit=1)
+    section = parts[1].strip() if len(parts) > 1 else "cluster"
+    if section not in metrics.sections():
+        await message.answer(f"Нет раздела «{escape(section)}». Разделы: {', '.join(metrics.sections())}")
+        return
+    text = metrics.dumps(metrics.collect([section]), indent=1)
+    if len(text) > 3900:
+        text = text[:3900] + "\n..."
+    await message.answer(f"<pre>{escape(text)}</pre>\nРазделы: {', '.join(metrics.sections())}")
@@ -0,0 +1,158 @@
+# leader.py
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import asyncpg
+
+import db
+
+# Ключ advisory lock ведущего процесса: только он закрывает лоты по таймерам и запускает
+# страховочную проверку (несколько процессов бота не должны завершать один лот дважды)
+LEADER_LOCK_KEY = 7_305_002
+# Как часто ведомые процессы пытаются стать ведущим
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", "5"))
+# Как часто ведущий проверяет соединение с блокировкой (сек) и сколько ждет ответа
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", "5"))
+LEADER_CHECK_TIMEOUT = float(os.getenv("LEADER_CHECK_TIMEOUT", "5"))
+
+# Кто держит блокировку (поиск по application_name соединения ведущего)
+LEADER_HOLDER_SQL = """
+    SELECT a.application_name
+    FROM pg_locks l
+    JOIN pg_stat_activity a ON a.pid = l.pid
+    WHERE l.locktype = 'advisory' AND l.granted
+      AND l.classid = 0 AND l.objid = $1::BIGINT::OID AND l.objsubid = 1
+"""
+
+# Блокировка держится на отдельном соединении (не из пула): пока оно открыто, процесс — ведущий.
+# Если процесс ведущего завершится или его соединение оборвется, БД снимет блокировку, и ее возьмет
+# один из ведомых. TCP keepalive на стороне сервера обнаруживает "молча" пропавшего ведущего.
+_LEADER_CONN_SETTINGS = {'tcp_keepalives_idle': '10', 'tcp_keepalives_interval': '5', 'tcp_keepalives_count': '3'}
+
+_conn: Optional[asyncpg.Connection] = None
+_task: Optional[asyncio.Task] = None
+_is_leader = False
+# Метрики (см. stats): кто ведущий по последним данным, с какого момента, сколько раз менялась роль
+_state: Dict[str, Any] = {'leader_node': None, 'since': None, 'elections': 0, 'stepdowns': 0}
+
+Callback = Callable[[], Awaitable[None]]
+
+
+def is_leader() -> bool:
+    return _is_leader
+
+
+def stats() -> Dict[str, Any]:
+    """Роль процесса и имя ведущего процесса кластера (NODE_ID)."""
+    return {
+        'node': db.NODE_ID,
+        'is_leader': _is_leader,
+        'leader_node': _state['leader_node'],
+        'since': _state['since'].isoformat() if _state['since'] else None,
+        'elections': _state['elections'],
+        'stepdowns': _state['stepdowns'],
+    }
+
+
+def _drop_connection():
+    global _conn
+    if _conn is not None:
+        _conn.terminate()  # Закрытие соединения снимает блокировку, если она еще держится
+        _conn = None
+
+
+async def _try_acquire() -> bool:
+    global _conn
+    if _conn is None or _conn.is_closed():
+        _conn = await db.connect("leader", **_LEADER_CONN_SETTINGS)
+    return await _conn.fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_KEY)
+
+
+async def _leader_node() -> Optional[str]:
+    name = await _conn.fetchval(LEADER_HOLDER_SQL, LEADER_LOCK_KEY)
+    prefix = f"{db.DB_APPLICATION_NAME}:leader:"
+    return name[len(prefix):] if name and name.startswith(prefix) else name
+
+
+async def _call(callback: Optional[Callback], action: str):
+    if callback is None:
+        return
+    try:
+        await callback()
+    except Exception as e:
+        logging.error(f"Ошибка при {action} ведущего процесса: {e}")
+
+
+async def _become_leader(on_elected: Optional[Callback]):
+    global _is_leader
+    _is_leader = True
+    _state.update(leader_node=db.NODE_ID, since=datetime.now(timezone.utc), elections=_state['elections'] + 1)
+    logging.info(f"Процесс {db.NODE_ID} стал ведущим: закрытие лотов и планировщик работают здесь.")
+    await _call(on_elected, "запуске")
+
+
+async def _step_down(on_demoted: Optional[Callback], reason: Exception):
+    global _is_leader
+    _is_leader = False
+    _drop_connection()
+    _state.update(leader_node=None, since=None, stepdowns=_state['stepdowns'] + 1)
+    logging.warning(f"Процесс {db.NODE_ID} больше не ведущий (соединение с блокировкой потеряно: {reason}).")
+    await _call(on_demoted, "остановке")
+
+
+async def _campaign_once(on_elected: Optional[Callback]):
+    try:
+        if await _try_acquire():
+            await _become_leader(on_elected)
+        else:
+            _state['leader_node'] = await _leader_node()
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+        logging.warning(f"Не удалось проверить блокировку ведущего: {e}")
+        _drop_connection()
+
+
+async def _run(on_elected: Optional[Callback], on_demoted: Optional[Callback]):
+    while True:
+        if not _is_leader:
+            await asyncio.sleep(LEADER_RETRY_INTERVAL)
+            await _campaign_once(on_elected)
+            continue
+        await asyncio.sleep(LEADER_CHECK_INTERVAL)
+        try:
+            await _conn.fetchval("SELECT 1", timeout=LEADER_CHECK_TIMEOUT)
+        except Exception as e:
+            # Блокировка могла уже перейти к другому процессу — уступаем сразу, не дожидаясь переподключения
+            await _step_down(on_demoted, e)
+
+
+async def start(on_elected: Optional[Callback] = None, on_demoted: Optional[Callback] = None):
+    """
+    Участвует в выборах ведущего: on_elected() вызывается, когда процесс стал ведущим,
+    on_demoted() — когда перестал (потеряно соединение с блокировкой), после чего попытки продолжаются.
+    Первая попытка — сразу (единственный процесс становится ведущим еще до приема обновлений),
+    следующие — в фоне раз в LEADER_RETRY_INTERVAL секунд.
+    """
+    global _task
+    if _task is not None:
+        return
+    await _campaign_once(on_elected)
+    if not _is_leader:
+        logging.info(f"Процесс {db.NODE_ID} — ведомый (ведущий: {_state['leader_node'] or 'неизвестен'}).")
+    _task = asyncio.create_task(_run(on_elected, on_demoted))
+
+
+async def stop():
+    """Прекращает участие в выборах и отпускает блокировку (закрытием соединения)."""
+    global _task, _conn, _is_leader
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    if _conn is not None:
+        await _conn.close(timeout=LEADER_CHECK_TIMEOUT)
+        _conn = None
+    _is_leader = False
+    _state.update(leader_node=None, since=None)
@@ -1,20 +1,46 @@
 # main.py
+import argparse
 import asyncio
 import logging
 import os
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
 
 from aiogram.client.default import DefaultBotProperties
-from collections import defaultdict
+from apscheduler.schedulers.base import STATE_PAUSED
 from dotenv import load_dotenv
 
-from handlers import router
+import auction_book
+import auction_timers
+import bid_lanes
+import broadcast
+import cluster
+import db
+import leader
+import metrics
+import outbox
+import queries
+import throttling
+from fsm_storage import FSM_CACHE_TTL, PostgresStorage
+from handlers import router, bot_identity
+from rate_limiter import rate_limiter
 from db import init_db
-from scheduler import setup_scheduler
+from scheduler import setup_scheduler, check_auctions
+from webhook import WEBHOOK_BASE_URL, run_webhook
 
 
-async def main():
+async def on_shutdown():
+    """Выполняется при остановке поллинга: останавливает фоновые задачи и дописывает отложенные данные в БД."""
+    await broadcast.stop_broadcasts()
+    await outbox.stop_dispatcher()
+    await throttling.stop_cleanup()
+    await leader.stop()
+    await cluster.stop_sync()
+    await db.stop_tg_details_flusher()
+    await db.stop_pool_monitor()
+
+
+async def main(mode: str = "polling"):
     # Настройка логирования
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
 
@@ -29,21 +55,87 @@ async def main():
     # --- ИЗМЕНЕНО ---
     bot = Bot(token=bot_token, default=DefaultBotProperties(parse_mode="HTML"))
     # ---
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-    dp["last_start_time"] = defaultdict(float)
+    # Лимиты Telegram на отправку (глобальный, по чатам, для канала) и повторы после 429
+    bot.session.middleware(rate_limiter)
+    # Состояния FSM — в PostgreSQL (переживают перезапуск, общие для процессов); memory — для отладки.
+    # Кэш чтения FSM — если обновления получает только этот процесс (поллинг) или кэши других процессов
+    # сбрасываются синхронизацией кластера; у реплик вебхука без синхронизации кэша нет
+    fsm_cache_ttl = FSM_CACHE_TTL if mode == "polling" or cluster.CLUSTER_SYNC else 0
+    storage = (MemoryStorage() if os.getenv("FSM_STORAGE", "postgres") == "memory"
+               else PostgresStorage(cache_ttl=fsm_cache_ttl))
+    # Вебхук обрабатывает обновления параллельно: обновления одного пользователя — строго по очереди
+    dp = Dispatcher(storage=storage, events_isolation=SimpleEventIsolation() if mode == "webhook" else None)
     # Подключение роутера
     dp.include_router(router)
+    dp.shutdown.register(on_shutdown)
+
+    if mode == "router":
+        # Маршрутизатор кластера только пересылает обновления воркерам (см. cluster.py)
+        await cluster.run_router(dp, bot)
+        return
+    if mode == "webhook" and not WEBHOOK_BASE_URL and not cluster.CLUSTER_SYNC:
+        # Вебхук регистрирует другой процесс — этот работает одной из реплик. Книги лотов и кэш статусов
+        # пользователей в памяти узнают о ставках и банах на других репликах только через синхронизацию:
+        # без нее кулдаун обходится переходом на другую реплику, а бан доходит до нее не сразу
+        raise RuntimeError("Для реплики вебхука (без WEBHOOK_BASE_URL) включите CLUSTER_SYNC=true в .env")
+
+    # Метрики процесса: команда /stats и GET /metrics в режиме webhook (см. metrics.py)
+    metrics.register("cluster", cluster.cluster_stats)
+    metrics.register("db_pool", db.pool_stats)
+    metrics.register("queries", queries.query_stats)
+    metrics.register("user_status_cache", db.user_status_cache.stats)
+    metrics.register("bid_lanes", bid_lanes.lane_stats)
+    metrics.register("telegram_limits", rate_limiter.stats)
+    metrics.register("throttling", throttling.throttle_stats)
+
+    # Данные бота (username для deep link) запрашиваем один раз
+    await bot_identity.resolve(bot)
 
     # Инициализация базы данных
     await init_db()
+    db.start_pool_monitor()
+    if isinstance(storage, PostgresStorage):
+        storage.start_cleanup()  # Остановится в dp.shutdown (storage.close)
+    throttling.start_cleanup()
+    db.start_tg_details_flusher()
+    if cluster.CLUSTER_SYNC:
+        # Ставки и изменения лотов от других процессов бота (до загрузки книг, чтобы ничего не пропустить)
+        await cluster.start_sync()
+    # Книги активных лотов (цена, лидер, кулдауны) — в память
+    await auction_book.hydrate()
 
-    # Настройка и запуск планировщика
+    # Настройка планировщика
     # --- ИЗМЕНЕНО: передаем bot ---
     scheduler = setup_scheduler(bot, timezone="Europe/Moscow")
-    scheduler.start()
 
-    logging.info("Бот запускается...")
+    async def on_elected():
+        # Планировщик, закрытие лотов и рассылки работают только на ведущем процессе (см. leader.py)
+        if scheduler.state == STATE_PAUSED:
+            scheduler.resume()
+        else:
+            scheduler.start()
+        # Закрываем лоты, истекшие пока бот был выключен, и выставляем таймеры закрытия для идущих лотов
+        await check_auctions(bot)
+        # Рассылки, прерванные прошлой остановкой, продолжаем с места остановки; новые задания
+        # (в том числе созданные на ведомых процессах) ведущий подхватывает сам (см. setup_scheduler)
+        await broadcast.resume_broadcasts(bot)
+
+    async def on_demoted():
+        # Роль перешла к другому процессу: он же продолжит рассылки с места остановки.
+        # Таймеры закрытия снимаем, иначе при новом избрании сработали бы устаревшие
+        scheduler.pause()
+        auction_timers.disarm_all()
+        await broadcast.stop_broadcasts()
+
+    await leader.start(on_elected, on_demoted)
+    # Уведомления из outbox (в том числе не отправленные до перезапуска)
+    outbox.start_dispatcher(bot)
+
+    logging.info(f"Бот запускается (режим {mode})...")
+    if mode == "webhook":
+        # Обновления приходят на aiohttp-сервер (см. webhook.py)
+        await run_webhook(dp, bot)
+        return
     # Удаление вебхуков перед запуском
     await bot.delete_webhook(drop_pending_updates=True)
     # Запуск поллинга
@@ -51,7 +143,12 @@ async def main():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("polling", "webhook", "router"), default=os.getenv("BOT_MODE", "polling"),
+                        help="получение обновлений: long polling, вебхук (aiohttp-сервер) "
+                             "или маршрутизатор кластера (пересылает обновления воркерам)")
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.mode))
     except (KeyboardInterrupt, SystemExit):
         logging.info("Бот остановлен.")
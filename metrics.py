@@ -0,0 +1,61 @@
+# metrics.py
+import hmac
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, Optional
+
+from aiohttp import web
+
+# Метрики процесса: источники (имя -> функция без аргументов, возвращающая JSON-совместимый dict)
+# подключаются при старте (main.py, webhook.py, cluster.py). Смотреть их можно командой /stats
+# (админам) и, в режимах webhook и router, по HTTP: GET METRICS_PATH на том же порту, что и вебхук.
+# Если задан METRICS_TOKEN, запрос должен прийти с заголовком "Authorization: Bearer <токен>"
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+Source = Callable[[], Any]
+_sources: Dict[str, Source] = {}
+
+
+def register(name: str, source: Source):
+    """Подключает источник метрик (повторная регистрация имени заменяет источник)."""
+    _sources[name] = source
+
+
+def sections():
+    return list(_sources)
+
+
+def collect(names: Optional[list] = None) -> Dict[str, Any]:
+    """Текущие значения источников names (по умолчанию — всех). Ошибка одного источника не мешает остальным."""
+    result = {}
+    for name in names or _sources:
+        source = _sources.get(name)
+        if source is None:
+            continue
+        try:
+            result[name] = source()
+        except Exception as e:
+            logging.error(f"Метрики {name} недоступны: {e}")
+            result[name] = {'error': str(e)}
+    return result
+
+
+def dumps(data: Any, indent: Optional[int] = None) -> str:
+    return json.dumps(data, ensure_ascii=False, indent=indent, default=str)
+
+
+async def handle(request: web.Request) -> web.Response:
+    if METRICS_TOKEN:
+        expected = f"Bearer {METRICS_TOKEN}".encode()
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), expected):
+            return web.Response(status=401)
+    names = request.query.get("sections")
+    return web.json_response(collect(names.split(",") if names else None), dumps=dumps)
+
+
+def add_route(app: web.Application):
+    """Отдает метрики на GET METRICS_PATH (пустой METRICS_PATH — не отдавать)."""
+    if METRICS_PATH:
+        app.router.add_get(METRICS_PATH, handle)
@@ -0,0 +1,376 @@
+# migrations.py
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Tuple
+
+import asyncpg
+
+import queries
+
+# Ключ advisory lock: несколько процессов бота не применяют миграции одновременно
+MIGRATIONS_LOCK_KEY = 7_305_001
+
+# Миграции схемы: (версия, название, список SQL-команд). Только добавлять в конец, старые не менять.
+# Каждая миграция выполняется в своей транзакции и записывается в schema_migrations.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "baseline", [
+        # Все команды идемпотентны: на уже существующей базе миграция просто отмечается примененной
+        '''
+        CREATE TABLE IF NOT EXISTS users
+        (
+            user_id           BIGINT PRIMARY KEY,
+            username          TEXT,
+            full_name         TEXT,
+            tg_full_name      TEXT, -- Имя из Telegram профиля
+            phone_number      TEXT,
+            status            TEXT        DEFAULT 'pending', -- pending, approved, banned
+            registration_date TIMESTAMPTZ DEFAULT NOW()
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS auctions
+        (
+            auction_id         SERIAL PRIMARY KEY,
+            title              TEXT,
+            description        TEXT,
+            photo_id           TEXT,
+            start_price        REAL,
+            min_step           REAL DEFAULT 1000,
+            max_step           REAL DEFAULT 10000,
+            blitz_price        REAL,
+            end_time           TIMESTAMPTZ,
+            status             TEXT DEFAULT 'active', -- active, finished, canceled
+            winner_id          BIGINT,
+            final_price        REAL,
+            channel_message_id BIGINT,
+            cooldown_minutes INTEGER DEFAULT 10,
+            cooldown_off_before_end_minutes INTEGER DEFAULT 30
+        );
+        ''',
+        # Столбцы, добавленные в таблицы после их первого создания
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS tg_full_name TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS menu_message_id BIGINT",
+        "ALTER TABLE auctions ADD COLUMN IF NOT EXISTS cooldown_minutes INTEGER DEFAULT 10",
+        "ALTER TABLE auctions ADD COLUMN IF NOT EXISTS cooldown_off_before_end_minutes INTEGER DEFAULT 30",
+        "ALTER TABLE auctions ADD COLUMN IF NOT EXISTS media_type TEXT DEFAULT 'photo'",
+        '''
+        CREATE TABLE IF NOT EXISTS bids
+        (
+            bid_id     SERIAL PRIMARY KEY,
+            auction_id INTEGER REFERENCES auctions (auction_id) ON DELETE CASCADE,
+            user_id    BIGINT REFERENCES users (user_id) ON DELETE CASCADE,
+            bid_amount REAL,
+            bid_time   TIMESTAMPTZ DEFAULT NOW()
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS auction_participants
+        (
+            participant_id   SERIAL PRIMARY KEY,
+            user_id          BIGINT REFERENCES users (user_id) ON DELETE CASCADE,
+            auction_id       INTEGER REFERENCES auctions (auction_id) ON DELETE CASCADE,
+            status           TEXT DEFAULT 'pending', -- pending, approved, rejected
+            rejection_reason TEXT,
+            UNIQUE (user_id, auction_id)             -- Пользователь может подать заявку на 1 лот только один раз
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS settings
+        (
+            setting_key   TEXT PRIMARY KEY,
+            setting_value TEXT
+        );
+        ''',
+        # Значение по умолчанию для автопринятия (если еще не установлено)
+        '''
+        INSERT INTO settings (setting_key, setting_value)
+        VALUES ('auto_approve_enabled', 'false')
+        ON CONFLICT (setting_key) DO NOTHING;
+        ''',
+        # Transactional outbox: уведомления в Telegram пишутся в той же транзакции, что и изменение
+        # состояния, и отправляются диспетчером outbox.py (с повторами)
+        '''
+        CREATE TABLE IF NOT EXISTS outbox
+        (
+            event_id        BIGSERIAL PRIMARY KEY,
+            kind            TEXT,
+            payload         JSONB,
+            status          TEXT        DEFAULT 'pending', -- pending, done, failed
+            attempts        INTEGER     DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ DEFAULT NOW(),
+            last_error      TEXT,
+            created_at      TIMESTAMPTZ DEFAULT NOW(),
+            done_at         TIMESTAMPTZ
+        );
+        ''',
+        "CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox (next_attempt_at) WHERE status = 'pending'",
+        # Массовые рассылки: задание и результат доставки каждому получателю (см. broadcast.py)
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs
+        (
+            job_id            SERIAL PRIMARY KEY,
+            title             TEXT,
+            text              TEXT,
+            reply_markup      JSONB,
+            status            TEXT        DEFAULT 'pending', -- pending, running, done
+            total             INTEGER     DEFAULT 0,
+            sent              INTEGER     DEFAULT 0,
+            failed            INTEGER     DEFAULT 0,
+            report_chat_id    BIGINT,
+            report_message_id BIGINT,
+            created_at        TIMESTAMPTZ DEFAULT NOW(),
+            finished_at       TIMESTAMPTZ
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries
+        (
+            job_id  INTEGER REFERENCES broadcast_jobs (job_id) ON DELETE CASCADE,
+            user_id BIGINT,
+            status  TEXT DEFAULT 'pending', -- pending, sent, failed
+            error   TEXT,
+            sent_at TIMESTAMPTZ,
+            PRIMARY KEY (job_id, user_id)
+        );
+        ''',
+    ]),
+    (2, "hot query indexes", [
+        # Лидер и топ ставок лота, число ставок, страница ставок, place_bid
+        "CREATE INDEX IF NOT EXISTS bids_auction_amount_idx ON bids (auction_id, bid_amount DESC, bid_time)",
+        # Кулдаун: последняя ставка пользователя на лот (get_user_last_bid_time)
+        "CREATE INDEX IF NOT EXISTS bids_user_auction_time_idx ON bids (user_id, auction_id, bid_time DESC)",
+        # Поиск пользователя админом по @username / телефону (find_user_by_text)
+        "CREATE INDEX IF NOT EXISTS users_username_idx ON users (username)",
+        "CREATE INDEX IF NOT EXISTS users_phone_number_idx ON users (phone_number)",
+        # Активные лоты (их единицы среди всех): текущий лот и поиск истекших
+        "CREATE INDEX IF NOT EXISTS auctions_active_idx ON auctions (auction_id) WHERE status = 'active'",
+        "CREATE INDEX IF NOT EXISTS auctions_active_end_time_idx ON auctions (end_time) WHERE status = 'active'",
+    ]),
+    (3, "fsm storage", [
+        # Состояния FSM пользователей и админов (см. fsm_storage.py) переживают перезапуск бота
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_state
+        (
+            key        TEXT PRIMARY KEY, -- bot_id:chat_id:user_id:thread_id:business_connection_id:destiny
+            state      TEXT,
+            data       JSONB       NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        ''',
+        # Очистка устаревших состояний (delete_expired_fsm_states)
+        "CREATE INDEX IF NOT EXISTS fsm_state_updated_at_idx ON fsm_state (updated_at)",
+    ]),
+    (4, "throttle hits", [
+        # Окна ограничения частоты, общие для процессов бота (throttling.py, THROTTLE_BACKEND=postgres).
+        # UNLOGGED: данные не пишутся в WAL и не нужны после сбоя БД
+        '''
+        CREATE UNLOGGED TABLE IF NOT EXISTS throttle_hits
+        (
+            key        TEXT PRIMARY KEY, -- правило:user_id
+            window_end TIMESTAMPTZ NOT NULL,
+            hits       INTEGER     NOT NULL
+        );
+        ''',
+        "CREATE INDEX IF NOT EXISTS throttle_hits_window_end_idx ON throttle_hits (window_end)",
+    ]),
+    (5, "place_bid function", [
+        # Атомарная ставка (db.place_bid_atomic): блокировка строки аукциона (FOR UPDATE) выстраивает
+        # конкурентные ставки на лот в очередь; каждая следующая видит цену, уже учитывающую предыдущую.
+        # Антиснайпинг и блиц — в той же транзакции. Изменения функции — только новыми миграциями.
+        # Версия без p_notify создавалась при старте бота до этой миграции (вызов с пятью аргументами
+        # был бы неоднозначным)
+        "DROP FUNCTION IF EXISTS place_bid(INTEGER, BIGINT, REAL, INTERVAL, INTERVAL)",
+        '''
+        CREATE OR REPLACE FUNCTION place_bid(p_auction_id INTEGER, p_user_id BIGINT, p_amount REAL,
+                                             p_snipe_window INTERVAL, p_snipe_extension INTERVAL,
+                                             p_notify BOOLEAN DEFAULT FALSE)
+            RETURNS TABLE (outcome TEXT, bid_id INTEGER, bid_time TIMESTAMPTZ, bid_amount REAL,
+                           current_price REAL, min_step REAL, previous_leader_id BIGINT,
+                           end_time TIMESTAMPTZ, username TEXT, tg_full_name TEXT)
+            LANGUAGE plpgsql AS $$
+        #variable_conflict use_column
+        DECLARE
+            a auctions%ROWTYPE;
+            v_outcome TEXT := 'accepted';
+            v_amount REAL := p_amount;
+            v_price REAL;
+            v_leader_id BIGINT;
+            v_leader_amount REAL;
+            v_bid_id INTEGER;
+            v_bid_time TIMESTAMPTZ;
+            v_username TEXT;
+            v_tg_full_name TEXT;
+        BEGIN
+            SELECT * INTO a FROM auctions WHERE auctions.auction_id = p_auction_id FOR UPDATE;
+            IF NOT FOUND THEN
+                RETURN QUERY SELECT 'not_found'::TEXT, NULL::INTEGER, NULL::TIMESTAMPTZ, p_amount, NULL::REAL,
+                                    NULL::REAL, NULL::BIGINT, NULL::TIMESTAMPTZ, NULL::TEXT, NULL::TEXT;
+                RETURN;
+            END IF;
+
+            SELECT b.user_id, b.bid_amount INTO v_leader_id, v_leader_amount
+            FROM bids b
+            WHERE b.auction_id = p_auction_id
+            ORDER BY b.bid_amount DESC, b.bid_time ASC
+            LIMIT 1;
+            v_price := COALESCE(v_leader_amount, a.start_price);
+
+            IF a.status <> 'active' THEN
+                v_outcome := 'not_active';
+            ELSIF a.end_time <= NOW() THEN
+                v_outcome := 'ended';
+            ELSIF a.blitz_price > 0 AND p_amount >= a.blitz_price THEN
+                v_outcome := 'blitz';
+                v_amount := a.blitz_price;
+            ELSIF p_amount < v_price + a.min_step THEN
+                v_outcome := 'too_low';
+            END IF;
+
+            IF v_outcome IN ('accepted', 'blitz') THEN
+                INSERT INTO bids (auction_id, user_id, bid_amount)
+                VALUES (p_auction_id, p_user_id, v_amount)
+                RETURNING bids.bid_id, bids.bid_time INTO v_bid_id, v_bid_time;
+
+                SELECT u.username, u.tg_full_name INTO v_username, v_tg_full_name
+                FROM users u WHERE u.user_id = p_user_id;
+
+                IF v_outcome = 'blitz' THEN
+                    UPDATE auctions SET status = 'finished', winner_id = p_user_id, final_price = v_amount
+                    WHERE auctions.auction_id = p_auction_id;
+                    INSERT INTO outbox (kind, payload)
+                    VALUES ('auction_post_finalize', jsonb_build_object('auction_id', p_auction_id)),
+                           ('winner_notify', jsonb_build_object('auction_id', p_auction_id, 'blitz', TRUE));
+                ELSIF p_snipe_window IS NOT NULL AND a.end_time - NOW() <= p_snipe_window THEN
+                    a.end_time := a.end_time + p_snipe_extension;
+                    UPDATE auctions SET end_time = a.end_time WHERE auctions.auction_id = p_auction_id;
+                END IF;
+
+                -- Другие процессы бота применяют ставку к своей книге лота (см. cluster.py, канал CLUSTER_CHANNEL).
+                -- NOTIFY доставляется после коммита; блиц-покупка закрывает лот — книгу нужно перечитать.
+                -- Только при включенной синхронизации: коммиты с NOTIFY выстраиваются в очередь за общей блокировкой
+                IF NOT p_notify THEN
+                    NULL;
+                ELSIF v_outcome = 'accepted' THEN
+                    PERFORM pg_notify('auction_bot_events', json_build_object(
+                        'type', 'bid', 'auction_id', p_auction_id, 'bid_id', v_bid_id, 'user_id', p_user_id,
+                        'bid_amount', v_amount, 'bid_time', v_bid_time, 'username', v_username,
+                        'tg_full_name', v_tg_full_name, 'end_time', a.end_time)::TEXT);
+                ELSE
+                    PERFORM pg_notify('auction_bot_events',
+                                      json_build_object('type', 'book', 'auction_id', p_auction_id)::TEXT);
+                END IF;
+
+                -- Уведомление перебитому лидеру уходит через outbox
+                IF v_outcome = 'accepted' AND v_leader_id IS NOT NULL AND v_leader_id <> p_user_id THEN
+                    INSERT INTO outbox (kind, payload)
+                    VALUES ('outbid_notify', jsonb_build_object('user_id', v_leader_id, 'auction_id', p_auction_id,
+                                                                'title', a.title, 'amount', v_amount));
+                END IF;
+            END IF;
+
+            RETURN QUERY SELECT v_outcome, v_bid_id, v_bid_time, v_amount, v_price, a.min_step,
+                                v_leader_id, a.end_time, v_username, v_tg_full_name;
+        END;
+        $$;
+        ''',
+    ]),
+]
+
+# Горячие запросы реестра queries.STATEMENTS (по имени) с примерами параметров для check_query_plans:
+# проверяется ровно тот SQL, который выполняет db.py. place_bid не проверяется — это вызов функции БД,
+# планы ее запросов EXPLAIN не показывает (они те же, что у top_bids)
+HOT_QUERY_ARGS: Dict[str, Tuple[Any, ...]] = {
+    "user_status": (1,),
+    "participation_status": (1, 1),
+    "active_auction": (),
+    "last_bid": (1,),
+    "last_bid_times": (1,),
+    "user_last_bid_time": (1, 1),
+    "top_bids": (1, 5),
+    "auction_snapshot": (1, 5),
+    "bids_page": (1, 10, 0),
+    "count_bids": (1,),
+    "fsm_get": ("1:1:1:::default",),
+    "user_by_username": ("user",),
+    "user_by_phone": ("+70000000000",),
+    "close_expired_auctions": (None,),
+    "claim_outbox": (50, 60.0),
+}
+HOT_QUERIES: List[Tuple[str, str, Tuple[Any, ...]]] = [
+    (name, queries.STATEMENTS[name], args) for name, args in HOT_QUERY_ARGS.items()
+]
+
+
+async def run_migrations(conn: asyncpg.Connection):
+    """Применяет еще не примененные миграции по порядку версий."""
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_KEY)
+    try:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations
+            (
+                version    INTEGER PRIMARY KEY,
+                name       TEXT,
+                applied_at TIMESTAMPTZ DEFAULT NOW()
+            );
+        ''')
+        applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            async with conn.transaction():
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+            logging.info(f"Применена миграция {version}: {name}")
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_KEY)
+
+
+def _seq_scans(plan: dict) -> List[str]:
+    """Таблицы, которые план читает последовательным сканированием."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+async def check_query_plans(conn: asyncpg.Connection) -> List[str]:
+    """
+    Проверяет через EXPLAIN, что каждый запрос из HOT_QUERIES может идти по индексу.
+    Seq scan отключается (enable_seqscan = off), чтобы результат не зависел от размера таблиц:
+    если план все равно содержит Seq Scan — подходящего индекса нет.
+    Возвращает список проблем (пустой — все в порядке).
+    """
+    problems = []
+    async with conn.transaction():
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        for name, sql, args in HOT_QUERIES:
+            raw = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *args)
+            plan = json.loads(raw)[0]["Plan"]
+            tables = _seq_scans(plan)
+            if tables:
+                problems.append(f"{name}: seq scan по {', '.join(tables)}")
+    return problems
+
+
+async def _main():
+    import db  # Здесь, чтобы db мог импортировать этот модуль
+    conn = await db.connect("migrations")
+    try:
+        await run_migrations(conn)
+        problems = await check_query_plans(conn)
+    finally:
+        await conn.close()
+    for problem in problems:
+        print(f"❌ {problem}")
+    if not problems:
+        print(f"✅ Все {len(HOT_QUERIES)} горячих запросов используют индексы.")
+    raise SystemExit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    # python migrations.py — применить миграции и проверить планы горячих запросов
+    asyncio.run(_main())
@@ -0,0 +1,199 @@
+# outbox.py
+import asyncio
+import logging
+import os
+from html import escape
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+import auction_book
+import db
+import kb
+from channel_updater import channel_updater
+from handlers import APPROVAL_MESSAGE, REJECTION_MESSAGE, format_auction_post
+from rate_limiter import Priority, priority
+from user_menu import update_participation_menu
+
+# Сколько событий забираем из БД за раз и сколько отправляем одновременно
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+# Проверка новых событий, если диспетчер не разбудили (например, событие записал другой процесс)
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))
+# Повторы: задержка растет вдвое с каждой попыткой, после OUTBOX_MAX_ATTEMPTS событие помечается failed
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "5"))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "600"))
+# Сколько секунд взятое в работу событие недоступно другим диспетчерам (продлевается, пока оно обрабатывается)
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+
+EventHandler = Callable[[Bot, Dict[str, Any]], Awaitable[None]]
+EVENT_HANDLERS: Dict[str, EventHandler] = {}
+
+_dispatcher_task: Optional[asyncio.Task] = None
+
+
+def event_handler(kind: str):
+    """Регистрирует обработчик событий вида kind: async def handler(bot, payload)."""
+    def decorator(func: EventHandler) -> EventHandler:
+        EVENT_HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+async def _handle(bot: Bot, event: Dict[str, Any], semaphore: asyncio.Semaphore, in_flight: Set[int]):
+    """
+    Выполняет событие и сразу отмечает его выполненным (после падения посреди пачки уже отправленное
+    не повторится); при ошибке записывает ее и время повтора.
+    """
+    handler = EVENT_HANDLERS.get(event['kind'])
+    try:
+        if handler is None:
+            raise LookupError(f"нет обработчика для события {event['kind']}")
+        async with semaphore:
+            await handler(bot, event['payload'])
+    except Exception as e:
+        in_flight.discard(event['event_id'])
+        permanent = isinstance(e, (TelegramForbiddenError, LookupError))  # Повтор не поможет
+        if permanent or event['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            retry_in = None
+            logging.error(f"Событие outbox #{event['event_id']} ({event['kind']}) не выполнено: {e}")
+        else:
+            retry_in = min(OUTBOX_RETRY_BASE * 2 ** (event['attempts'] - 1), OUTBOX_RETRY_MAX)
+            logging.warning(f"Событие outbox #{event['event_id']} ({event['kind']}): {e}. "
+                            f"Повтор через {retry_in:.0f} с")
+        await db.fail_outbox_event(event['event_id'], str(e), retry_in)
+        return
+    in_flight.discard(event['event_id'])
+    await db.complete_outbox_events([event['event_id']])
+
+
+async def _renew_lease(in_flight: Set[int]):
+    """Пока пачка обрабатывается, продлевает аренду ее невыполненных событий раз в половину OUTBOX_LEASE."""
+    while True:
+        await asyncio.sleep(OUTBOX_LEASE / 2)
+        try:
+            await db.extend_outbox_lease(list(in_flight), OUTBOX_LEASE)
+        except Exception as e:
+            logging.warning(f"Не удалось продлить аренду событий outbox: {e}")
+
+
+async def dispatch_batch(bot: Bot) -> int:
+    """Отправляет одну пачку готовых событий. Возвращает количество взятых событий."""
+    events = await db.claim_outbox_events(OUTBOX_BATCH_SIZE, OUTBOX_LEASE)
+    if not events:
+        return 0
+    semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    in_flight = {event['event_id'] for event in events}
+    renewal = asyncio.create_task(_renew_lease(in_flight))
+    try:
+        await asyncio.gather(*(_handle(bot, event, semaphore, in_flight) for event in events))
+    finally:
+        renewal.cancel()
+    return len(events)
+
+
+async def _dispatcher_loop(bot: Bot):
+    while True:
+        db.outbox_wakeup.clear()
+        try:
+            claimed = await dispatch_batch(bot)
+        except Exception as e:
+            logging.error(f"Ошибка диспетчера outbox: {e}")
+            claimed = 0
+        if claimed >= OUTBOX_BATCH_SIZE:
+            continue  # Вероятно, в очереди есть еще события
+        try:
+            await asyncio.wait_for(db.outbox_wakeup.wait(), OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_dispatcher(bot: Bot):
+    """Запускает фоновую отправку событий outbox."""
+    global _dispatcher_task
+    if _dispatcher_task is None:
+        _dispatcher_task = asyncio.create_task(_dispatcher_loop(bot))
+
+
+async def stop_dispatcher():
+    """Останавливает диспетчер; недоотправленные события будут отправлены после перезапуска."""
+    global _dispatcher_task
+    if _dispatcher_task is not None:
+        _dispatcher_task.cancel()
+        await asyncio.gather(_dispatcher_task, return_exceptions=True)
+        _dispatcher_task = None
+
+
+# --- Обработчики событий ---
+
+@event_handler('auction_post_finalize')
+async def _finalize_auction_post(bot: Bot, payload: Dict[str, Any]):
+    """Финальный пост лота в канале (данные — из БД, книга лота к этому моменту может быть неактуальна)."""
+    auction_id = payload['auction_id']
+    auction_book.drop(auction_id)
+    snapshot = await db.get_auction_snapshot(auction_id, top_n=5)
+    if not snapshot:
+        return
+    text = await format_auction_post(snapshot['auction'], bot, finished=True, snapshot=snapshot)
+    if not await channel_updater.finalize(bot, snapshot['auction']['channel_message_id'], text):
+        raise RuntimeError(f"пост аукциона #{auction_id} в канале не обновлен")
+
+
+@event_handler('winner_notify')
+async def _notify_winner(bot: Bot, payload: Dict[str, Any]):
+    snapshot = await db.get_auction_snapshot(payload['auction_id'], top_n=1)
+    if not snapshot or not snapshot['auction']['winner_id']:
+        return
+    auction = snapshot['auction']
+    if payload.get('blitz'):
+        text = (f"🎉 Поздравляем! Вы купили лот «{escape(auction['title'])}» по блиц-цене "
+                f"{auction['final_price']:,.2f} руб.\n\n"
+                f"В ближайшее время с вами свяжется администратор.")
+    else:
+        text = (f"🎉 Поздравляем! Вы победили в аукционе «{escape(auction['title'])}»!\n\n"
+                f"Ваша выигрышная ставка: {auction['final_price']:,.2f} руб.\n\n"
+                f"В ближайшее время с вами свяжется администратор для уточнения деталей.")
+    await bot.send_message(auction['winner_id'], text)
+
+
+@event_handler('outbid_notify')
+async def _notify_outbid(bot: Bot, payload: Dict[str, Any]):
+    with priority(Priority.HIGH):
+        await bot.send_message(
+            payload['user_id'],
+            f"❗️ Вашу ставку на аукционе '{escape(payload['title'])}' перебили! "
+            f"Новая ставка: {payload['amount']:,.0f} руб."
+        )
+
+
+@event_handler('user_approved')
+async def _notify_user_approved(bot: Bot, payload: Dict[str, Any]):
+    # Стандартное сообщение с главным меню; оно же становится "меню" пользователя
+    new_msg = await bot.send_message(payload['user_id'], APPROVAL_MESSAGE, reply_markup=kb.get_main_menu())
+    await db.update_user_menu_message_id(payload['user_id'], new_msg.message_id)
+
+
+@event_handler('user_rejected')
+async def _notify_user_rejected(bot: Bot, payload: Dict[str, Any]):
+    notify_text = REJECTION_MESSAGE
+    if payload.get('reason'):
+        notify_text += f"\nПричина: {escape(payload['reason'])}"
+    await bot.send_message(payload['user_id'], notify_text)
+
+
+@event_handler('participation_approved')
+async def _notify_participation_approved(bot: Bot, payload: Dict[str, Any]):
+    await bot.send_message(payload['user_id'],
+                           "✅ Ваша заявка на участие в аукционе одобрена. Теперь вы можете делать ставки.")
+    # Пытаемся обновить меню пользователя "вживую"
+    await update_participation_menu(bot, payload['user_id'], payload['auction_id'], 'approved')
+
+
+@event_handler('participation_rejected')
+async def _notify_participation_rejected(bot: Bot, payload: Dict[str, Any]):
+    reason_text = payload.get('reason') or "Без указания причины"
+    await bot.send_message(payload['user_id'],
+                           f"❌ Ваша заявка на участие в аукционе отклонена.\nПричина: {escape(reason_text)}")
+    await update_participation_menu(bot, payload['user_id'], payload['auction_id'], 'rejected')
@@ -0,0 +1,209 @@
+# queries.py
+import time
+from typing import Any, Dict, List, Optional
+
+import asyncpg
+from asyncpg.pool import PoolConnectionProxy
+from asyncpg.prepared_stmt import PreparedStatement
+
+# Реестр горячих запросов: имя -> SQL. Функции db.py вызывают запрос по имени через fetch/fetchrow/fetchval
+# (с замером времени). Все запросы реестра готовятся init-хуком пула (init_connection) при создании
+# соединения, и вызов выполняет уже подготовленный запрос этого соединения.
+STATEMENTS: Dict[str, str] = {
+    # get_user_status (на каждое событие при промахе кэша)
+    "user_status": "SELECT status FROM users WHERE user_id = $1",
+    # get_participation_status
+    "participation_status": "SELECT status FROM auction_participants WHERE user_id = $1 AND auction_id = $2",
+    # get_active_auction
+    "active_auction": "SELECT * FROM auctions WHERE status = 'active' ORDER BY auction_id DESC LIMIT 1",
+    # place_bid_atomic
+    "place_bid": "SELECT * FROM place_bid($1, $2, $3, $4, $5, $6)",
+    # get_last_bid
+    "last_bid": """
+        SELECT b.bid_amount, u.username, b.user_id, u.tg_full_name
+        FROM bids b
+        JOIN users u ON b.user_id = u.user_id
+        WHERE b.auction_id = $1
+        ORDER BY b.bid_amount DESC, b.bid_time ASC
+        LIMIT 1
+    """,
+    # get_last_bid_times
+    "last_bid_times": "SELECT user_id, MAX(bid_time) AS bid_time FROM bids WHERE auction_id = $1 GROUP BY user_id",
+    # get_user_last_bid_time (кулдаун)
+    "user_last_bid_time":
+        "SELECT bid_time FROM bids WHERE user_id = $1 AND auction_id = $2 ORDER BY bid_time DESC LIMIT 1",
+    # get_top_bids
+    "top_bids": """
+        SELECT b.bid_id, b.auction_id, b.user_id, b.bid_amount, b.bid_time,
+               u.username, u.tg_full_name
+        FROM bids b
+        JOIN users u ON b.user_id = u.user_id
+        WHERE b.auction_id = $1
+        ORDER BY b.bid_amount DESC, b.bid_time ASC
+        LIMIT $2
+    """,
+    # get_auction_snapshot
+    "auction_snapshot": """
+        SELECT a.*, c.bids_count, c.last_bid_id,
+               t.bid_id, t.user_id AS bid_user_id, t.bid_amount, t.bid_time,
+               t.username, t.tg_full_name
+        FROM auctions a
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) AS bids_count, MAX(bid_id) AS last_bid_id FROM bids WHERE auction_id = a.auction_id
+        ) c
+        LEFT JOIN LATERAL (
+            SELECT b.bid_id, b.user_id, b.bid_amount, b.bid_time, u.username, u.tg_full_name
+            FROM bids b
+            JOIN users u ON b.user_id = u.user_id
+            WHERE b.auction_id = a.auction_id
+            ORDER BY b.bid_amount DESC, b.bid_time ASC
+            LIMIT $2
+        ) t ON TRUE
+        WHERE a.auction_id = $1
+        ORDER BY t.bid_amount DESC, t.bid_time ASC
+    """,
+    # get_bids_page
+    "bids_page": """
+        SELECT b.*, u.username, u.tg_full_name
+        FROM bids b
+        JOIN users u ON b.user_id = u.user_id
+        WHERE b.auction_id = $1
+        ORDER BY b.bid_amount DESC, b.bid_time ASC
+        LIMIT $2 OFFSET $3
+    """,
+    # count_bids
+    "count_bids": "SELECT COUNT(*) FROM bids WHERE auction_id = $1",
+    # get_fsm_record (при промахе кэша fsm_storage)
+    "fsm_get": "SELECT state, data FROM fsm_state WHERE key = $1",
+    # get_user_by_username / get_user_by_phone (поиск пользователя админом)
+    "user_by_username": "SELECT * FROM users WHERE username = $1",
+    "user_by_phone": "SELECT * FROM users WHERE phone_number = $1",
+    # close_expired_auctions (таймер закрытия лота и страховочная проверка)
+    "close_expired_auctions": """
+        WITH closed AS (
+            UPDATE auctions a
+            SET status = 'finished',
+                winner_id = (SELECT b.user_id FROM bids b WHERE b.auction_id = a.auction_id
+                             ORDER BY b.bid_amount DESC, b.bid_time ASC LIMIT 1),
+                final_price = (SELECT b.bid_amount FROM bids b WHERE b.auction_id = a.auction_id
+                               ORDER BY b.bid_amount DESC, b.bid_time ASC LIMIT 1)
+            WHERE a.status = 'active'
+              AND a.end_time <= NOW()
+              AND ($1::int[] IS NULL OR a.auction_id = ANY($1::int[]))
+            RETURNING a.*
+        ), events AS (
+            INSERT INTO outbox (kind, payload)
+            SELECT 'auction_post_finalize', jsonb_build_object('auction_id', auction_id) FROM closed
+            UNION ALL
+            SELECT 'winner_notify', jsonb_build_object('auction_id', auction_id) FROM closed WHERE winner_id IS NOT NULL
+        )
+        SELECT * FROM closed
+    """,
+    # claim_outbox_events (диспетчер outbox)
+    "claim_outbox": """
+        UPDATE outbox
+        SET attempts = attempts + 1,
+            next_attempt_at = NOW() + make_interval(secs => $2)
+        WHERE event_id IN (
+            SELECT event_id FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= NOW()
+            ORDER BY event_id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING event_id, kind, payload, attempts
+    """,
+}
+
+# Время выполнения по каждому запросу: имя -> {'calls', 'errors', 'total_ms', 'max_ms'}
+_stats: Dict[str, Dict[str, float]] = {}
+# Подготовленные запросы реестра по соединениям: соединение asyncpg (не прокси пула) -> {имя: запрос}.
+# Запись удаляется, когда соединение закрывается (в том числе при пересоздании пулом)
+_prepared: Dict[asyncpg.Connection, Dict[str, PreparedStatement]] = {}
+
+
+async def init_connection(conn: asyncpg.Connection):
+    """
+    init-хук пула: готовит все запросы реестра на новом соединении. Первый вызов запроса на соединении
+    не тратит время на разбор и планирование, а ошибка в SQL реестра обнаруживается при создании пула,
+    а не посреди обработки события.
+    """
+    statements = {}
+    for name, sql in STATEMENTS.items():
+        try:
+            statements[name] = await conn.prepare(sql)
+        except asyncpg.PostgresError as e:
+            raise RuntimeError(f"Запрос реестра {name} не готовится: {e}") from e
+    _prepared[conn] = statements
+    conn.add_termination_listener(lambda _: _prepared.pop(conn, None))
+
+
+async def setup_connection(conn: PoolConnectionProxy):
+    """
+    setup-хук пула (при каждой выдаче соединения). asyncpg считает PreparedStatement недействительным,
+    как только соединение вернулось в пул, поэтому запросы соединения привязываются к текущей выдаче.
+    На сервере они остаются подготовленными, обращения к БД нет.
+    """
+    raw = conn._con
+    for statement in _prepared.get(raw, {}).values():
+        statement._con_release_ctr = raw._pool_release_ctr
+
+
+async def _execute(conn: asyncpg.Connection, name: str, method: str, args: tuple) -> Any:
+    raw = conn._con if isinstance(conn, PoolConnectionProxy) else conn
+    statements = _prepared.get(raw)
+    if statements is None:  # Соединение не из пула (init_connection на нем не выполнялся)
+        return await getattr(conn, method)(STATEMENTS[name], *args)
+    statement = statements.get(name)
+    if statement is None:
+        statement = statements[name] = await conn.prepare(STATEMENTS[name])
+    try:
+        return await getattr(statement, method)(*args)
+    except asyncpg.InvalidCachedStatementError:
+        # Схема изменилась (например, миграцию применил другой процесс): запрос готовится заново.
+        # В транзакции повторить нельзя — она уже прервана ошибкой; запрос подготовится при следующем вызове
+        del statements[name]
+        if conn.is_in_transaction():
+            raise
+        statement = statements[name] = await conn.prepare(STATEMENTS[name])
+        return await getattr(statement, method)(*args)
+
+
+async def _run(conn: asyncpg.Connection, name: str, method: str, args: tuple) -> Any:
+    stats = _stats.setdefault(name, {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+    started = time.perf_counter()
+    try:
+        return await _execute(conn, name, method, args)
+    except Exception:
+        stats['errors'] += 1
+        raise
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        stats['calls'] += 1
+        stats['total_ms'] += elapsed
+        stats['max_ms'] = max(stats['max_ms'], elapsed)
+
+
+async def fetch(conn: asyncpg.Connection, name: str, *args) -> List[asyncpg.Record]:
+    return await _run(conn, name, "fetch", args)
+
+
+async def fetchrow(conn: asyncpg.Connection, name: str, *args) -> Optional[asyncpg.Record]:
+    return await _run(conn, name, "fetchrow", args)
+
+
+async def fetchval(conn: asyncpg.Connection, name: str, *args) -> Any:
+    return await _run(conn, name, "fetchval", args)
+
+
+def query_stats() -> Dict[str, Dict[str, float]]:
+    """Статистика по запросам реестра: число вызовов, ошибок, среднее и максимальное время (мс)."""
+    return {
+        name: {
+            'calls': s['calls'],
+            'errors': s['errors'],
+            'avg_ms': round(s['total_ms'] / s['calls'], 3) if s['calls'] else 0.0,
+            'max_ms': round(s['max_ms'], 3),
+        }
+        for name, s in _stats.items()
+    }
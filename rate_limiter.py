@@ -0,0 +1,208 @@
+# rate_limiter.py
+import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from cache import TTLCache, MISSING
+
+CHANNEL_ID = os.getenv("CHANNEL_ID")
+
+# Лимиты Telegram: ~30 сообщений/с на бота, ~1/с в личный чат, ~20/мин в группу или канал
+GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+PRIVATE_CHAT_RATE = float(os.getenv("TG_PRIVATE_CHAT_RATE", "1"))
+PRIVATE_CHAT_BURST = float(os.getenv("TG_PRIVATE_CHAT_BURST", "3"))
+GROUP_CHAT_RATE = float(os.getenv("TG_GROUP_CHAT_RATE", str(20 / 60)))
+GROUP_CHAT_BURST = float(os.getenv("TG_GROUP_CHAT_BURST", "3"))
+# Для нашего канала — отдельный, более строгий лимит (посты лотов редактируются часто)
+CHANNEL_RATE = float(os.getenv("TG_CHANNEL_RATE", str(15 / 60)))
+CHANNEL_BURST = float(os.getenv("TG_CHANNEL_BURST", "2"))
+# Сколько раз повторяем запрос после TelegramRetryAfter
+RETRY_AFTER_ATTEMPTS = int(os.getenv("TG_RETRY_AFTER_ATTEMPTS", "3"))
+CHAT_BUCKETS_SIZE = int(os.getenv("TG_CHAT_BUCKETS_SIZE", "10000"))
+
+# Лимитируются только методы, отправляющие или изменяющие сообщения
+LIMITED_METHOD_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+
+
+class Priority(IntEnum):
+    """Класс запроса: при нехватке токенов первыми уходят запросы с меньшим значением."""
+    HIGH = 0  # Ответы на ставки, уведомления о перебитой ставке
+    NORMAL = 1
+    LOW = 2  # Массовые рассылки
+
+
+_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar("tg_request_priority", default=Priority.NORMAL)
+
+
+@contextmanager
+def priority(level: Priority):
+    """Запросы к Bot API внутри блока with отправляются с приоритетом level."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def with_priority(level: Priority):
+    """Декоратор хендлера: все запросы к Bot API из хендлера отправляются с приоритетом level."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with priority(level):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TokenBucket:
+    """
+    Token bucket с очередью ожидающих по приоритету:
+    освободившийся токен получает самый приоритетный (а при равенстве — самый ранний) запрос.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters: list = []  # heap: (priority, seq, future)
+        self._seq = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _try_take(self) -> bool:
+        if time.monotonic() < self.paused_until:
+            return False
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, level: Priority = Priority.NORMAL):
+        if not self._waiters and self._try_take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (level, next(self._seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    def pause(self, seconds: float):
+        """Не выдает токены seconds секунд (после ответа 429 от Telegram)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # Сразу после паузы можно отправить один запрос, дальше токены копятся как обычно
+        self.tokens = 1
+        self.updated = self.paused_until
+
+    async def _pump(self):
+        while self._waiters:
+            if self._try_take():
+                while self._waiters:
+                    _, _, future = heapq.heappop(self._waiters)
+                    if not future.done():  # Отмененных ожидающих пропускаем
+                        future.set_result(None)
+                        break
+                else:
+                    self.tokens += 1  # Токен никому не достался — возвращаем
+                continue
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: перед отправкой сообщения берет токен из бакета чата
+    (личный чат, группа или наш канал), затем из глобального бакета.
+    На TelegramRetryAfter ставит бакет чата на паузу и повторяет запрос.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.channel_bucket = TokenBucket(CHANNEL_RATE, CHANNEL_BURST)
+        self.chat_buckets = TTLCache(CHAT_BUCKETS_SIZE, ttl=600)
+        self.retries = 0
+        self.retry_failures = 0
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        if CHANNEL_ID and str(chat_id) == CHANNEL_ID:
+            return self.channel_bucket
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is MISSING:
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            if is_private:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            else:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+        # Продлеваем TTL при каждом обращении, чтобы активный чат не терял свой бакет
+        self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(LIMITED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+
+        level = _priority.get()
+        chat_bucket = self._chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            await chat_bucket.acquire(level)
+            await self.global_bucket.acquire(level)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                chat_bucket.pause(e.retry_after)
+                if attempt > RETRY_AFTER_ATTEMPTS:
+                    self.retry_failures += 1
+                    logging.error(f"Flood control: {type(method).__name__} в чат {chat_id} не отправлен "
+                                  f"после {RETRY_AFTER_ATTEMPTS} повторов")
+                    raise
+                self.retries += 1
+                logging.warning(f"Flood control: {type(method).__name__} в чат {chat_id}, "
+                                f"повтор через {e.retry_after} с (попытка {attempt})")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "global_waiting": self.global_bucket.waiting,
+            "channel_waiting": self.channel_bucket.waiting,
+            "chat_buckets": len(self.chat_buckets),
+            "retries": self.retries,
+            "retry_failures": self.retry_failures,
+        }
+
+
+rate_limiter = RateLimitMiddleware()
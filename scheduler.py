@@ -1,63 +1,60 @@
 # scheduler.py
 import logging
 import os
+from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiogram import Bot
-from aiogram.exceptions import TelegramAPIError
 
+import auction_book
+import broadcast
+import auction_timers
 import db
-from handlers import format_auction_post  # Импортируем нашу функцию форматирования
+import leader
 
-CHANNEL_ID = os.getenv("CHANNEL_ID")
+# Страховочная проверка просроченных лотов (основное закрытие — по таймерам auction_timers)
+AUCTION_SWEEP_MINUTES = int(os.getenv("AUCTION_SWEEP_MINUTES", "10"))
+# Через сколько секунд повторить закрытие, если таймер сработал, а лот по часам БД еще не истек
+AUCTION_CLOSE_RETRY_SECONDS = float(os.getenv("AUCTION_CLOSE_RETRY_SECONDS", "1"))
 
 
-async def check_auctions(bot: Bot):
+async def close_auction(bot: Bot, auction_id: int):
     """
-    Проверяет и завершает аукционы, время которых истекло.
-    Вызывается планировщиком каждую минуту.
+    Срабатывает по таймеру в end_time лота.
+    Финальный пост и уведомление победителю записываются в outbox вместе с закрытием (см. outbox.py).
     """
+    if not leader.is_leader():
+        return  # Процесс только что уступил роль ведущего: лот закроет новый ведущий
     try:
-        expired_auctions = await db.get_expired_active_auctions()
-        if not expired_auctions:
-            return  # Если нет просроченных аукционов, ничего не делаем
-
-        logging.info(f"Найдено {len(expired_auctions)} аукционов для завершения.")
-
-        for auction in expired_auctions:
-            auction_id = auction['auction_id']
-            last_bid = await db.get_last_bid(auction_id)
-
-            winner_id = last_bid['user_id'] if last_bid else None
-            final_price = last_bid['bid_amount'] if last_bid else None
-
-            # 1. Обновляем статус в БД
-            await db.finish_auction(auction_id, winner_id, final_price)
-            logging.info(f"Аукцион #{auction_id} завершен в базе данных.")
-
-            # 2. Обновляем пост в канале
-            finished_post_text = await format_auction_post(auction, bot, finished=True)
-            try:
-                await bot.edit_message_caption(
-                    chat_id=CHANNEL_ID,  # Используем ID из базы
-                    message_id=auction['channel_message_id'],
-                    caption=finished_post_text,
-                    parse_mode="HTML"
-                )
-            except TelegramAPIError as e:
-                logging.error(f"Не удалось обновить пост для аукциона #{auction_id} в канале: {e}")
+        closed = await db.close_expired_auctions([auction_id])
+        if closed:
+            auction_book.drop(auction_id)
+            return
+        snapshot = await db.get_auction_snapshot(auction_id, top_n=1)
+        if snapshot and snapshot['auction']['status'] == 'active':
+            # Лот не закрылся: время окончания успели сдвинуть (антиснайпинг) или часы процесса
+            # спешат относительно БД (закрытие сверяется с NOW() базы) — таймер нужен в любом случае,
+            # иначе лот закроет только страховочная проверка
+            end_time = snapshot['auction']['end_time']
+            retry_at = datetime.now(timezone.utc) + timedelta(seconds=AUCTION_CLOSE_RETRY_SECONDS)
+            auction_timers.arm(auction_id, max(end_time, retry_at))
+    except Exception as e:
+        logging.error(f"Ошибка при завершении аукциона #{auction_id}: {e}")
 
-            # 3. Уведомляем победителя, если он есть
-            if winner_id:
-                try:
-                    await bot.send_message(
-                        winner_id,
-                        f"🎉 Поздравляем! Вы победили в аукционе «{auction['title']}»!\n\n"
-                        f"Ваша выигрышная ставка: {final_price:,.2f} руб.\n\n"
-                        f"В ближайшее время с вами свяжется администратор для уточнения деталей."
-                    )
-                except TelegramAPIError as e:
-                    logging.error(f"Не удалось уведомить победителя {winner_id} аукциона #{auction_id}: {e}")
 
+async def check_auctions(bot: Bot):
+    """
+    Страховочная проверка (раз в AUCTION_SWEEP_MINUTES и при старте): закрывает просроченные лоты
+    и заново выставляет таймеры.
+    """
+    if not leader.is_leader():
+        return
+    try:
+        closed = await db.close_expired_auctions()
+        if closed:
+            logging.info(f"Завершено {len(closed)} просроченных аукционов.")
+        for auction in closed:
+            auction_book.drop(auction['auction_id'])
+        await auction_timers.reconcile()
     except Exception as e:
         logging.error(f"Произошла ошибка в задаче check_auctions: {e}")
 
@@ -65,5 +62,8 @@ async def check_auctions(bot: Bot):
 def setup_scheduler(bot: Bot, timezone: str):
     """Настраивает и возвращает объект планировщика."""
     scheduler = AsyncIOScheduler(timezone=timezone)
-    scheduler.add_job(check_auctions, 'interval', minutes=1, args=(bot,))
+    scheduler.add_job(check_auctions, 'interval', minutes=AUCTION_SWEEP_MINUTES, args=(bot,))
+    scheduler.add_job(broadcast.resume_broadcasts, 'interval', seconds=broadcast.BROADCAST_POLL_INTERVAL,
+                      args=(bot,), coalesce=True, max_instances=1)
+    auction_timers.init(scheduler, bot, close_auction)
     return scheduler
@@ -0,0 +1,208 @@
+# throttling.py
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+import db
+from access import ADMIN_IDS
+
+# Ограничение частоты событий пользователя. Правило "limit/period": не больше limit событий
+# за period секунд (фиксированное окно); переопределяется в .env: THROTTLE_<ИМЯ>, например THROTTLE_SHOW_BIDS="3/10".
+# Лишние события отбрасываются до обращений к БД; нажатие кнопки получает короткий ответ, сообщение — нет.
+# Админы (ADMIN_IDS) не ограничиваются.
+#
+# Сообщения: хендлер помечается флагом throttle с именем правила (throttle_middleware), например
+# @router.message(CommandStart(), flags={"throttle": "start"}). Флаг ставится только там, где потерять
+# повторное сообщение не страшно.
+DEFAULT_RULES = {
+    "start": "1/1",  # /start (удаление старого меню, проверка подписки, deep link)
+}
+# Кнопки: правило по префиксу callback_data (callback_rate_limit_middleware, до фильтров и middleware с БД).
+# Имя правила — префикс без "_" по краям: "show_bids_" -> THROTTLE_SHOW_BIDS
+DEFAULT_CALLBACK_RULES = {
+    "show_bids_": "5/10",      # История ставок: count_bids + get_bids_page + правка сообщения
+    "all_page_": "5/10",       # Список лотов: count_auctions + лидер каждого лота + правка сообщения
+    "menu_all": "3/6",
+    "menu_current": "5/5",
+    "show_auction_": "5/5",
+    "bid_auction_": "5/5",
+    "blitz_auction_": "3/6",
+    "confirm_blitz_": "2/2",   # Подтверждение блиц-покупки
+    "apply_auction_": "2/10",
+    "back_to_menu": "5/5",
+    "check_sub": "1/2",        # "Проверить подписку" (запрос getChatMember к Telegram), с лотом и без
+}
+# Где хранятся счетчики: memory — в процессе (в кластере пользователь всегда попадает на один воркер),
+# postgres — общие для всех процессов (таблица throttle_hits, по запросу к БД на событие)
+THROTTLE_BACKEND = os.getenv("THROTTLE_BACKEND", "memory")
+# Сколько пользователей помнит каждое правило в памяти (старые окна вытесняются первыми)
+THROTTLE_MAX_KEYS = int(os.getenv("THROTTLE_MAX_KEYS", "50000"))
+THROTTLE_CLEANUP_INTERVAL = float(os.getenv("THROTTLE_CLEANUP_INTERVAL", "600"))
+THROTTLED_CALLBACK_TEXT = "⏳ Слишком часто, попробуйте через пару секунд."
+
+
+class Rule:
+    """Не больше limit событий за period секунд на пользователя."""
+
+    def __init__(self, name: str, limit: int, period: float):
+        self.name = name
+        self.limit = limit
+        self.period = period
+        self.passed = 0
+        self.dropped = 0
+
+    @classmethod
+    def parse(cls, name: str, spec: str) -> "Rule":
+        limit, period = spec.split("/")
+        return cls(name, int(limit), float(period))
+
+
+class WindowStore:
+    """
+    Счетчики фиксированных окон одного правила в памяти: ключ -> (конец окна, число событий).
+    Окна одного правила одной длины, поэтому порядок добавления совпадает с порядком истечения:
+    устаревшие окна снимаются с начала очереди при каждом обращении, а при переполнении
+    вытесняется самое старое. Память ограничена maxsize независимо от времени работы.
+    """
+
+    def __init__(self, period: float, maxsize: int = THROTTLE_MAX_KEYS):
+        self.period = period
+        self.maxsize = maxsize
+        self._windows: "OrderedDict[Hashable, Tuple[float, int]]" = OrderedDict()
+
+    def _expire(self, now: float):
+        while self._windows:
+            key, (ends_at, _) = next(iter(self._windows.items()))
+            if ends_at > now:
+                break
+            del self._windows[key]
+
+    def hit(self, key: Hashable, limit: int) -> bool:
+        """Учитывает событие. Возвращает False, если лимит окна уже исчерпан."""
+        now = time.monotonic()
+        self._expire(now)
+        window = self._windows.get(key)
+        if window is None:
+            self._windows[key] = (now + self.period, 1)
+            if len(self._windows) > self.maxsize:
+                self._windows.popitem(last=False)
+            return True
+        ends_at, count = window
+        if count >= limit:
+            return False
+        self._windows[key] = (ends_at, count + 1)  # Позиция в очереди не меняется
+        return True
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+
+def _rule(name: str, spec: str) -> Rule:
+    return Rule.parse(name, os.getenv(f"THROTTLE_{name.upper()}", spec))
+
+
+RULES: Dict[str, Rule] = {name: _rule(name, spec) for name, spec in DEFAULT_RULES.items()}
+# Префикс -> правило; сначала более длинные префиксы: "show_bids_" проверяется раньше, чем "show_"
+CALLBACK_RULES: List[Tuple[str, Rule]] = sorted(
+    ((prefix, _rule(prefix.strip("_"), spec)) for prefix, spec in DEFAULT_CALLBACK_RULES.items()),
+    key=lambda item: -len(item[0])
+)
+RULES.update((rule.name, rule) for _, rule in CALLBACK_RULES)
+_stores: Dict[str, WindowStore] = {name: WindowStore(rule.period) for name, rule in RULES.items()}
+_cleanup_task: Optional[asyncio.Task] = None
+
+
+async def allow(rule: Rule, user_id: int) -> bool:
+    """Учитывает событие пользователя по правилу; False — событие нужно отбросить."""
+    if THROTTLE_BACKEND == "postgres":
+        try:
+            allowed = await db.throttle_hit(f"{rule.name}:{user_id}", rule.limit, rule.period)
+        except Exception as e:
+            # Ограничение частоты не должно останавливать бота: при ошибке БД пропускаем событие
+            logging.warning(f"Ограничение частоты ({rule.name}) недоступно: {e}")
+            allowed = True
+    else:
+        allowed = _stores[rule.name].hit(user_id, rule.limit)
+    if allowed:
+        rule.passed += 1
+    else:
+        rule.dropped += 1
+    return allowed
+
+
+async def throttle_middleware(handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                              event: Message, data: Dict[str, Any]) -> Any:
+    """Отбрасывает слишком частые сообщения хендлеров с флагом throttle."""
+    rule = RULES.get(get_flag(data, "throttle"))
+    user = data.get("event_from_user")
+    if rule is None or user is None or user.id in ADMIN_IDS or await allow(rule, user.id):
+        return await handler(event, data)
+    logging.info(f"Ограничение частоты ({rule.name}): сообщение пользователя {user.id} отброшено")
+
+
+def _callback_rule(callback_data: Optional[str]) -> Optional[Rule]:
+    if callback_data:
+        for prefix, rule in CALLBACK_RULES:
+            if callback_data.startswith(prefix):
+                return rule
+    return None
+
+
+async def callback_rate_limit_middleware(handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                                         event: CallbackQuery, data: Dict[str, Any]) -> Any:
+    """
+    Outer middleware нажатий кнопок: лишние нажатия (по правилам CALLBACK_RULES) получают короткий ответ
+    и не доходят ни до фильтров, ни до middleware с обращениями к БД.
+    """
+    rule = _callback_rule(event.data)
+    if rule is None or event.from_user.id in ADMIN_IDS or await allow(rule, event.from_user.id):
+        return await handler(event, data)
+    logging.debug(f"Ограничение частоты ({rule.name}): нажатие пользователя {event.from_user.id} отброшено")
+    try:
+        await event.answer(THROTTLED_CALLBACK_TEXT)
+    except TelegramAPIError:
+        pass
+
+
+def throttle_stats() -> Dict[str, Dict[str, Any]]:
+    """По каждому правилу (сообщения и кнопки): лимит, пропущенные и отброшенные события, число окон в памяти."""
+    return {
+        name: {
+            "limit": f"{rule.limit}/{rule.period:g}s",
+            "passed": rule.passed,
+            "dropped": rule.dropped,
+            "keys": len(_stores[name]) if THROTTLE_BACKEND == "memory" else None,
+        }
+        for name, rule in RULES.items()
+    }
+
+
+async def _cleanup_loop():
+    while True:
+        await asyncio.sleep(THROTTLE_CLEANUP_INTERVAL)
+        try:
+            await db.delete_expired_throttle_hits()
+        except Exception as e:
+            logging.error(f"Ошибка очистки счетчиков частоты: {e}")
+
+
+def start_cleanup():
+    """Запускает удаление истекших окон из таблицы throttle_hits (только для THROTTLE_BACKEND=postgres)."""
+    global _cleanup_task
+    if THROTTLE_BACKEND == "postgres" and (_cleanup_task is None or _cleanup_task.done()):
+        _cleanup_task = asyncio.create_task(_cleanup_loop())
+
+
+async def stop_cleanup():
+    global _cleanup_task
+    if _cleanup_task is not None:
+        _cleanup_task.cancel()
+        await asyncio.gather(_cleanup_task, return_exceptions=True)
+        _cleanup_task = None
@@ -0,0 +1,44 @@
+# user_menu.py
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+import db
+import kb
+from access import ADMIN_IDS
+
+# Обновление "меню" пользователя (сообщения с карточкой лота) вне хендлеров — из outbox.py
+
+
+async def update_participation_menu(bot: Bot, user_id: int, auction_id: int, new_part_status: str):
+    """Пытается обновить меню пользователя, если он смотрит на этот лот."""
+    try:
+        # Проверяем, что лот, который модерируют, = активный лот
+        active_auction = await db.get_active_auction()
+        if not active_auction or active_auction['auction_id'] != auction_id:
+            return  # Лот уже неактивен, обновлять нечего
+
+        # Проверяем, что меню пользователя = ID лота
+        menu_id = await db.get_user_menu_message_id(user_id)
+        if not menu_id:
+            return  # У пользователя нет активного меню
+
+        # (Мы не можем 100% знать, что menu_id - это карточка аукциона,
+        # но если ID совпали, то 99% это так)
+
+        is_admin = int(user_id) in ADMIN_IDS  # (Будет False)
+        new_kb = kb.get_auction_keyboard(
+            auction_id,
+            active_auction['blitz_price'],
+            participation_status=new_part_status,
+            is_admin=is_admin
+        )
+        await bot.edit_message_reply_markup(
+            chat_id=user_id,
+            message_id=menu_id,
+            reply_markup=new_kb
+        )
+        logging.info(f"Обновлено меню участия (на {new_part_status}) для {user_id}")
+    except TelegramAPIError as e:
+        logging.warning(f"Не удалось 'вживую' обновить меню {user_id} при модерации: {e}")
@@ -0,0 +1,141 @@
+# webhook.py
+import asyncio
+import hmac
+import logging
+import os
+from typing import Any, Dict, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
+
+import metrics
+
+# Публичный адрес, на который Telegram шлет обновления (https://bot.example.com), и путь обработчика.
+# Без WEBHOOK_BASE_URL вебхук не регистрируется (его уже зарегистрировала другая реплика
+# или маршрутизатор кластера — тогда этот процесс работает воркером, см. cluster.py; нужен CLUSTER_SYNC=true)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token: запросы без него отклоняются
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+# Сколько соединений Telegram держит к нам одновременно (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Сколько обновлений обрабатывается одновременно. Когда лимит занят, ответ Telegram задерживается
+# (он не шлет новые обновления по занятым соединениям), а через WEBHOOK_QUEUE_TIMEOUT секунд
+# отвечаем 503 — Telegram повторит доставку позже
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "200"))
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", "5"))
+# Сколько секунд при остановке ждем завершения уже принятых обновлений
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler:
+    """
+    Принимает обновления от Telegram: проверяет секрет, сразу отвечает 200
+    и обрабатывает обновление в фоне, не больше WEBHOOK_MAX_IN_FLIGHT одновременно.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.slots = asyncio.Semaphore(WEBHOOK_MAX_IN_FLIGHT)
+        self.tasks: Set[asyncio.Task] = set()
+        self.accepted = 0
+        self.rejected = 0
+        self.unauthorized = 0
+        self.failed = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), self.secret.encode()):
+            self.unauthorized += 1
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        try:
+            await asyncio.wait_for(self.slots.acquire(), WEBHOOK_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logging.warning(f"Вебхук: {len(self.tasks)} обновлений в обработке, "
+                            f"обновление {update.get('update_id')} отклонено (Telegram повторит)")
+            return web.Response(status=503)
+
+        self.accepted += 1
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Dict[str, Any]):
+        try:
+            await self.dp.feed_raw_update(self.bot, update)
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            self.slots.release()
+
+    async def drain(self, *_: Any):
+        """Дожидается обработки принятых обновлений (при остановке сервера)."""
+        if self.tasks:
+            logging.info(f"Вебхук: ждем завершения {len(self.tasks)} обновлений...")
+            await asyncio.wait(set(self.tasks), timeout=WEBHOOK_DRAIN_TIMEOUT)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self.tasks),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "unauthorized": self.unauthorized,
+            "failed": self.failed,
+        }
+
+
+async def register_webhook(dp: Dispatcher, bot: Bot):
+    """Регистрирует вебхук в Telegram на WEBHOOK_BASE_URL + WEBHOOK_PATH."""
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    logging.info(f"Вебхук зарегистрирован: {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+
+
+async def serve(app: web.Application):
+    """Запускает aiohttp-приложение на WEBAPP_HOST:WEBAPP_PORT и работает до остановки."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    logging.info(f"Прием обновлений на {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Запускает aiohttp-сервер для приема обновлений (вместо long polling)."""
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для режима webhook укажите WEBHOOK_SECRET в .env")
+
+    handler = WebhookHandler(dp, bot, WEBHOOK_SECRET)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+    metrics.register("webhook", handler.stats)
+    metrics.add_route(app)
+    # Сначала дожидаемся принятых обновлений, затем останавливаем фоновые задачи бота (dp.shutdown)
+    app.on_shutdown.append(handler.drain)
+    setup_application(app, dp, bot=bot)
+
+    if WEBHOOK_BASE_URL:
+        await register_webhook(dp, bot)
+    await serve(app)